@@ -0,0 +1,146 @@
+import argparse
+import hashlib
+import http.server
+import io
+import os
+import random
+import re
+import socketserver
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+'''Downloads a release archive the way nodes do, from a local HTTP server that injects failures: dropped connections, slow transfers, and ignored range requests.
+Reports time taken and bytes served per case, and fails when a download does not complete, extracts the wrong files, or downloads anything twice while the server accepts range requests.
+Usage: python3 benchmarks/flaky_download.py [--size MiB] [--seed N]'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Appends main project root as importpath.
+
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+
+
+class _Faults(object):
+    '''Failures the server injects. The first `drops` responses are cut off after a random number of bytes.'''
+    def __init__(self, drops=0, ranges=True, slow_responses=0, seed=0):
+        self.drops = drops
+        self.ranges = ranges
+        self.slow_responses = slow_responses # Number of first responses sent at a trickle.
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.served = 0
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        data, faults = self.server.data, self.server.faults
+        start, end = 0, len(data)
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and faults.ranges:
+            start, end = int(match.group(1)), int(match.group(2))+1 if match.group(2) else len(data)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end-1, len(data)))
+        else:
+            self.send_response(200)
+        if faults.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end-start))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with faults.lock:
+            faults.requests += 1
+            slow = faults.requests <= faults.slow_responses
+            cut = end if faults.requests > faults.drops else faults.random.randint(start, end-1)
+        try:
+            for x in range(start, cut, 64*1024 if not slow else 1024):
+                chunk = data[x:min(x+(64*1024 if not slow else 1024), cut)]
+                self.wfile.write(chunk)
+                with faults.lock:
+                    faults.served += len(chunk)
+                if slow:
+                    time.sleep(0.1)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            pass
+        self.close_connection = True
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _archive(size):
+    '''Returns a release-like tar.gz archive with a binary, consoles, and `size` MiB of files we do not install.'''
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w:gz') as tar:
+        for name, data in (('prometheus', b'#!/bin/sh\nexit 0\n'), ('consoles/index.html', b'console'), ('promtool', os.urandom(size*1024*1024)), ('LICENSE', b'license')):
+            info = tarfile.TarInfo('prometheus-flaky.linux-amd64/{}'.format(name))
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+def _cases():
+    '''Returns cases. Every case maps its name to a `(faults, streams)` pair.'''
+    return {
+        'clean': (dict(), 1),
+        'dropped connections': (dict(drops=3), 1),
+        'dropped connections, no ranges': (dict(drops=3, ranges=False), 1),
+        'slow start': (dict(slow_responses=1), 1),
+        'parallel': (dict(), 4),
+        'parallel, dropped connections': (dict(drops=2), 4),
+        'parallel, slow start': (dict(slow_responses=2), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='flaky_download', description='Download a release archive from a local server that injects failures.')
+    parser.add_argument('--size', metavar='MiB', type=int, default=32, help='Size of the archive, in MiB (default=32).')
+    parser.add_argument('--retries', metavar='amount', type=int, default=20, help='Amount of download attempts per case (default=20).')
+    parser.add_argument('--seed', metavar='number', type=int, default=0, help='Seed for injected failures (default=0).')
+    args = parser.parse_args()
+
+    data = _archive(args.size)
+    sha256 = hashlib.sha256(data).hexdigest()
+    module = generate_module_lifecycle(silent=True)
+    module._backoff_base = 0.05 # Keeps runs short. Real downloads back off for seconds.
+    module._throughput_window = 1
+    module._socket_timeout = 5
+    module._parallel_min_size = 1024*1024
+
+    failures = []
+    print('{:<36}{:>8}{:>12}{:>10}{:>12}{:>6}'.format('case', 'streams', 'time (s)', 'requests', 'served (%)', 'ok'))
+    for name, (faults, streams) in _cases().items():
+        server = _Server(('127.0.0.1', 0), _Handler)
+        server.data, server.faults = data, _Faults(seed=args.seed, **faults)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ['XDG_CACHE_HOME'] = tmpdir
+            location = os.path.join(tmpdir, 'install')
+            t0 = time.monotonic()
+            ok = module._download_url(location, 'http://127.0.0.1:{}/prometheus-flaky.linux-amd64.tar.gz'.format(server.server_address[1]), name=name, silent=True, retries=args.retries, sha256=sha256, members=['prometheus', 'consoles'], streams=streams)
+            elapsed = time.monotonic() - t0
+            ok = ok and sorted(os.listdir(location)) == ['consoles', 'prometheus']
+        ok = ok and (server.faults.served <= len(data)*1.01 or not server.faults.ranges) # Downloads must resume, instead of starting over, when the server accepts ranges.
+        server.shutdown()
+        server.server_close()
+        print('{:<36}{:>8}{:>12.2f}{:>10}{:>12.1f}{:>6}'.format(name, streams, elapsed, server.faults.requests, server.faults.served*100/len(data), 'yes' if ok else 'no'))
+        if not ok:
+            failures.append(name)
+
+    if any(failures):
+        print('{} case(s) did not download correctly: {}'.format(len(failures), ', '.join(failures)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
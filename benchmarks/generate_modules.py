@@ -0,0 +1,59 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+'''Measures remote module generation time for the lifecycle bundle.
+Usage: python3 benchmarks/generate_modules.py [--repeats N]'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Appends main project root as importpath.
+
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+import prometheus_grafana_deploy.internal.remoto.modulegenerator as modulegenerator
+
+
+def _generators():
+    return {
+        'all_lifecycle': generate_module_lifecycle,
+    }
+
+
+def _measure(func, repeats, clear_parsed):
+    '''Times `func`, forcing module generation for every run.
+    Args:
+        func (callable): Module generation function to measure.
+        repeats (int): Number of measurements to take.
+        clear_parsed (bool): If set, also drops parsed files, so every run parses all input files again.
+
+    Returns:
+        `list(float)` of timings in seconds.'''
+    timings = []
+    for _ in range(repeats):
+        modulegenerator._loaded_modules.clear()
+        if clear_parsed:
+            modulegenerator._parsed_files.clear()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ['XDG_CACHE_HOME'] = tmpdir
+            modulegenerator._load_stl_libs() # Index loading is measured separately, not part of module generation.
+            t0 = time.perf_counter()
+            func(silent=True)
+            timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='generate_modules', description='Measure remote module generation time.')
+    parser.add_argument('--repeats', metavar='amount', type=int, default=50, help='Amount of measurements per module (default=50).')
+    args = parser.parse_args()
+
+    print('{:<16}{:>24}{:>24}'.format('module', 'all files (ms)', 'unchanged files (ms)'))
+    for name, func in _generators().items():
+        cold = _measure(func, args.repeats, clear_parsed=True)
+        warm = _measure(func, args.repeats, clear_parsed=False)
+        print('{:<16}{:>24.3f}{:>24.3f}'.format(name, statistics.median(cold)*1000, statistics.median(warm)*1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+'''Checks CLI startup cost: Runs "grafana-monitor" with "python -X importtime", and fails when a command loads modules it should not, or takes longer than its import budget.
+Usage: python3 benchmarks/importtime.py [--repeats N] [--budget ms]'''
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_heavy = ('remoto', 'execnet', 'yaml', 'metareserve', 'prometheus_grafana_deploy.internal.remoto') # Modules only lifecycle commands may load, when executing.
+
+
+def _cases():
+    '''Returns cases. Every case maps its commandline arguments to modules (and their submodules) it may not load.'''
+    return {
+        '--help': _heavy,
+        'install --help': _heavy,
+        'start --help': _heavy,
+        'stop --help': _heavy,
+        'uninstall --help': _heavy,
+        'deploy --help': _heavy,
+        'pool --help': _heavy,
+        'dash spark_rados -- -h': _heavy,
+    }
+
+
+def _importtime(args):
+    '''Runs the CLI once with given arguments.
+    Returns:
+        `(total import time in seconds, list(str) of imported module names)`.'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'prometheus_grafana_deploy.cli.entrypoint']+args.split(), cwd=_root, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    total = 0
+    modules = []
+    for line in proc.stderr.decode('utf-8').split('\n'):
+        if not line.startswith('import time:'):
+            continue
+        selftime, _, name = line[len('import time:'):].split('|')
+        if not selftime.strip().isdigit():
+            continue # Header line.
+        total += int(selftime)
+        modules.append(name.strip())
+    return total / 1000000, modules
+
+
+def _forbidden(modules, forbidden):
+    '''Returns which of given forbidden modules were loaded, directly or through one of their submodules.'''
+    return [x for x in forbidden if any(y == x or y.startswith(x+'.') for y in modules)]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='importtime', description='Check that CLI commands stay within their import budget.')
+    parser.add_argument('--repeats', metavar='amount', type=int, default=5, help='Amount of runs per case. The median import time counts (default=5).')
+    parser.add_argument('--budget', metavar='ms', type=float, default=100, help='Maximum total import time per case, including interpreter startup modules, in milliseconds (default=100).')
+    args = parser.parse_args()
+
+    failures = []
+    print('{:<32}{:>10}{:>12}{:>8}'.format('case', 'modules', 'time (ms)', 'ok'))
+    for case, forbidden in _cases().items():
+        timings = []
+        for x in range(args.repeats):
+            total, modules = _importtime(case)
+            timings.append(total)
+        median = statistics.median(timings)
+        loaded = _forbidden(modules, forbidden)
+        ok = median*1000 <= args.budget and not loaded
+        print('{:<32}{:>10}{:>12.1f}{:>8}'.format(case, len(modules), median*1000, 'yes' if ok else 'no'))
+        if loaded:
+            print('    loads: {}'.format(', '.join(loaded)))
+        if not ok:
+            failures.append(case)
+
+    if any(failures):
+        print('{} case(s) over budget ({}ms) or loading forbidden modules: {}'.format(len(failures), args.budget, ', '.join(failures)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
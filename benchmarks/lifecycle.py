@@ -0,0 +1,202 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+'''Measures orchestration cost of lifecycle commands on synthetic reservations, using loopback nodes instead of remote hosts.
+For every reservation size, records wall-clock time, controller CPU time, peak controller RSS, peak thread count, peak open file descriptors, and bytes sent per node.
+Results are written as JSON, to compare releases. Linux only, as resource usage is read from /proc.
+Note: Every loopback node is a local Python process. Large reservations need a lot of memory, and a high open file limit.
+Usage: python3 benchmarks/lifecycle.py [--nodes N [N ...]] [--output path]'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Appends main project root as importpath.
+
+from prometheus_grafana_deploy.install import install
+from prometheus_grafana_deploy.internal.remoto.loopback import get_loopback_wrappers, fake_releases
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import close_wrappers
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
+from prometheus_grafana_deploy.start import start
+from prometheus_grafana_deploy.stop import stop
+from prometheus_grafana_deploy.uninstall import uninstall
+import synthetic
+
+
+def _commands():
+    return {
+        'install': install,
+        'start': start,
+        'stop': stop,
+        'uninstall': uninstall,
+    }
+
+
+def _proc_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field+':'):
+                return int(line.split()[1])
+    return 0
+
+
+class _Sampler(object):
+    '''Samples controller resource usage in the background, keeping peak values. The sampler thread itself is not counted.'''
+    def __init__(self, interval=0.02):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.rss_peak_kb = 0
+        self.threads_peak = 0
+        self.fds_peak = 0
+
+    def _sample(self):
+        self.rss_peak_kb = max(self.rss_peak_kb, _proc_status('VmRSS'))
+        self.threads_peak = max(self.threads_peak, _proc_status('Threads') - (1 if self._thread.is_alive() else 0))
+        self.fds_peak = max(self.fds_peak, len(os.listdir('/proc/self/fd')))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+
+class _SentCounter(object):
+    '''Counts bytes the controller sends to every node, by wrapping the write function of execnet gateway io objects.'''
+    def __init__(self):
+        self._sent = dict()
+
+    def attach(self, wrappers):
+        for node, wrapper in wrappers.items():
+            io = wrapper.connection.gateway._io
+            self._sent[node] = 0
+            def write(data, node=node, write=io.write):
+                self._sent[node] += len(data)
+                return write(data)
+            io.write = write
+
+    def reset(self):
+        self._sent = {x: 0 for x in self._sent}
+
+    def per_node(self):
+        '''Returns `(mean, max)` bytes sent per node since the last reset.'''
+        if not self._sent:
+            return 0, 0
+        return sum(self._sent.values()) / len(self._sent), max(self._sent.values())
+
+
+def _measure(name, func, sent_counter=None, verbose=False):
+    '''Runs `func`, and records its resource usage.
+    Returns:
+        `(func return value, dict of measurements)`.'''
+    if sent_counter:
+        sent_counter.reset()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull), _Sampler() as sampler:
+        t0 = time.perf_counter()
+        retval = func()
+        wall = time.perf_counter() - t0
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    measurements = {
+        'command': name,
+        'wall_s': wall,
+        'cpu_s': (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime),
+        'rss_peak_mb': sampler.rss_peak_kb / 1024,
+        'threads_peak': sampler.threads_peak,
+        'fds_peak': sampler.fds_peak,
+    }
+    if sent_counter:
+        measurements['bytes_sent_per_node_mean'], measurements['bytes_sent_per_node_max'] = sent_counter.per_node()
+    return retval, measurements
+
+
+def _succeeded(retval):
+    return (retval[0] if isinstance(retval, tuple) else retval) == True
+
+
+def _run_size(amount, commands, root, max_parallel, netns, verbose):
+    '''Runs all commands on a synthetic reservation of given size.
+    Returns:
+        `list(dict)` of measurements, one for connecting, one per command, and one for closing.'''
+    reservation = synthetic.reservation(amount)
+    node_exporter_url, prometheus_url = fake_releases(root)
+    sent_counter = _SentCounter()
+    wrappers, connect = _measure('connect', lambda: get_loopback_wrappers(reservation.nodes, os.path.join(root, str(amount)), netns=netns, max_parallel=max_parallel, silent=True), verbose=verbose)
+    connect['ok'] = all(x.open for x in wrappers.values())
+    results = [connect]
+    try:
+        if connect['ok']:
+            sent_counter.attach(wrappers)
+            for name in commands:
+                kwargs = {'node_exporter_url': node_exporter_url, 'prometheus_url': prometheus_url} if name == 'install' else {}
+                retval, measurements = _measure(name, lambda: _commands()[name](reservation, connectionwrappers=wrappers, max_parallel=max_parallel, silent=True, **kwargs), sent_counter=sent_counter, verbose=verbose)
+                measurements['ok'] = _succeeded(retval)
+                results.append(measurements)
+    finally:
+        _, close = _measure('close', lambda: close_wrappers(wrappers, max_parallel=max_parallel), verbose=verbose)
+        close['ok'] = True
+        results.append(close)
+    for x in results:
+        x['nodes'] = amount
+    return results
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception as e:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='lifecycle', description='Measure orchestration cost of lifecycle commands on loopback nodes.')
+    parser.add_argument('--nodes', metavar='amount', type=int, nargs='+', default=[10, 100, 1000, 5000], help='Reservation sizes to measure (default=10 100 1000 5000).')
+    parser.add_argument('--commands', metavar='name', type=str, nargs='+', choices=list(_commands().keys()), default=list(_commands().keys()), help='Commands to run, in order (default=all).')
+    parser.add_argument('--max-parallel', metavar='amount', dest='max_parallel', type=int, default=fanout_defaults.max_parallel(), help='Maximum number of nodes to work on at once (default={}).'.format(fanout_defaults.max_parallel()))
+    parser.add_argument('--netns', help='If set, runs every loopback node in its own network namespace.', action='store_true')
+    parser.add_argument('--output', metavar='path', type=str, default='lifecycle_benchmark.json', help='Path to write JSON results to (default=lifecycle_benchmark.json).')
+    parser.add_argument('--verbose', help='If set, shows output of lifecycle commands.', action='store_true')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # Every loopback node uses several file descriptors.
+
+    results = []
+    print('{:>8}{:>12}{:>12}{:>12}{:>12}{:>10}{:>10}{:>16}{:>6}'.format('nodes', 'command', 'wall (s)', 'cpu (s)', 'rss (MB)', 'threads', 'fds', 'sent/node (B)', 'ok'))
+    for amount in args.nodes:
+        with tempfile.TemporaryDirectory() as root:
+            for x in _run_size(amount, args.commands, root, args.max_parallel, args.netns, args.verbose):
+                print('{:>8}{:>12}{:>12.3f}{:>12.3f}{:>12.1f}{:>10}{:>10}{:>16.0f}{:>6}'.format(x['nodes'], x['command'], x['wall_s'], x['cpu_s'], x['rss_peak_mb'], x['threads_peak'], x['fds_peak'], x.get('bytes_sent_per_node_mean', 0), 'yes' if x['ok'] else 'no'))
+                results.append(x)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.time(),
+            'max_parallel': args.max_parallel,
+            'netns': args.netns,
+            'results': results,
+        }, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+'''Measures local code paths that run on every command, and fails when they slow down compared to a baseline.
+Baselines are machine-specific: Store one with "--save-baseline" on a reference revision, and compare later revisions against it on the same machine with "--baseline".
+Usage: python3 benchmarks/micro.py [--repeats N] [--save-baseline path] [--baseline path [--threshold percentage]]'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Appends main project root as importpath.
+
+import prometheus_grafana_deploy.internal.remoto.bundle as bundle
+import prometheus_grafana_deploy.internal.remoto.modulegenerator as modulegenerator
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import _build_ssh_config
+import prometheus_grafana_deploy.internal.util.fs as fs
+import prometheus_grafana_deploy.internal.util.location as loc
+from prometheus_grafana_deploy.start import _prometheus_config
+from prometheus_grafana_deploy.thirdparty.sshconf import SshConfigFile, empty_ssh_config_file
+import synthetic
+
+
+_hosts = 1000 # Number of hosts in ssh config cases.
+_nodes = 5000 # Number of nodes in reservation cases.
+
+
+def _lifecycle_generator():
+    '''Returns a `ModuleGenerator` with the inputs of the lifecycle bundle. See `generate_module_lifecycle` in `internal/remoto/bundle.py`.'''
+    files = [fs.join(fs.dirname(fs.dirname(fs.abspath(bundle.__file__))), 'util', 'printer.py')]
+    files += sorted(x for x in fs.ls(bundle._modules_dir(), only_files=True, full_paths=True) if x.endswith('.py') and fs.basename(x) != '__init__.py')
+    return modulegenerator.ModuleGenerator().with_modules(fs).with_files(*files).with_entrypoints(*bundle.entrypoints())
+
+
+def _host_params(amount):
+    return {'host{}'.format(x): {'IdentitiesOnly': 'yes', 'User': 'user{}'.format(x % 7), 'StrictHostKeyChecking': 'no', 'IdentityFile': '/keys/{}.rsa'.format(x % 3)} for x in range(amount)}
+
+
+def _sshconf_lines(amount):
+    conf = empty_ssh_config_file()
+    for hostname, params in _host_params(amount).items():
+        conf.add(hostname, **params)
+    return conf.config().split('\n')
+
+
+def _load_generator(name):
+    path = fs.join(loc.generators_dir(), '{}.py'.format(name))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _cases(tmpdir):
+    '''Returns benchmark cases. Every case maps its name to a `(setup, func)` pair. `setup` runs before every measurement, and is not measured.'''
+    generator_out = fs.join(tmpdir, 'generated.py')
+    sshconf_out = fs.join(tmpdir, 'ssh_config')
+    sshconf_lines = _sshconf_lines(_hosts)
+    host_params = _host_params(_hosts)
+    reservation = synthetic.reservation(_nodes, jobs=('client', 'storage'))
+    spark_rados = _load_generator('spark_rados')
+    spark_rados_out = fs.join(tmpdir, 'spark_rados.json')
+
+    def clear_parsed():
+        modulegenerator._parsed_files.clear()
+
+    def written_sshconf():
+        conf = empty_ssh_config_file()
+        for hostname, params in host_params.items():
+            conf.add(hostname, **params)
+        return conf
+
+    state = dict()
+    return {
+        'modulegenerator.generate (cold)': (clear_parsed, lambda: _lifecycle_generator().generate(generator_out, silent=True)),
+        'modulegenerator.generate (warm)': (None, lambda: _lifecycle_generator().generate(generator_out, silent=True)),
+        'modulegenerator._generate_stl_libs': (None, modulegenerator._generate_stl_libs),
+        'sshconf.parse ({} hosts)'.format(_hosts): (None, lambda: SshConfigFile(sshconf_lines)),
+        'sshconf.add ({} hosts)'.format(_hosts): (None, written_sshconf),
+        'sshconf.write ({} hosts)'.format(_hosts): (lambda: state.update(conf=written_sshconf()), lambda: state['conf'].write(sshconf_out)),
+        'ssh_wrapper._build_ssh_config ({} hosts)'.format(_hosts): (None, lambda: _build_ssh_config(host_params).close()),
+        'start._prometheus_config ({} nodes)'.format(_nodes): (None, lambda: _prometheus_config(reservation.nodes)),
+        'spark_rados.generate ({} nodes)'.format(_nodes): (None, lambda: spark_rados.generate(reservation, spark_rados_out)),
+    }
+
+
+def _measure(setup, func, repeats):
+    '''Times `func` after one warmup run.
+    Returns:
+        `list(float)` of timings in seconds.'''
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for x in range(repeats+1):
+            if setup:
+                setup()
+            t0 = time.perf_counter()
+            func()
+            if x > 0:
+                timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='micro', description='Measure local code paths, and detect regressions against a baseline.')
+    parser.add_argument('--repeats', metavar='amount', type=int, default=20, help='Amount of measurements per case (default=20).')
+    parser.add_argument('--filter', metavar='text', type=str, default=None, help='If set, only runs cases with given text in their name.')
+    parser.add_argument('--baseline', metavar='path', type=str, default=None, help='Baseline JSON file to compare against. Exits with status 1 if a case is slower than its baseline by more than "--threshold" percent.')
+    parser.add_argument('--threshold', metavar='percentage', type=float, default=25, help='Maximum allowed slowdown compared to the baseline, in percent (default=25).')
+    parser.add_argument('--save-baseline', metavar='path', dest='save_baseline', type=str, default=None, help='If set, writes results to given path, for use as baseline.')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+
+    results = dict()
+    regressions = []
+    print('{:<48}{:>14}{:>14}{:>12}'.format('case', 'median (ms)', 'baseline (ms)', 'change'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['XDG_CACHE_HOME'] = tmpdir # Keeps the persistent stl index of the user out of measurements.
+        for name, (setup, func) in _cases(tmpdir).items():
+            if args.filter and not args.filter in name:
+                continue
+            results[name] = statistics.median(_measure(setup, func, args.repeats))
+            if baseline and name in baseline:
+                change = (results[name] / baseline[name] - 1) * 100
+                if change > args.threshold:
+                    regressions.append(name)
+                print('{:<48}{:>14.3f}{:>14.3f}{:>11.1f}%{}'.format(name, results[name]*1000, baseline[name]*1000, change, ' REGRESSION' if change > args.threshold else ''))
+            else:
+                print('{:<48}{:>14.3f}{:>14}{:>12}'.format(name, results[name]*1000, '-', '-'))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'repeats': args.repeats, 'results': results}, f, indent=2)
+        print('Baseline written to {}'.format(args.save_baseline))
+    if any(regressions):
+        print('{} case(s) slowed down by more than {}%: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import getpass
+
+'''Synthetic reservations for benchmarks.'''
+
+from metareserve import Reservation
+
+
+def reservation(amount, jobs=('client',)):
+    '''Builds a synthetic reservation with given amount of nodes, with distinct ips.
+    Args:
+        amount (int): Number of nodes.
+        jobs (optional tuple(str)): Jobs to assign to nodes, round-robin.
+
+    Returns:
+        `metareserve.Reservation`.'''
+    user = getpass.getuser()
+    return Reservation.from_string('\n'.join('{0}|node{0}|10.{1}.{2}.{3}|10.{1}.{2}.{3}|22|user={4}|job={5}'.format(x, x // 65536 % 256, x // 256 % 256, x % 256, user, jobs[x % len(jobs)]) for x in range(amount)))
@@ -3,8 +3,6 @@ import prometheus_grafana_deploy.internal.defaults.dash as defaults
 import prometheus_grafana_deploy.internal.util.location as loc
 from prometheus_grafana_deploy.internal.util.printer import *
 
-from prometheus_grafana_deploy.dash import dash_cli as _dash_cli
-
 
 '''CLI module to generate dashboards for Grafana.'''
 
@@ -25,4 +23,5 @@ def deploy_args_set(args):
     return args.command == 'dash'
 
 def deploy(parsers, args):
+    from prometheus_grafana_deploy.dash import dash_cli as _dash_cli
     return _dash_cli(args.generator_name, args.args, output=args.output)
\ No newline at end of file
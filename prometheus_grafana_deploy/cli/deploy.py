@@ -0,0 +1,47 @@
+import prometheus_grafana_deploy.cli.util as _cli_util
+import prometheus_grafana_deploy.internal.defaults.install as install_defaults
+import prometheus_grafana_deploy.internal.defaults.mirror as mirror_defaults
+import prometheus_grafana_deploy.internal.defaults.start as start_defaults
+
+
+'''CLI module to install and start Prometheus+Grafana on a cluster in one go.'''
+
+def subparser(subparsers):
+    '''Register subparser modules'''
+    deployparser = subparsers.add_parser('deploy', help='Install and start Prometheus+Grafana on a cluster. Nodes start exporting as soon as they are installed.')
+    deployparser.add_argument('--admin', metavar='id', dest='admin_id', type=int, default=None, help='ID of the node that will be the Prometheus admin node.')
+    deployparser.add_argument('--node-exporter-url', metavar='url', dest='node_exporter_url', type=str, default=install_defaults.node_exporter_url(), help='Prometheus node exporter download URL.')
+    deployparser.add_argument('--prometheus-port', metavar='number', type=int, default=start_defaults.prometheus_port(), help='Port to use for Prometheus.')
+    deployparser.add_argument('--grafana-name', metavar='name', dest='grafana_name', type=str, default=start_defaults.grafana_name(), help='Grafana docker run name to use (default={}).'.format(start_defaults.grafana_name()))
+    deployparser.add_argument('--grafana-port', metavar='number', type=int, default=start_defaults.grafana_port(), help='Port to use for Grafana (default={}).'.format(start_defaults.grafana_port()))
+    deployparser.add_argument('--grafana-image', metavar='image', dest='grafana_image', type=str, default=install_defaults.grafana_image(), help='Grafana docker image to download and use (default={}).'.format(install_defaults.grafana_image()))
+    deployparser.add_argument('--force-reinstall', dest='force_reinstall', help='If set, we always will reinstall components, from archives cached on the nodes if available. Otherwise, we will skip installing if we already have installed components.', action='store_true')
+    deployparser.add_argument('--no-verify', dest='verify', help='If set, does not fetch release archives locally to verify their checksums. Nodes then download without verification.', action='store_false')
+    deployparser.add_argument('--push', help='If set, streams release archives from this machine to the nodes over the existing connections, for nodes without internet access.', action='store_true')
+    deployparser.add_argument('--mirror', help='If set, only the admin node fetches release archives, and serves them to all other nodes over the cluster network with a short-lived HTTP server.', action='store_true')
+    deployparser.add_argument('--mirror-port', metavar='number', dest='mirror_port', type=int, default=mirror_defaults.port(), help='Port for the mirror HTTP server on the admin node (default={}).'.format(mirror_defaults.port()))
+    deployparser.add_argument('--mirror-clients', metavar='amount', dest='mirror_clients', type=int, default=mirror_defaults.max_clients(), help='Maximum number of nodes downloading from the mirror at once (default={}).'.format(mirror_defaults.max_clients()))
+    deployparser.add_argument('--download-streams', metavar='amount', dest='download_streams', type=int, default=install_defaults.download_streams(), help='Number of parallel range requests nodes use to download large release archives (default={}).'.format(install_defaults.download_streams()))
+    deployparser.add_argument('--silent', help='If set, less boot output is shown.', action='store_true')
+    deployparser.add_argument('--retries', metavar='amount', type=int, default=install_defaults.retries(), help='Amount of retries to use for risky operations (default={}).'.format(install_defaults.retries()))
+    return [deployparser]
+
+
+def deploy_args_set(args):
+    '''Indicates whether we will handle command parse output in this module.
+    `deploy()` function will be called if set.
+
+    Returns:
+        `True` if we found arguments used by this subsubparser, `False` otherwise.'''
+    return args.command == 'deploy'
+
+
+def deploy(parsers, args):
+    from prometheus_grafana_deploy.deploy import deploy as _deploy
+    reservation = _cli_util.read_reservation_cli()
+    if not reservation:
+        return False
+    tracer = _cli_util.tracer(args)
+    retval = _deploy(reservation, args.install_dir, args.key_path, args.admin_id, node_exporter_url=args.node_exporter_url, grafana_image=args.grafana_image, force_reinstall=args.force_reinstall, verify=args.verify, push=args.push, mirror=args.mirror, mirror_port=args.mirror_port, mirror_clients=args.mirror_clients, download_streams=args.download_streams, prometheus_port=args.prometheus_port, grafana_name=args.grafana_name, grafana_port=args.grafana_port, pool=_cli_util.pool(args), max_parallel=args.max_parallel, handshake_rate=args.handshake_rate, window=args.window, relay=args.relay, step_timeout=args.step_timeout, node_timeout=args.node_timeout, retry_failed=args.retry_failed, partial=args.partial, tracer=tracer, silent=args.silent, retries=args.retries)
+    _cli_util.write_trace(tracer, args.trace)
+    return retval
@@ -10,23 +10,41 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspa
 
 import prometheus_grafana_deploy
 
+import prometheus_grafana_deploy.internal.defaults.deadline as deadline_defaults
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
 import prometheus_grafana_deploy.internal.defaults.install as install_defaults
+import prometheus_grafana_deploy.internal.defaults.pool as pool_defaults
 
 
 def _get_modules():
+    '''Returns all CLI modules. CLI modules only register their arguments at import time. They import what they need to execute in their `deploy()` function,
+    so only the chosen command loads remoto, execnet, metareserve etc. Use "benchmarks/importtime.py" to check that this stays the case.'''
     import prometheus_grafana_deploy.cli.install as install
     import prometheus_grafana_deploy.cli.start as start
     import prometheus_grafana_deploy.cli.stop as stop
     import prometheus_grafana_deploy.cli.uninstall as uninstall
+    import prometheus_grafana_deploy.cli.deploy as deploy
+    import prometheus_grafana_deploy.cli.pool as pool
 
     import prometheus_grafana_deploy.cli.dash as dash
-    return [install, start, stop, uninstall, dash]
+    return [install, start, stop, uninstall, deploy, pool, dash]
 
 
 def generic_args(parser):
-    '''Configure arguments important for all modules (install, uninstall, start, stop) here.'''
+    '''Configure arguments important for all modules (install, uninstall, start, stop, deploy) here.'''
     parser.add_argument('--install_dir', metavar='path', type=str, default=install_defaults.install_dir(), help='Installation directory for Prometheus, for all remote machines. Note: The home directory of the remote machines is prepended to this path if it is relative.')
     parser.add_argument('--key-path', dest='key_path', type=str, default=None, help='Path to ssh key to access nodes.')
+    parser.add_argument('--pool', help='If set, connects through a persistent connection pool. Connections stay alive for "--pool-persist" time after use, and are reused by later commands. Use "pool list" and "pool flush" to inspect and close pooled connections.', action='store_true')
+    parser.add_argument('--pool-persist', metavar='time', dest='pool_persist', type=str, default=pool_defaults.persist(), help='Time pooled connections stay alive after use, e.g. "30m" (default={}). Only used with "--pool".'.format(pool_defaults.persist()))
+    parser.add_argument('--max-parallel', metavar='amount', dest='max_parallel', type=int, default=fanout_defaults.max_parallel(), help='Maximum number of nodes to connect to and work on at once (default={}).'.format(fanout_defaults.max_parallel()))
+    parser.add_argument('--handshake-rate', metavar='amount', dest='handshake_rate', type=float, default=fanout_defaults.handshake_rate(), help='If set, starts at most this many new ssh connections per second. Use this to stay below the sshd "MaxStartups" limit of shared bastion hosts.')
+    parser.add_argument('--window', help='If set, connections are opened right before working on a node, and closed right after. This way, at most "--max-parallel" connections are open at once, and memory usage stays flat for large clusters.', action='store_true')
+    parser.add_argument('--relay', help='If set, only connects to the admin node directly, and reaches all other nodes from there, over their local ip. Only one connection crosses the link to the cluster. The admin node must be able to ssh to all other nodes using its own ssh keys.', action='store_true')
+    parser.add_argument('--step-timeout', metavar='seconds', dest='step_timeout', type=float, default=deadline_defaults.step_timeout(), help='Maximum number of seconds one step (e.g. installing Grafana) may take on a node. Use 0 to disable (default={}).'.format(deadline_defaults.step_timeout()))
+    parser.add_argument('--node-timeout', metavar='seconds', dest='node_timeout', type=float, default=deadline_defaults.node_timeout(), help='Maximum number of seconds all steps together may take on a node. Nodes that do not finish in time are cancelled and reported. Use 0 to disable (default={}).'.format(deadline_defaults.node_timeout()))
+    parser.add_argument('--retry-failed', metavar='amount', dest='retry_failed', type=int, default=0, help='Number of times to retry nodes that failed, reusing their connections (default=0).')
+    parser.add_argument('--partial', help='If set, continues on all nodes we can reach when some nodes fail, and prints which nodes failed. The Prometheus admin only scrapes nodes that succeeded.', action='store_true')
+    parser.add_argument('--trace', metavar='path', type=str, default=None, help='If set, writes a trace of every phase on every node to given path, in Chrome trace-event format, and prints the slowest nodes and phases.')
 
 
 def subparser(parser):
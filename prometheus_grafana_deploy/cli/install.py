@@ -1,6 +1,6 @@
 import prometheus_grafana_deploy.internal.defaults.install as defaults
+import prometheus_grafana_deploy.internal.defaults.mirror as mirror_defaults
 import prometheus_grafana_deploy.cli.util as _cli_util
-from prometheus_grafana_deploy.install import install as _install
 
 
 '''CLI module to install Prometheus on a cluster.'''
@@ -11,7 +11,13 @@ def subparser(subparsers):
     installparser.add_argument('--admin', metavar='id', dest='admin_id', type=int, default=None, help='ID of the node that will be the Prometheus admin node.')
     installparser.add_argument('--node-exporter-url', metavar='url', dest='node_exporter_url', type=str, default=defaults.node_exporter_url(), help='Prometheus node exporter download URL.')
     installparser.add_argument('--grafana-image', metavar='image', dest='grafana_image', type=str, default=defaults.grafana_image(), help='Grafana docker image to download (default={}).'.format(defaults.grafana_image()))
-    installparser.add_argument('--force-reinstall', dest='force_reinstall', help='If set, we always will re-download and install components. Otherwise, we will skip installing if we already have installed components.', action='store_true')
+    installparser.add_argument('--force-reinstall', dest='force_reinstall', help='If set, we always will reinstall components, from archives cached on the nodes if available. Otherwise, we will skip installing if we already have installed components.', action='store_true')
+    installparser.add_argument('--no-verify', dest='verify', help='If set, does not fetch release archives locally to verify their checksums. Nodes then download without verification.', action='store_false')
+    installparser.add_argument('--push', help='If set, streams release archives from this machine to the nodes over the existing connections, for nodes without internet access.', action='store_true')
+    installparser.add_argument('--mirror', help='If set, only the admin node fetches release archives, and serves them to all other nodes over the cluster network with a short-lived HTTP server.', action='store_true')
+    installparser.add_argument('--mirror-port', metavar='number', dest='mirror_port', type=int, default=mirror_defaults.port(), help='Port for the mirror HTTP server on the admin node (default={}).'.format(mirror_defaults.port()))
+    installparser.add_argument('--mirror-clients', metavar='amount', dest='mirror_clients', type=int, default=mirror_defaults.max_clients(), help='Maximum number of nodes downloading from the mirror at once (default={}).'.format(mirror_defaults.max_clients()))
+    installparser.add_argument('--download-streams', metavar='amount', dest='download_streams', type=int, default=defaults.download_streams(), help='Number of parallel range requests nodes use to download large release archives (default={}).'.format(defaults.download_streams()))
     installparser.add_argument('--silent', help='If set, less boot output is shown.', action='store_true')
     installparser.add_argument('--retries', metavar='amount', type=int, default=defaults.retries(), help='Amount of retries to use for risky operations (default={}).'.format(defaults.retries()))
     return [installparser]
@@ -27,7 +33,11 @@ def deploy_args_set(args):
 
 
 def deploy(parsers, args):
+    from prometheus_grafana_deploy.install import install as _install
     reservation = _cli_util.read_reservation_cli()
     if not reservation:
         return False
-    return _install(reservation, args.install_dir, args.key_path, args.admin_id, node_exporter_url=args.node_exporter_url, grafana_image=args.grafana_image, force_reinstall=args.force_reinstall, silent=args.silent, retries=args.retries) if reservation else False
\ No newline at end of file
+    tracer = _cli_util.tracer(args)
+    retval = _install(reservation, args.install_dir, args.key_path, args.admin_id, node_exporter_url=args.node_exporter_url, grafana_image=args.grafana_image, force_reinstall=args.force_reinstall, verify=args.verify, push=args.push, mirror=args.mirror, mirror_port=args.mirror_port, mirror_clients=args.mirror_clients, download_streams=args.download_streams, pool=_cli_util.pool(args), max_parallel=args.max_parallel, handshake_rate=args.handshake_rate, window=args.window, relay=args.relay, step_timeout=args.step_timeout, node_timeout=args.node_timeout, retry_failed=args.retry_failed, partial=args.partial, tracer=tracer, silent=args.silent, retries=args.retries)
+    _cli_util.write_trace(tracer, args.trace)
+    return retval
\ No newline at end of file
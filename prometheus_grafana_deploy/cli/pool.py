@@ -0,0 +1,32 @@
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''CLI module to inspect and close pooled connections.'''
+
+def subparser(subparsers):
+    '''Register subparser modules'''
+    poolparser = subparsers.add_parser('pool', help='Inspect and close pooled connections (see "--pool").')
+    poolparser.add_argument('action', type=str, choices=['list', 'flush'], help='"list" shows all pooled connections, "flush" closes them.')
+    return [poolparser]
+
+
+def deploy_args_set(args):
+    '''Indicates whether we will handle command parse output in this module.
+    `deploy()` function will be called if set.
+
+    Returns:
+        `True` if we found arguments used by this subsubparser, `False` otherwise.'''
+    return args.command == 'pool'
+
+
+def deploy(parsers, args):
+    import prometheus_grafana_deploy.internal.remoto.pool as _pool
+    if args.action == 'list':
+        connections = _pool.list_connections()
+        if not any(connections):
+            print('No pooled connections.')
+        for name, alive in connections:
+            print('    {} ({})'.format(name, 'alive' if alive else 'dead'))
+        return True
+    prints('Closed {} pooled connections.'.format(_pool.flush_connections()))
+    return True
@@ -5,7 +5,6 @@ import prometheus_grafana_deploy.internal.defaults.start as defaults
 import prometheus_grafana_deploy.internal.defaults.install as install_defaults
 
 from prometheus_grafana_deploy.internal.util.printer import *
-from prometheus_grafana_deploy.start import start as _start
 
 
 '''CLI module to start Prometheus on a cluster.'''
@@ -30,5 +29,11 @@ def deploy_args_set(args):
     return args.command == 'start'
 
 def deploy(parsers, args):
+    from prometheus_grafana_deploy.start import start as _start
     reservation = _cli_util.read_reservation_cli()
-    return _start(reservation, args.install_dir, args.key_path, args.admin_id, prometheus_port=args.prometheus_port, grafana_name=args.grafana_name, grafana_port=args.grafana_port, grafana_image=args.grafana_image, silent=args.silent) if reservation else False
\ No newline at end of file
+    if not reservation:
+        return False
+    tracer = _cli_util.tracer(args)
+    retval = _start(reservation, args.install_dir, args.key_path, args.admin_id, prometheus_port=args.prometheus_port, grafana_name=args.grafana_name, grafana_port=args.grafana_port, grafana_image=args.grafana_image, pool=_cli_util.pool(args), max_parallel=args.max_parallel, handshake_rate=args.handshake_rate, window=args.window, relay=args.relay, step_timeout=args.step_timeout, node_timeout=args.node_timeout, retry_failed=args.retry_failed, partial=args.partial, tracer=tracer, silent=args.silent)
+    _cli_util.write_trace(tracer, args.trace)
+    return retval
\ No newline at end of file
@@ -1,5 +1,4 @@
 import prometheus_grafana_deploy.cli.util as _cli_util
-from prometheus_grafana_deploy.stop import stop as _stop
 
 
 '''CLI module to stop a running Prometheus cluster.'''
@@ -22,5 +21,11 @@ def deploy_args_set(args):
 
 
 def deploy(parsers, args):
+    from prometheus_grafana_deploy.stop import stop as _stop
     reservation = _cli_util.read_reservation_cli()
-    return _stop(reservation, args.install_dir, args.key_path, args.admin_id, silent=args.silent) if reservation else False
\ No newline at end of file
+    if not reservation:
+        return False
+    tracer = _cli_util.tracer(args)
+    retval = _stop(reservation, args.install_dir, args.key_path, args.admin_id, pool=_cli_util.pool(args), max_parallel=args.max_parallel, handshake_rate=args.handshake_rate, window=args.window, relay=args.relay, step_timeout=args.step_timeout, node_timeout=args.node_timeout, retry_failed=args.retry_failed, partial=args.partial, tracer=tracer, silent=args.silent)
+    _cli_util.write_trace(tracer, args.trace)
+    return retval
\ No newline at end of file
@@ -1,7 +1,6 @@
 import prometheus_grafana_deploy.internal.defaults.uninstall as defaults
 import prometheus_grafana_deploy.internal.defaults.install as install_defaults
 import prometheus_grafana_deploy.cli.util as _cli_util
-from prometheus_grafana_deploy.uninstall import uninstall as _uninstall
 
 
 '''CLI module to install Prometheus on a cluster.'''
@@ -26,7 +25,11 @@ def deploy_args_set(args):
 
 
 def deploy(parsers, args):
+    from prometheus_grafana_deploy.uninstall import uninstall as _uninstall
     reservation = _cli_util.read_reservation_cli()
     if not reservation:
         return False
-    return _uninstall(reservation, args.install_dir, args.key_path, args.admin_id, grafana_image=args.grafana_image, silent=args.silent, retries=args.retries) if reservation else False
\ No newline at end of file
+    tracer = _cli_util.tracer(args)
+    retval = _uninstall(reservation, args.install_dir, args.key_path, args.admin_id, grafana_image=args.grafana_image, pool=_cli_util.pool(args), max_parallel=args.max_parallel, handshake_rate=args.handshake_rate, window=args.window, relay=args.relay, step_timeout=args.step_timeout, node_timeout=args.node_timeout, retry_failed=args.retry_failed, partial=args.partial, tracer=tracer, silent=args.silent, retries=args.retries)
+    _cli_util.write_trace(tracer, args.trace)
+    return retval
\ No newline at end of file
@@ -1,8 +1,8 @@
-from metareserve import Reservation as _Reservation
 from prometheus_grafana_deploy.internal.util.printer import *
 
 def read_reservation_cli():
     '''Read `MetaReserve.Reservation` from user input.'''
+    from metareserve import Reservation as _Reservation
     print('Paste Reservation string here. Use <enter> twice to finish.')
     lines = []
     while True:
@@ -16,3 +16,24 @@ def read_reservation_cli():
         printe('Could not read data from input. Was input malformed? ', e)
         return None
 
+
+def pool(args):
+    '''Returns how long pooled connections stay alive if the user asked for a connection pool, `None` otherwise.'''
+    return args.pool_persist if args.pool else None
+
+
+def tracer(args):
+    '''Returns a `Tracer` if the user asked for a trace, `None` otherwise.'''
+    if not args.trace:
+        return None
+    from prometheus_grafana_deploy.internal.util.trace import Tracer
+    return Tracer()
+
+
+def write_trace(tracer, path):
+    '''Writes given trace to given path, and prints the slowest nodes and phases. Does nothing if `tracer` is `None`.'''
+    if not tracer:
+        return
+    tracer.write(path)
+    tracer.summary()
+    prints('Trace written to {} (open it in chrome://tracing or https://ui.perfetto.dev).'.format(path))
@@ -0,0 +1,149 @@
+import time
+
+import prometheus_grafana_deploy.internal.defaults.deadline as deadline_defaults
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
+import prometheus_grafana_deploy.internal.defaults.install as install_defaults
+import prometheus_grafana_deploy.internal.defaults.mirror as mirror_defaults
+import prometheus_grafana_deploy.internal.defaults.start as start_defaults
+from prometheus_grafana_deploy.install import _fetch_artifacts, _install_plan, _pick_admin, _push_artifacts, _start_mirror, _stop_mirror
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+from prometheus_grafana_deploy.internal.remoto.fanout import run_plans, node_results
+from prometheus_grafana_deploy.internal.remoto.plan import Plan, succeeded
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers, module_cache_stats
+from prometheus_grafana_deploy.internal.util.printer import *
+from prometheus_grafana_deploy.internal.util.trace import span
+from prometheus_grafana_deploy.start import _prometheus_config, _start_admin_plan, _start_plan, _print_grafana_started
+
+
+def _deploy_plan(install_dir, is_admin, configstring, node_exporter_url=install_defaults.node_exporter_url(), prometheus_url=install_defaults.prometheus_url(), grafana_image=install_defaults.grafana_image(), force_reinstall=False, checksums=None, download_streams=install_defaults.download_streams(), grafana_name=start_defaults.grafana_name(), grafana_port=start_defaults.grafana_port(), silent=False, retries=install_defaults.retries()):
+    '''Builds the deploy plan for one node: The install plan, directly followed by the start plan. Start steps are skipped when installing fails.
+    If `configstring` is `None`, the admin node only installs everything and starts its node exporter.'''
+    plan = Plan(stop_on_failure=True)
+    plan.extend(_install_plan(install_dir, is_admin, node_exporter_url=node_exporter_url, prometheus_url=prometheus_url, grafana_image=grafana_image, force_reinstall=force_reinstall, checksums=checksums, download_streams=download_streams, silent=silent, retries=retries))
+    plan.extend(_start_plan(install_dir, is_admin and configstring != None, configstring, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, silent=silent))
+    return plan
+
+
+def deploy(reservation, install_dir=install_defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, node_exporter_url=install_defaults.node_exporter_url(), prometheus_url=install_defaults.prometheus_url(), grafana_image=install_defaults.grafana_image(), force_reinstall=False, verify=True, push=False, mirror=False, mirror_port=mirror_defaults.port(), mirror_clients=mirror_defaults.max_clients(), download_streams=install_defaults.download_streams(), prometheus_port=start_defaults.prometheus_port(), grafana_name=start_defaults.grafana_name(), grafana_port=start_defaults.grafana_port(), pool=None, max_parallel=fanout_defaults.max_parallel(), handshake_rate=fanout_defaults.handshake_rate(), window=False, relay=False, step_timeout=deadline_defaults.step_timeout(), node_timeout=deadline_defaults.node_timeout(), retry_failed=0, partial=False, tracer=None, silent=False, retries=install_defaults.retries()):
+    '''Installs and starts Prometheus+Grafana on a remote cluster, using one set of connections.
+    Installing and starting is pipelined per node: Every node starts its node exporter as soon as its own installation finishes, without waiting for other nodes.
+    The Prometheus admin configuration lists all scrape targets from the start, and is written once. Targets that are not up yet are scraped as soon as they start.
+    Args:
+        reservation (`metareserve.Reservation`): Reservation object with all nodes to deploy Prometheus on.
+        install_dir (optional str): Location on remote host to store Prometheus in.
+        key_path (optional str): Path to SSH key, which we use to connect to nodes. If `None`, we do not authenticate using an IdentityFile.
+        admin_id (optional int): Node id that must become the admin. If `None`, the node with lowest public ip value (string comparison) will be picked.
+        connectionwrappers (optional dict(metareserve.Node, RemotoSSHWrapper)): If set, uses given connections, instead of building new ones.
+        pool (optional str): If set, connects through the persistent connection pool, keeping connections alive for given time (e.g. "30m") for reuse by later invocations.
+        max_parallel (optional int): Maximum number of nodes to connect to and work on at once. If `None`, works on all nodes at once.
+        handshake_rate (optional float): If set, starts at most this many new ssh connections per second.
+        window (optional bool): If set, every connection is opened right before working on its node, and closed right after. This way, at most `max_parallel` connections are open at once. Ignored when passing `connectionwrappers`.
+        relay (optional bool): If set, only connects to the admin node directly, and reaches all other nodes from there, over their local ip. The admin node must be able to ssh to all other nodes using its own ssh keys.
+        step_timeout (optional float): Maximum number of seconds one step (e.g. installing Grafana) may take on a node. If `None` or 0, steps may take forever.
+        node_timeout (optional float): Maximum number of seconds all steps together may take on a node. Nodes that do not finish in time are cancelled and reported. If `None` or 0, nodes may take forever.
+        retry_failed (optional int): Number of times to retry nodes that failed, reusing their connections.
+        partial (optional bool): If set, continues on nodes we can reach when other nodes fail. The Prometheus admin is started after all other nodes, and only scrapes nodes that deployed successfully.
+        tracer (optional Tracer): If set, records how long every phase takes on every node. See `internal/util/trace.py`.
+        node_exporter_url (optional str): Download URL for Prometheus node exporter.
+        prometheus_url (optional str): Download URL for Prometheus.
+        grafana_image (optonal str): Grafana image to download and run.
+        force_reinstall (optional bool): If set, we always will reinstall, from archives cached on the nodes if available. Otherwise, we will skip installing if we already find an installation.
+        verify (optional bool): If set, fetches release archives once into the local artifact cache, verifies them against their published checksums, and makes nodes verify their downloads against the same checksums.
+        push (optional bool): If set, streams release archives from the local artifact cache to the nodes, over the connections we already have. Nodes then do not need internet access. Implies `verify`.
+        mirror (optional bool): If set, only the admin node fetches release archives (or receives them, with `push`). It serves them to all other nodes over their local ip, using a short-lived HTTP server.
+        mirror_port (optional int): Port for the mirror HTTP server.
+        mirror_clients (optional int): Maximum number of nodes downloading from the mirror at once.
+        download_streams (optional int): If higher than 1, nodes download large release archives with this many parallel range requests, if the server supports them.
+        prometheus_port (optional int): Port to use with Prometheus.
+        grafana_name (optional str): Grafana docker run name to use.
+        grafana_port (optional int): Port to use with Grafana.
+        silent (optional bool): If set, does not print so much info.
+        retries (optional int): Number of retries before we error.
+
+    Returns:
+        `True, admin_node_id` on success, `False, None` otherwise.
+        With `partial` set, returns `True, admin_node_id, node_results` when the Prometheus admin and Grafana started, `False, None, node_results` otherwise.
+        `node_results` is a `dict(metareserve.Node, bool)`, mapping every node to whether it deployed successfully.'''
+    admin_picked, _ = _pick_admin(reservation, admin=admin_id)
+    printc('Picked admin node: {}'.format(admin_picked), Color.CAN)
+
+    if partial:
+        configstring = None # Admin configuration is only known once we know which nodes deployed.
+    else:
+        configstring = _prometheus_config(reservation.nodes, port=prometheus_port)
+        if not configstring:
+            return False, None
+
+    local_connections = connectionwrappers == None
+    window = window and local_connections # We only close connections we opened ourselves.
+    if local_connections:
+        ssh_kwargs = {'IdentitiesOnly': 'yes', 'User': admin_picked.extra_info['user'], 'StrictHostKeyChecking': 'no'}
+        if key_path:
+            ssh_kwargs['IdentityFile'] = key_path
+        else:
+            printw('Connections have no assigned ssh key. Prepare to fill in your password often.')
+        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, pool=pool, max_parallel=max_parallel, handshake_rate=handshake_rate, lazy=window, relay=admin_picked if relay else None, relay_hostnames=lambda node: node.ip_local, tracer=tracer, silent=silent)
+    if not partial and not window and not all(x.open for x in connectionwrappers.values()):
+        if local_connections:
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        printe('Failed to create at least one connection.')
+        return False, None
+
+    t0 = time.time()
+    def _report(node, results):
+        if not succeeded(results):
+            return
+        if not silent:
+            print('Node {} exporting metrics after {:.1f} seconds.'.format(node, time.time()-t0))
+        if node == admin_picked and configstring:
+            _print_grafana_started(admin_picked, port=grafana_port)
+
+    with span(tracer, 'generate module'):
+        deploy_module = generate_module_lifecycle(silent=silent)
+    with span(tracer, 'fetch artifacts'):
+        checksums = _fetch_artifacts([node_exporter_url, prometheus_url], silent=silent, retries=retries) if verify or push else None
+    if push:
+        with span(tracer, 'push artifacts'):
+            _push_artifacts(admin_picked, node_exporter_url, prometheus_url, checksums, deploy_module, {admin_picked: connectionwrappers[admin_picked]} if mirror else connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer, silent=silent)
+    mirrored, mirror_pid = dict(), None
+    if mirror:
+        with span(tracer, 'start mirror'):
+            mirrored, mirror_pid = _start_mirror(admin_picked, [node_exporter_url], checksums, deploy_module, connectionwrappers, port=mirror_port, max_clients=mirror_clients, download_streams=download_streams, silent=silent, retries=retries, window=window, step_timeout=step_timeout, node_timeout=node_timeout, tracer=tracer)
+    plans = {node: _deploy_plan(install_dir, node == admin_picked, configstring, node_exporter_url=node_exporter_url if node == admin_picked else mirrored.get(node_exporter_url, node_exporter_url), prometheus_url=prometheus_url, grafana_image=grafana_image, force_reinstall=force_reinstall, checksums=checksums, download_streams=download_streams, grafana_name=grafana_name, grafana_port=grafana_port, silent=silent, retries=retries) for node in connectionwrappers.keys()}
+    results = run_plans(plans, deploy_module, connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer, on_result=_report)
+    _stop_mirror(admin_picked, mirror_pid, deploy_module, connectionwrappers, window=window, step_timeout=step_timeout, node_timeout=node_timeout, tracer=tracer)
+    if partial:
+        return _deploy_partial(results, admin_picked, install_dir, connectionwrappers, local_connections, deploy_module, prometheus_port=prometheus_port, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer, silent=silent)
+    state_ok = all(succeeded(x) for x in results.values())
+
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+    if local_connections:
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
+    if not state_ok:
+        return False, None
+    prints('Prometheus+Grafana deployed on all nodes.')
+    return True, admin_picked.node_id
+
+
+def _deploy_partial(results, admin_picked, install_dir, connectionwrappers, local_connections, deploy_module, prometheus_port=start_defaults.prometheus_port(), grafana_name=start_defaults.grafana_name(), grafana_port=start_defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), max_parallel=None, window=False, step_timeout=None, node_timeout=None, retry_failed=0, tracer=None, silent=False):
+    '''Starts Prometheus admin and Grafana after deploying all other nodes we could reach. The Prometheus admin only scrapes nodes that deployed successfully.
+    Returns:
+        `(True, admin_node_id, node_results)` if the Prometheus admin and Grafana started, `(False, None, node_results)` otherwise.
+        `node_results` maps every node to whether it deployed successfully.'''
+    admin_ok = False
+    configstring = _prometheus_config((node for node, x in results.items() if succeeded(x)), port=prometheus_port)
+    if succeeded(results[admin_picked]) and configstring:
+        admin_results = run_plans({admin_picked: _start_admin_plan(install_dir, configstring, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, silent=silent)}, deploy_module, connectionwrappers, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)[admin_picked]
+        admin_ok = succeeded(admin_results)
+        results[admin_picked] = None if admin_results == None else results[admin_picked] + admin_results
+        if succeeded(admin_results, step='start_grafana'):
+            _print_grafana_started(admin_picked, port=grafana_port)
+
+    summary = node_results(results, 'deploy Prometheus')
+    prints('Prometheus+Grafana deployed on {}/{} nodes.'.format(sum(summary.values()), len(summary)))
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+    if local_connections:
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
+    return admin_ok, admin_picked.node_id if admin_ok else None, summary
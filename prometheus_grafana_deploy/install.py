@@ -1,54 +1,76 @@
-import concurrent.futures
-import hashlib
-import subprocess
-import tempfile
-
+import prometheus_grafana_deploy.internal.defaults.deadline as deadline_defaults
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
 import prometheus_grafana_deploy.internal.defaults.install as defaults
-from prometheus_grafana_deploy.internal.remoto.modulegenerator import ModuleGenerator
-from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers
-import prometheus_grafana_deploy.internal.util.fs as fs
-import prometheus_grafana_deploy.internal.util.importer as importer
+import prometheus_grafana_deploy.internal.defaults.mirror as mirror_defaults
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+from prometheus_grafana_deploy.internal.remoto.fanout import run_plans, node_results
+from prometheus_grafana_deploy.internal.remoto.plan import Plan, succeeded
+from prometheus_grafana_deploy.internal.remoto.push import push_files
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers, module_cache_stats
+import prometheus_grafana_deploy.internal.util.artifacts as artifacts
 import prometheus_grafana_deploy.internal.util.location as loc
 from prometheus_grafana_deploy.internal.util.printer import *
+from prometheus_grafana_deploy.internal.util.trace import span
 
 
-def _install_prometheus_node_exporter(connection, module, install_dir, node_exporter_url=defaults.node_exporter_url(), force_reinstall=False, silent=False, retries=defaults.retries()):
-    remote_module = connection.import_module(module)
-    if not remote_module.install_prometheus_node_exporter(loc.prometheus_exporterdir(install_dir), node_exporter_url, force_reinstall, silent, retries):
-        printe('Could not install prometheus node exporter.')
-        return False
-    return True
+def _install_plan(install_dir, is_admin, node_exporter_url=defaults.node_exporter_url(), prometheus_url=defaults.prometheus_url(), grafana_image=defaults.grafana_image(), force_reinstall=False, checksums=None, download_streams=defaults.download_streams(), silent=False, retries=defaults.retries()):
+    '''Builds the install plan for one node. Every node gets a node exporter. The admin node also gets Prometheus admin and Grafana.
+    If `checksums` is set, nodes verify downloaded archives against the sha256 digests in it (see `_fetch_artifacts`).'''
+    checksums = checksums or dict()
+    plan = Plan(stop_on_failure=False).add('install_prometheus_node_exporter', loc.prometheus_exporterdir(install_dir), node_exporter_url, force_reinstall, silent, retries, checksums.get(node_exporter_url), download_streams, description='install prometheus node exporter')
+    if is_admin:
+        plan.add('install_prometheus_admin', loc.prometheus_admindir(install_dir), prometheus_url, force_reinstall, silent, retries, checksums.get(prometheus_url), download_streams, description='install Prometheus admin')
+        plan.add('install_grafana', grafana_image, force_reinstall, silent, description='install Grafana')
+    return plan
 
 
-def _install_prometheus_admin(connection, module, install_dir, prometheus_url=defaults.prometheus_url(), force_reinstall=False, silent=False, retries=defaults.retries()):
-    remote_module = connection.import_module(module)
-    if not remote_module.install_prometheus_admin(loc.prometheus_admindir(install_dir), prometheus_url, force_reinstall, silent, retries):
-        printe('Could not install Prometheus admin on some node(s).')
-        return False
-    return True
+def _fetch_artifacts(urls, silent=False, retries=defaults.retries()):
+    '''Fetches given release archives once into the local artifact cache, and verifies them against their published checksums.
+    Returns:
+        `dict(str, str)`, mapping urls to their sha256 digest. Urls we could not fetch are left out. Nodes download those without verification.'''
+    checksums = dict()
+    for url in urls:
+        _, digest = artifacts.fetch(url, retries=retries, silent=silent)
+        if digest:
+            checksums[url] = digest
+        else:
+            printw('Nodes download {} without checksum verification.'.format(url))
+    return checksums
 
 
-def _install_grafana(connection, module, image=defaults.grafana_image(), force_reinstall=False, silent=False):
-    remote_module = connection.import_module(module)
-    if not remote_module.install_grafana(image, force_reinstall, silent):
-        printe('Could not install Grafana.')
-        return False
-    return True
+def _push_artifacts(admin_picked, node_exporter_url, prometheus_url, checksums, module, connectionwrappers, **kwargs):
+    '''Pushes release archives from the local artifact cache to the archive cache of every node. Every node gets the node exporter archive, the admin node also gets the Prometheus archive.
+    Archives missing in `checksums` could not be fetched locally, and are not pushed. Nodes that do not receive an archive download it themselves. Extra kwargs are passed to `push_files`.'''
+    def _files(node):
+        urls = [node_exporter_url, prometheus_url] if node == admin_picked else [node_exporter_url]
+        return [(artifacts.cached(x), checksums[x]) for x in urls if x in checksums]
+    push_files({node: _files(node) for node in connectionwrappers.keys()}, module, connectionwrappers, **kwargs)
 
 
-def _generate_module_install(silent=False):
-    '''Generates Prometheus-install module from available sources.'''
-    generation_loc = fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'generated', 'all_install.py')
-    files = [
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'util', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'util.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'prometheus_install.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'grafana_install.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'remoto_base.py'),
-    ]
-    ModuleGenerator().with_modules(fs).with_files(*files).generate(generation_loc, silent)
-    return importer.import_full_path(generation_loc)
+def _start_mirror(admin_picked, urls, checksums, module, connectionwrappers, port=mirror_defaults.port(), max_clients=mirror_defaults.max_clients(), download_streams=defaults.download_streams(), silent=False, retries=defaults.retries(), **kwargs):
+    '''Fetches release archives once onto the admin node, and serves them to the other nodes over the cluster network with a short-lived HTTP server.
+    Adds the checksums of mirrored urls to `checksums`, if set. Extra kwargs are passed to `run_plans`.
+    Returns:
+        `(mirrored, pid)`. `mirrored` is a `dict(str, str)`, mapping urls to their url on the mirror. `pid` is the process id of the mirror server. `(dict(), None)` if the mirror could not be started.'''
+    plan = Plan(stop_on_failure=True)
+    for url in urls:
+        plan.add('fetch_archive', url, url.split('/')[-1], silent, retries, (checksums or dict()).get(url), download_streams, description='fetch {} for mirror'.format(url.split('/')[-1]))
+    plan.add('start_mirror', port, max_clients, mirror_defaults.lifetime(), silent, description='start mirror')
+    results = run_plans({admin_picked: plan}, module, connectionwrappers, **kwargs)[admin_picked]
+    if not succeeded(results):
+        printw('Could not start mirror on admin node {}. Nodes download from the original urls instead.'.format(admin_picked))
+        return dict(), None
+    mirrored = {url: 'http://{}:{}/{}'.format(admin_picked.ip_local, port, url.split('/')[-1]) for url in urls}
+    if checksums != None:
+        checksums.update({y: checksums[x] for x, y in mirrored.items() if x in checksums})
+    prints('Mirror started on admin node {}, port {}.'.format(admin_picked, port))
+    return mirrored, results[-1]['result']
+
+
+def _stop_mirror(admin_picked, pid, module, connectionwrappers, **kwargs):
+    '''Stops a mirror started by `_start_mirror`. Extra kwargs are passed to `run_plans`.'''
+    if pid:
+        run_plans({admin_picked: Plan().add('stop_mirror', pid, description='stop mirror')}, module, connectionwrappers, **kwargs)
 
 
 def _pick_admin(reservation, admin=None):
@@ -75,7 +97,7 @@ def _merge_kwargs(x, y):
     return z
 
 
-def install(reservation, install_dir=defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, node_exporter_url=defaults.node_exporter_url(), prometheus_url=defaults.prometheus_url(), grafana_image=defaults.grafana_image(), force_reinstall=False, silent=False, retries=defaults.retries()):
+def install(reservation, install_dir=defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, node_exporter_url=defaults.node_exporter_url(), prometheus_url=defaults.prometheus_url(), grafana_image=defaults.grafana_image(), force_reinstall=False, verify=True, push=False, mirror=False, mirror_port=mirror_defaults.port(), mirror_clients=mirror_defaults.max_clients(), download_streams=defaults.download_streams(), pool=None, max_parallel=fanout_defaults.max_parallel(), handshake_rate=fanout_defaults.handshake_rate(), window=False, relay=False, step_timeout=deadline_defaults.step_timeout(), node_timeout=deadline_defaults.node_timeout(), retry_failed=0, partial=False, tracer=None, silent=False, retries=defaults.retries()):
     '''Installs Prometheus on remote cluster.
     Args:
         reservation (`metareserve.Reservation`): Reservation object with all nodes to install Prometheus on.
@@ -83,43 +105,81 @@ def install(reservation, install_dir=defaults.install_dir(), key_path=None, admi
         key_path (optional str): Path to SSH key, which we use to connect to nodes. If `None`, we do not authenticate using an IdentityFile.
         admin_id (optional int): Node id that must become the admin. If `None`, the node with lowest public ip value (string comparison) will be picked.
         connectionwrappers (optional dict(metareserve.Node, RemotoSSHWrapper)): If set, uses given connections, instead of building new ones.
+        pool (optional str): If set, connects through the persistent connection pool, keeping connections alive for given time (e.g. "30m") for reuse by later invocations.
+        max_parallel (optional int): Maximum number of nodes to connect to and work on at once. If `None`, works on all nodes at once.
+        handshake_rate (optional float): If set, starts at most this many new ssh connections per second.
+        window (optional bool): If set, every connection is opened right before working on its node, and closed right after. This way, at most `max_parallel` connections are open at once. Ignored when passing `connectionwrappers`.
+        relay (optional bool): If set, only connects to the admin node directly, and reaches all other nodes from there, over their local ip. The admin node must be able to ssh to all other nodes using its own ssh keys.
+        step_timeout (optional float): Maximum number of seconds one step (e.g. installing Grafana) may take on a node. If `None` or 0, steps may take forever.
+        node_timeout (optional float): Maximum number of seconds all steps together may take on a node. Nodes that do not finish in time are cancelled and reported. If `None` or 0, nodes may take forever.
+        retry_failed (optional int): Number of times to retry nodes that failed, reusing their connections.
+        partial (optional bool): If set, continues on nodes we can reach when other nodes fail.
+        tracer (optional Tracer): If set, records how long every phase takes on every node. See `internal/util/trace.py`.
         node_exporter_url (optional str): Download URL for Prometheus node exporter.
         prometheus_url (optional str): Download URL for Prometheus.
         grafana_image (optonal str): Grafana image to download.
-        force_reinstall (optional bool): If set, we always will re-download and install. Otherwise, we will skip installing if we already find an installation.
+        force_reinstall (optional bool): If set, we always will reinstall, from archives cached on the nodes if available. Otherwise, we will skip installing if we already find an installation.
+        verify (optional bool): If set, fetches release archives once into the local artifact cache, verifies them against their published checksums, and makes nodes verify their downloads against the same checksums.
+        push (optional bool): If set, streams release archives from the local artifact cache to the nodes, over the connections we already have. Nodes then do not need internet access. Implies `verify`.
+        mirror (optional bool): If set, only the admin node fetches release archives (or receives them, with `push`). It serves them to all other nodes over their local ip, using a short-lived HTTP server.
+        mirror_port (optional int): Port for the mirror HTTP server.
+        mirror_clients (optional int): Maximum number of nodes downloading from the mirror at once.
+        download_streams (optional int): If higher than 1, nodes download large release archives with this many parallel range requests, if the server supports them.
         silent (optional bool): If set, does not print so much info.
         retries (optional int): Number of retries before we error.
 
     Returns:
-        `True, admin_node_id` on success, `False, None` otherwise.'''
+        `True, admin_node_id` on success, `False, None` otherwise.
+        With `partial` set, returns `True, admin_node_id, node_results` when the admin node succeeded, `False, None, node_results` otherwise.
+        `node_results` is a `dict(metareserve.Node, bool)`, mapping every node to whether it installed successfully.'''
     admin_picked, _ = _pick_admin(reservation, admin=admin_id)
     printc('Picked admin node: {}'.format(admin_picked), Color.CAN)
     
     local_connections = connectionwrappers == None
+    window = window and local_connections # We only close connections we opened ourselves.
     if local_connections:
         ssh_kwargs = {'IdentitiesOnly': 'yes', 'User': admin_picked.extra_info['user'], 'StrictHostKeyChecking': 'no'}
         if key_path:
             ssh_kwargs['IdentityFile'] = key_path
         else:
             printw('Connections have no assigned ssh key. Prepare to fill in your password often.')
-        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, silent=silent)
-    if not all(x.open for x in connectionwrappers.values()):
+        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, pool=pool, max_parallel=max_parallel, handshake_rate=handshake_rate, lazy=window, relay=admin_picked if relay else None, relay_hostnames=lambda node: node.ip_local, tracer=tracer, silent=silent)
+    if not partial and not window and not all(x.open for x in connectionwrappers.values()):
         if local_connections:
-            close_wrappers(connectionwrappers)
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
         printe('Failed to create at least one connection.')
         return False, None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(reservation)+2) as executor:
-        install_module = _generate_module_install()
-        futures_install = [executor.submit(_install_prometheus_node_exporter, wrapper.connection, install_module, install_dir, node_exporter_url=defaults.node_exporter_url(), force_reinstall=force_reinstall, silent=silent, retries=retries) for wrapper in connectionwrappers.values()]
-
-        futures_install.append(executor.submit(_install_prometheus_admin, connectionwrappers[admin_picked].connection, install_module, install_dir, prometheus_url=defaults.prometheus_url(), force_reinstall=force_reinstall, silent=silent, retries=retries))
-        futures_install.append(executor.submit(_install_grafana, connectionwrappers[admin_picked].connection, install_module, image=grafana_image, force_reinstall=force_reinstall, silent=silent))
-        if not all(x.result() for x in futures_install):
-            if local_connections:
-                close_wrappers(connectionwrappers)
-            return False, None
+    with span(tracer, 'generate module'):
+        install_module = generate_module_lifecycle(silent=silent)
+    with span(tracer, 'fetch artifacts'):
+        checksums = _fetch_artifacts([node_exporter_url, prometheus_url], silent=silent, retries=retries) if verify or push else None
+    if push:
+        with span(tracer, 'push artifacts'):
+            _push_artifacts(admin_picked, node_exporter_url, prometheus_url, checksums, install_module, {admin_picked: connectionwrappers[admin_picked]} if mirror else connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer, silent=silent)
+    mirrored, mirror_pid = dict(), None
+    if mirror:
+        with span(tracer, 'start mirror'):
+            mirrored, mirror_pid = _start_mirror(admin_picked, [node_exporter_url], checksums, install_module, connectionwrappers, port=mirror_port, max_clients=mirror_clients, download_streams=download_streams, silent=silent, retries=retries, window=window, step_timeout=step_timeout, node_timeout=node_timeout, tracer=tracer)
+    plans = {node: _install_plan(install_dir, node == admin_picked, node_exporter_url=node_exporter_url if node == admin_picked else mirrored.get(node_exporter_url, node_exporter_url), prometheus_url=prometheus_url, grafana_image=grafana_image, force_reinstall=force_reinstall, checksums=checksums, download_streams=download_streams, silent=silent, retries=retries) for node in connectionwrappers.keys()}
+    results = run_plans(plans, install_module, connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)
+    _stop_mirror(admin_picked, mirror_pid, install_module, connectionwrappers, window=window, step_timeout=step_timeout, node_timeout=node_timeout, tracer=tracer)
+    if partial:
+        summary = node_results(results, 'install Prometheus')
+        admin_ok = succeeded(results[admin_picked])
+        prints('Prometheus+Grafana installed on {}/{} nodes.'.format(sum(summary.values()), len(summary)))
+        if not silent:
+            print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+        if local_connections:
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return admin_ok, admin_picked.node_id if admin_ok else None, summary
+    if not all(succeeded(x) for x in results.values()):
+        if local_connections:
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return False, None
     prints('Prometheus+Grafana installed on all nodes.')
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
     if local_connections:
-        close_wrappers(connectionwrappers)
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
     return True, admin_picked.node_id
\ No newline at end of file
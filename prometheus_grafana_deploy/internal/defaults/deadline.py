@@ -0,0 +1,5 @@
+def step_timeout():
+    return 900
+
+def node_timeout():
+    return 1800
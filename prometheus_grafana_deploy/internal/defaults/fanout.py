@@ -0,0 +1,5 @@
+def max_parallel():
+    return 64
+
+def handshake_rate():
+    return None
@@ -11,4 +11,7 @@ def grafana_image():
     return 'grafana/grafana'
 
 def retries():
-    return 5
\ No newline at end of file
+    return 5
+
+def download_streams():
+    return 1
\ No newline at end of file
@@ -0,0 +1,8 @@
+def port():
+    return 9191
+
+def max_clients():
+    return 64
+
+def lifetime():
+    return 3600
\ No newline at end of file
@@ -0,0 +1,2 @@
+def persist():
+    return '30m'
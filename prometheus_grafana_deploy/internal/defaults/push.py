@@ -0,0 +1,5 @@
+def chunk_size():
+    return 1024*1024
+
+def in_flight():
+    return 4
\ No newline at end of file
@@ -0,0 +1,36 @@
+import prometheus_grafana_deploy.internal.util.fs as fs
+from prometheus_grafana_deploy.internal.remoto.modulegenerator import ModuleGenerator
+
+
+'''The lifecycle bundle: One generated module with the remote functions of all lifecycle commands (install, start, stop, uninstall).
+Connection wrappers send it once per connection, after which every lifecycle command in that session reuses it.'''
+
+
+def _modules_dir():
+    return fs.join(fs.dirname(fs.abspath(__file__)), 'modules')
+
+
+def entrypoints():
+    '''Remote functions called by lifecycle commands. The bundle contains these, and only the functions, classes and imports they need.'''
+    return [
+        'install_prometheus_node_exporter', 'install_prometheus_admin', 'install_grafana',
+        'start_prometheus_node_exporter', 'start_prometheus_admin', 'start_grafana',
+        'stop_prometheus_node_exporter', 'stop_prometheus_admin', 'stop_grafana',
+        'uninstall_prometheus_node_exporter', 'uninstall_prometheus_admin', 'uninstall_grafana',
+        'archive_cached', 'receive_archive_start', 'receive_archive_chunk', 'receive_archive_finish',
+        'fetch_archive', 'start_mirror', 'stop_mirror',
+        'run_plan',
+    ]
+
+
+def generate_module_lifecycle(silent=False):
+    '''Generates the lifecycle bundle module from available sources.
+    All files in `internal/remoto/modules` are candidates. The remote printer comes after the regular printer, so its `print` overrides the regular one.
+    Args:
+        silent (optional bool): If set, skips printing warnings when non-standard imports are encountered.
+
+    Returns:
+        Imported bundle module.'''
+    files = [fs.join(fs.dirname(fs.dirname(fs.abspath(__file__))), 'util', 'printer.py')]
+    files += sorted(x for x in fs.ls(_modules_dir(), only_files=True, full_paths=True) if x.endswith('.py') and fs.basename(x) != '__init__.py')
+    return ModuleGenerator().with_modules(fs).with_files(*files).with_entrypoints(*entrypoints()).load('all_lifecycle', silent=silent)
@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import queue
+import time
+
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Orchestration core: One thread drives plans on all nodes, instead of parking one thread per node on a blocking remote call.
+Plans are sent without waiting for them to finish. Remote hosts report back through execnet channel callbacks, which post events to one queue.
+The event loop handles these events in the calling thread, and cancels nodes that miss their deadline.'''
+
+
+class _Task(object):
+    '''State of one plan executing on one node.'''
+    def __init__(self, node, plan, wrapper):
+        self.node = node
+        self.plan = plan
+        self.wrapper = wrapper
+        self.timeout = None
+        self.submitted = None
+        self.done = False
+
+
+class EventLoop(object):
+    '''Executes plans on many nodes from one thread, working on at most `max_parallel` nodes at once.
+    Opening and closing ssh connections blocks in execnet, so `window` mode and cancelling nodes use a small pool of at most `max_parallel` helper threads.
+    Waiting for remote hosts never occupies a thread.'''
+    def __init__(self, module, wrappers, max_parallel=None, window=False, step_timeout=None, node_timeout=None, on_result=None, tracer=None):
+        '''Args:
+            module (module): Lifecycle bundle module.
+            wrappers (dict(metareserve.Node, RemotoSSHWrapper)): Connection to execute plans on, per node.
+            max_parallel (optional int): Maximum number of nodes to work on at once. If `None`, works on all nodes at once.
+            window (optional bool): If set, every connection is opened right before executing its plan, and disconnected right after.
+                                    This way, at most `max_parallel` connections are open at once. Requires lazy wrappers, see `get_wrappers(lazy=True)`.
+            step_timeout (optional float): If set, maximum number of seconds one plan step may take.
+            node_timeout (optional float): If set, maximum number of seconds a plan may take on one node. Nodes that do not finish in time are cancelled, and their steps fail.
+            on_result (optional callable): If set, called as `on_result(node, results)` for every node as soon as its plan finishes. Called from the event loop thread.
+            tracer (optional Tracer): If set, records spans of every plan, and of the steps and phases executed remotely.'''
+        self._module = module
+        self._wrappers = wrappers
+        self._max_parallel = max_parallel
+        self._window = window
+        self._step_timeout = step_timeout
+        self._node_timeout = node_timeout
+        self._on_result = on_result
+        self._tracer = tracer
+        self._events = queue.Queue()
+        self._deadlines = [] # Heap of (deadline, sequence number, task).
+        self._sequence = itertools.count()
+        self._helpers = None
+        self._results = dict()
+        self._reconnect = False
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+    def _post(self, task, kind, value=None):
+        self._events.put((task, kind, value))
+
+
+    def _blocking(self, task, kind, function):
+        '''Runs a blocking connection function on a helper thread, and posts an event of given kind when it finishes.'''
+        if not self._helpers:
+            self._helpers = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_parallel or None)
+        self._helpers.submit(function).add_done_callback(lambda future: self._post(task, kind, future.exception()))
+
+
+    def _start(self, task):
+        if self._window or (self._reconnect and not task.wrapper.open):
+            self._blocking(task, 'connected', task.wrapper.connect)
+        else:
+            self._connected(task, None)
+
+
+    def _connected(self, task, error):
+        if error or not task.wrapper.open:
+            printe('Could not connect to node {}.{}'.format(task.node, ' {}'.format(error) if error else ''))
+            return self._finish(task, None)
+        task.submitted = time.monotonic()
+        task.timeout = task.plan.submit(task.wrapper, self._module, lambda results: self._post(task, 'results', results), step_timeout=self._step_timeout, node_timeout=self._node_timeout)
+        if task.timeout:
+            heapq.heappush(self._deadlines, (time.monotonic()+task.timeout, next(self._sequence), task))
+
+
+    def _finish(self, task, results, cancel=False):
+        '''Stores the results of a task. The task keeps its slot until its connection is closed, when closing is needed.'''
+        task.done = True
+        self._results[task.node] = results
+        if self._on_result:
+            self._on_result(task.node, results)
+        if (self._window or cancel) and task.wrapper.open:
+            self._blocking(task, 'closed', task.wrapper.disconnect)
+        else:
+            self._post(task, 'closed')
+
+
+    def _expire(self):
+        '''Cancels all tasks that passed their deadline.
+        Returns:
+            Number of seconds until the next deadline, or `None` if there is no deadline.'''
+        while self._deadlines:
+            deadline, _, task = self._deadlines[0]
+            remaining = deadline - time.monotonic()
+            if task.done:
+                heapq.heappop(self._deadlines)
+            elif remaining <= 0:
+                heapq.heappop(self._deadlines)
+                if self._tracer:
+                    self._tracer.add('plan (timed out)', task.submitted, time.monotonic(), node=task.node)
+                self._finish(task, task.plan.timed_out(task.node, task.timeout), cancel=True)
+            else:
+                return remaining
+        return None
+
+
+    def run(self, plans, reconnect=False):
+        '''Executes a plan on every node, and waits until all plans finished.
+        Args:
+            plans (dict(metareserve.Node, Plan)): Plan to execute, per node.
+            reconnect (optional bool): If set, connects again to nodes whose connection was closed, e.g. because we cancelled them before. See `RemotoSSHWrapper.reconnectable`.
+
+        Returns:
+            `dict(metareserve.Node, list(dict))`, mapping every node to its plan results. Nodes we could not connect to map to `None`.'''
+        self._results = dict()
+        self._reconnect = reconnect
+        waiting = collections.deque(_Task(node, plan, self._wrappers[node]) for node, plan in plans.items())
+        active = 0
+        while waiting or active:
+            while waiting and (not self._max_parallel or active < self._max_parallel):
+                active += 1
+                self._start(waiting.popleft())
+            try:
+                task, kind, value = self._events.get(timeout=self._expire())
+            except queue.Empty:
+                continue
+            if kind == 'connected':
+                self._connected(task, value)
+            elif kind == 'results' and not task.done: # Late results of cancelled tasks are ignored.
+                task.plan.report(value, task.node)
+                if self._tracer:
+                    task.plan.trace(self._tracer, task.node, value, task.submitted, time.monotonic())
+                self._finish(task, value)
+            elif kind == 'closed':
+                active -= 1
+        return self._results
+
+
+    def close(self):
+        '''Stops helper threads.'''
+        if self._helpers:
+            self._helpers.shutdown(wait=True)
+            self._helpers = None
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from prometheus_grafana_deploy.internal.remoto.eventloop import EventLoop
+from prometheus_grafana_deploy.internal.remoto.plan import succeeded
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Bounded fan-out over nodes: Limits the number of nodes we work on at once, and the rate at which we start new ssh handshakes.'''
+
+
+def workers(amount, max_parallel=None):
+    '''Returns the number of worker threads to use for `amount` tasks, limited to `max_parallel` (if set).'''
+    return max(1, min(amount, max_parallel) if max_parallel else amount)
+
+
+class RateLimiter(object):
+    '''Spaces out events, allowing at most `rate` events per second. With a `rate` of `None` or 0, events are not limited.'''
+    def __init__(self, rate=None):
+        self._interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        '''Blocks until the next event may start.'''
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        time.sleep(slot - now)
+
+
+def run_plans(plans, module, wrappers, max_parallel=None, window=False, step_timeout=None, node_timeout=None, retry_failed=0, on_result=None, tracer=None):
+    '''Executes a plan on every node, working on at most `max_parallel` nodes at once. All nodes are driven by one `EventLoop`, in the calling thread.
+    Args:
+        plans (dict(metareserve.Node, Plan)): Plan to execute, per node.
+        module (module): Lifecycle bundle module.
+        wrappers (dict(metareserve.Node, RemotoSSHWrapper)): Connection to execute plans on, per node.
+        max_parallel (optional int): Maximum number of nodes to work on at once. If `None`, works on all nodes at once.
+        window (optional bool): If set, every connection is opened right before executing its plan, and disconnected right after.
+                                This way, at most `max_parallel` connections are open at once. Requires lazy wrappers, see `get_wrappers(lazy=True)`.
+        step_timeout (optional float): If set, maximum number of seconds one plan step may take.
+        node_timeout (optional float): If set, maximum number of seconds a plan may take on one node. Nodes that do not finish in time are cancelled, and their steps fail.
+        retry_failed (optional int): Number of times to execute plans again on nodes where they failed. Closed connections (e.g. of cancelled nodes) are opened again, if their wrapper is `reconnectable`. Other nodes with closed connections are reported, and not retried.
+        on_result (optional callable): If set, called as `on_result(node, results)` for every node as soon as its plan finishes, also when retrying. Called from the calling thread.
+        tracer (optional Tracer): If set, records spans of every plan, and of the steps and phases executed remotely.
+
+    Returns:
+        `dict(metareserve.Node, list(dict))`, mapping every node to its plan results. Nodes we could not connect to map to `None`.'''
+    results = dict()
+    todo = plans
+    with EventLoop(module, wrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, on_result=on_result, tracer=tracer) as loop:
+        for attempt in range(retry_failed+1):
+            if attempt > 0:
+                failed = [node for node, x in results.items() if not succeeded(x)]
+                todo = {node: plans[node] for node in failed if window or wrappers[node].open or wrappers[node].reconnectable}
+                if len(todo) < len(failed):
+                    printw('Not retrying {} failed node(s) without a connection to reopen: {}'.format(len(failed)-len(todo), ', '.join(str(x) for x in failed if not x in todo)))
+                if not todo:
+                    break
+                printw('Retrying on {} failed node(s) (attempt {}/{}).'.format(len(todo), attempt, retry_failed))
+            results.update(loop.run(todo, reconnect=attempt > 0))
+    return results
+
+
+def node_results(results, action):
+    '''Summarizes plan results per node, and reports nodes on which plans failed.
+    Args:
+        results (dict(metareserve.Node, list(dict))): Plan results per node, as returned by `run_plans`.
+        action (str): Action description used when reporting failures, e.g. "install Prometheus".
+
+    Returns:
+        `dict(metareserve.Node, bool)`, mapping every node to whether its plan succeeded.'''
+    summary = {node: succeeded(x) for node, x in results.items()}
+    failed = [node for node, ok in summary.items() if not ok]
+    if any(failed):
+        printw('Could not {} on {}/{} nodes:\n{}'.format(action, len(failed), len(summary), '\n'.join('    {}'.format(x) for x in failed)))
+    return summary
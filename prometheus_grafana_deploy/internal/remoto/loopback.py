@@ -0,0 +1,210 @@
+import os
+import sys
+import tarfile
+
+import execnet
+
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import _make_wrappers
+import prometheus_grafana_deploy.internal.util.fs as fs
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Loopback transport: Backs every node with a local Python process instead of an ssh connection, to run lifecycle commands without remote hosts.
+Every loopback node gets its own system root directory. Remote modules place system files (e.g. "/usr/bin/prometheus") below it, see `sysroot()` in `internal/remoto/modules/util.py`.
+The `sudo`, `systemctl` and `docker` commands are replaced by shims, which only record state in the system root of the node calling them.'''
+
+_sysroot_var = 'PROMETHEUS_GRAFANA_DEPLOY_SYSROOT' # Must match the variable read in `internal/remoto/modules/util.py`.
+_join_timeout = 5 # Seconds to wait for a loopback process to exit.
+
+_shim_sudo = '''
+import os
+import sys
+
+os.execvp(sys.argv[1], sys.argv[1:]) # Runs the command as the calling user.
+'''
+
+_shim_systemctl = '''
+import os
+import sys
+
+root = os.environ.get('{var}', '')
+args = [x for x in sys.argv[1:] if not x.startswith('-')]
+command, units = args[0], args[1:]
+if command == 'daemon-reload':
+    sys.exit(0)
+for unit in units:
+    name = unit if unit.endswith('.service') else unit+'.service'
+    if not os.path.isfile(root+'/etc/systemd/system/'+name):
+        print('Failed to {{}} {{}}: Unit {{}} not found.'.format(command, unit, name), file=sys.stderr)
+        sys.exit(5)
+    os.makedirs(root+'/run/systemd', exist_ok=True)
+    active, enabled = root+'/run/systemd/'+name+'.active', root+'/run/systemd/'+name+'.enabled'
+    if command in ('start', 'restart'):
+        open(active, 'w').close()
+    elif command == 'stop' and os.path.isfile(active):
+        os.remove(active)
+    elif command == 'enable':
+        open(enabled, 'w').close()
+    elif command == 'disable' and os.path.isfile(enabled):
+        os.remove(enabled)
+    elif command == 'is-active' and not os.path.isfile(active):
+        sys.exit(3)
+'''
+
+_shim_docker = '''
+import os
+import sys
+import urllib.parse
+
+root = os.environ.get('{var}', '')
+images, containers = root+'/var/lib/docker/images', root+'/var/lib/docker/containers'
+os.makedirs(images, exist_ok=True)
+os.makedirs(containers, exist_ok=True)
+
+def option(args, name):
+    return args[args.index(name)+1] if name in args else None
+
+def state(name):
+    path = os.path.join(containers, name)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def set_state(name, value):
+    with open(os.path.join(containers, name), 'w') as f:
+        f.write(value)
+
+args = sys.argv[1:]
+if args[0] == 'container':
+    args = args[1:]
+command = ' '.join(args[:2]) if args[0] == 'image' else args[0]
+if command == 'ps':
+    pattern = (option(args, '-f') or 'name=').split('=', 1)[1]
+    for name in sorted(os.listdir(containers)):
+        if pattern in name and ('-a' in args or state(name) == 'running'):
+            print(name)
+elif command in ('image inspect', 'image rm'):
+    path = os.path.join(images, urllib.parse.quote(args[2], safe=''))
+    if not os.path.isfile(path):
+        print('Error: No such image: {{}}'.format(args[2]), file=sys.stderr)
+        sys.exit(1)
+    if command == 'image rm':
+        os.remove(path)
+elif command in ('image pull', 'pull'):
+    open(os.path.join(images, urllib.parse.quote(args[-1], safe='')), 'w').close()
+elif command == 'run':
+    name = option(args, '--name')
+    if state(name):
+        print('Error: Conflict. The container name "{{}}" is already in use.'.format(name), file=sys.stderr)
+        sys.exit(125)
+    open(os.path.join(images, urllib.parse.quote(args[-1], safe='')), 'w').close()
+    set_state(name, 'running')
+elif command in ('start', 'stop', 'rm'):
+    if not state(args[1]):
+        print('Error: No such container: {{}}'.format(args[1]), file=sys.stderr)
+        sys.exit(1)
+    if command == 'rm':
+        os.remove(os.path.join(containers, args[1]))
+    else:
+        set_state(args[1], 'running' if command == 'start' else 'exited')
+else:
+    print('docker shim: unsupported command: {{}}'.format(' '.join(sys.argv[1:])), file=sys.stderr)
+    sys.exit(1)
+'''
+
+
+class LoopbackConnection(object):
+    '''Minimal stand-in for `remoto.Connection`, for local Python processes acting as nodes.'''
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    @property
+    def gateway(self):
+        return self._gateway
+
+    def exit(self):
+        self._gateway.exit()
+        self._gateway.join(timeout=_join_timeout)
+
+
+def node_root(root, node):
+    '''Returns the system root directory of given loopback node.'''
+    return fs.join(root, 'node{}'.format(node.node_id))
+
+
+def _write_shims(root):
+    '''Writes `sudo`, `systemctl` and `docker` shims, shared by all loopback nodes.
+    Returns:
+        Directory containing the shims.'''
+    bindir = fs.join(root, 'bin')
+    fs.mkdir(bindir, exist_ok=True)
+    for name, source in (('sudo', _shim_sudo), ('systemctl', _shim_systemctl), ('docker', _shim_docker)):
+        path = fs.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!{}\n'.format(sys.executable))
+            f.write(source.format(var=_sysroot_var))
+        os.chmod(path, 0o755)
+    return bindir
+
+
+def fake_releases(root):
+    '''Builds Prometheus and node exporter release archives with stand-in binaries, for loopback nodes to install.
+    Args:
+        root (str): Directory to store archives in.
+
+    Returns:
+        `(node_exporter_url, prometheus_url)`, as "file://" urls.'''
+    root = fs.abspath(root)
+    urls = []
+    for name in ('node_exporter', 'prometheus'):
+        archive = fs.join(root, 'releases', '{}-loopback.linux-amd64.tar.gz'.format(name))
+        if not fs.isfile(archive):
+            fs.mkdir(fs.dirname(archive), exist_ok=True)
+            binary = fs.join(root, 'releases', name)
+            with open(binary, 'w') as f:
+                f.write('#!/bin/sh\nexit 0\n')
+            os.chmod(binary, 0o755)
+            with tarfile.open(archive, 'w:gz') as f:
+                f.add(binary, arcname='{}-loopback.linux-amd64/{}'.format(name, name))
+        urls.append('file://{}'.format(archive))
+    return tuple(urls)
+
+
+def get_loopback_wrappers(nodes, root, netns=False, parallel=True, max_parallel=None, lazy=False, silent=False):
+    '''Gets wrappers backed by local Python processes instead of ssh connections. Use these as `connectionwrappers` for lifecycle commands.
+    Warning: The `RemotoSSHWrapper` objects created here must be properly closed.
+    Args:
+        nodes (iterable of metareserve.Node): Nodes to build connection for. Nodes must have distinct ids.
+        root (str): Directory to place system roots of all nodes in. Every node uses subdirectory "node<id>" as its system root, and "node<id>/home" as its home directory.
+        netns (optional bool): If set, runs every node in its own user and network namespace (using `unshare`), so nodes cannot reach the network, nor each other.
+        parallel (optional bool): If set, creates wrappers in parallel. Otherwise, creates sequentially.
+        max_parallel (optional int): If set, creates at most this many wrappers at once.
+        lazy (optional bool): If set, does not start processes yet. Instead, returned wrappers start their process when calling their `connect()`.
+        silent (optional bool): If set, does not print so much info.
+
+    Returns:
+        `dict(metareserve.Node, RemotoSSHWrapper)`, Maps metareserve.Node to open loopback connection wrapper.'''
+    nodes = list(nodes)
+    root = fs.abspath(root)
+    bindir = _write_shims(root)
+    python = 'unshare --user --map-root-user --net {}'.format(sys.executable) if netns else sys.executable
+    group = execnet.Group()
+
+    def connector(node):
+        sysroot = node_root(root, node)
+        for x in ('usr/bin', 'etc/systemd/system', 'home'):
+            fs.mkdir(fs.join(sysroot, x), exist_ok=True)
+        spec = 'popen//python={}//env:{}={}//env:HOME={}//env:XDG_CACHE_HOME={}//env:PATH={}:{}'.format(python, _sysroot_var, sysroot, fs.join(sysroot, 'home'), fs.join(sysroot, 'home', '.cache'), bindir, os.environ.get('PATH', '/usr/bin:/bin'))
+        def connect():
+            try:
+                gateway = group.makegateway(spec)
+            except Exception as e:
+                printe('Could not start loopback node {}: {}'.format(node, e))
+                return None
+            gateway.reconfigure(py2str_as_py3str=False, py3str_as_py2str=False)
+            return LoopbackConnection(gateway)
+        return connect
+    if not silent:
+        print('Starting {} loopback node(s) in {}.'.format(len(nodes), root))
+    return _make_wrappers({x: connector(x) for x in nodes}, parallel=parallel, max_parallel=max_parallel, lazy=lazy)
@@ -1,22 +1,41 @@
-import distutils.sysconfig as sysconfig
-import itertools
-import re
+import ast
+import hashlib
+import json
+import os
 import sys
+import threading
 import types
 
 import prometheus_grafana_deploy.internal.util.fs as fs
+import prometheus_grafana_deploy.internal.util.importer as importer
+import prometheus_grafana_deploy.internal.util.location as loc
 from prometheus_grafana_deploy.internal.util.printer import *
 
 
+generator_version = 3 # Bump when changing the output format, to invalidate previously generated modules.
+
+_stl_libs = None # In-memory copy of the stl index, shared by all generators in this process.
+
+_parsed_files = dict() # Maps (path, mtime, size) to parse results of that file, see `_parse_file()`.
+
+_loaded_modules = dict() # Maps module digests to imported generated modules.
+_loaded_modules_lock = threading.Lock()
+
+
 def _generate_stl_libs():
-    '''Generator for stl-names. Does a breadth-first search on the python installation directory. Adds built-in library names.
+    '''Generator for stl-names. Uses `sys.stdlib_module_names` when the interpreter provides it (Python 3.10+).
+    Otherwise, does a breadth-first search on the python installation directory. Adds built-in library names.
     Returns:
         `set(str)` containing all known standard-library files.'''
-    ret_list = set()
+    found = set(sys.builtin_module_names)
+    if hasattr(sys, 'stdlib_module_names'):
+        found.update(sys.stdlib_module_names)
+        return found
+
+    import distutils.sysconfig as sysconfig
     std_lib = sysconfig.get_python_lib(standard_lib=True)
     std_lib_len = len(std_lib)
 
-    found = set()
     sep = fs.sep()
 
     to_visit = list()
@@ -29,10 +48,115 @@ def _generate_stl_libs():
         found.update(set('.'.join(y[std_lib_len+1:].split(sep))[:-3] for y in files if y[-3:] == '.py' and y[-11:-3] != '__init__'))
         if any(True for x in files if x[-11:] == '__init__.py') and visit_now != std_lib: #If we found '/path/to/python_lib/oof/a/__init__.py', then assume library 'oof.a' exists.
             found.add('.'.join(visit_now[std_lib_len+1:].split(sep)))
-    found.update(set(sys.builtin_module_names))
     return found
 
 
+def _stl_index_path():
+    '''Returns path to the persistent stl index of the running interpreter. Every interpreter path and version gets its own index.'''
+    key = hashlib.sha256('{}\n{}'.format(sys.executable, sys.version).encode('utf-8')).hexdigest()[:16]
+    return fs.join(loc.cachedir(), 'stl_index', '{}.json'.format(key))
+
+
+def _load_stl_libs():
+    '''Loads stl-names from the persistent index in the user cache directory. Builds and stores the index if it does not exist yet.
+    Returns:
+        `set(str)` containing all known standard-library files.'''
+    global _stl_libs
+    if _stl_libs != None:
+        return _stl_libs
+
+    path = _stl_index_path()
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index['executable'] == sys.executable and index['version'] == sys.version:
+            _stl_libs = set(index['names'])
+            return _stl_libs
+    except (OSError, ValueError, KeyError) as e:
+        pass # Index missing, corrupt, or written by another interpreter: rebuild below.
+
+    _stl_libs = _generate_stl_libs()
+    try:
+        fs.write_atomic(path, json.dumps({'executable': sys.executable, 'version': sys.version, 'names': sorted(_stl_libs)}))
+    except OSError as e:
+        printw('Could not store stl index at "{}": {}'.format(path, e))
+    return _stl_libs
+
+
+class _Segment(object):
+    '''A top-level, non-import statement of a parsed file.'''
+    def __init__(self, defines, references, source):
+        self.defines = defines # `frozenset(str)` of top-level names bound by this statement. Empty for statements that only have side effects.
+        self.references = references # `frozenset(str)` of all names this statement reads.
+        self.source = source
+
+
+class _ParsedFile(object):
+    '''Parse results of one input file, see `_parse_file()`.'''
+    def __init__(self, imports, body, segments):
+        self.imports = imports
+        self.body = body
+        self.segments = segments
+
+
+def _bound_names(node):
+    '''Returns names a top-level statement binds in the module namespace.'''
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return frozenset([node.name])
+    if isinstance(node, (ast.Assign, ast.AnnAssign)):
+        targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+        return frozenset(x.id for target in targets for x in ast.walk(target) if isinstance(x, ast.Name))
+    return frozenset()
+
+
+def _parse_file(filepath):
+    '''Parses a Python file once, splitting it into its top-level import statements and all remaining source.
+    Results are memoized per (path, mtime, size), so unchanged files are never parsed twice.
+    Args:
+        filepath (str): Path to Python file to parse.
+
+    Returns:
+        `_ParsedFile`, with members:
+            imports: List of found imports, as tuples `(None, name, asname)` for "import name (as asname)",
+                     and `(module, name, asname)` for "from module import name (as asname)". `asname` is `None` when not given.
+                     Relative imports have a module name starting with dots.
+            body: File source with all top-level import statements removed. Comments and nested imports are kept.
+            segments: List of `_Segment`, one for every top-level statement that is no import and no docstring.'''
+    stat = os.stat(filepath)
+    key = (filepath, stat.st_mtime_ns, stat.st_size)
+    if key in _parsed_files:
+        return _parsed_files[key]
+
+    with open(filepath, 'r') as f:
+        source = f.read()
+    lines = source.split('\n')
+    body_lines = list(lines)
+    imports = []
+    segments = []
+    for node in ast.parse(source, filename=filepath).body:
+        if isinstance(node, ast.Import):
+            imports += [(None, x.name, x.asname) for x in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            imports += [('.'*node.level+(node.module or ''), x.name, x.asname) for x in node.names]
+        else:
+            if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)):
+                start = min([node.lineno] + [x.lineno for x in getattr(node, 'decorator_list', [])])
+                references = frozenset(x.id for x in ast.walk(node) if isinstance(x, ast.Name) and not isinstance(x.ctx, ast.Store))
+                segments.append(_Segment(_bound_names(node), references, '\n'.join(lines[start-1:node.end_lineno])))
+            continue
+        for idx in range(node.lineno-1, node.end_lineno):
+            body_lines[idx] = None
+    _parsed_files[key] = _ParsedFile(imports, '\n'.join(x for x in body_lines if x != None), segments)
+    return _parsed_files[key]
+
+
+def _import_binding(module, name, asname):
+    '''Returns the name an import statement binds in the module namespace.'''
+    if asname:
+        return asname
+    return name if module else name.split('.', 1)[0]
+
+
 class ModuleGenerator(object):
     '''Object to quickly construct self-contained modules, for use with remoto.
     Warning: We have several constraints for the input modules/files:
@@ -42,7 +166,7 @@ class ModuleGenerator(object):
         4. All uses of user-provided modules/files must be as if the user-provided modules.'''
     def __init__(self):
         self._files = []
-        self._stl_modules_cache = []
+        self._entrypoints = None
 
     def with_module(self, module):
         if not isinstance(module, types.ModuleType):
@@ -68,57 +192,115 @@ class ModuleGenerator(object):
             self.with_file(x)
         return self
 
+    def with_entrypoints(self, *names):
+        '''Restricts the generated module to given top-level names, and everything they (transitively) reference.
+        Unreachable functions, classes, assignments and imports are left out. Statements that bind no name (e.g. "if __name__ == ...") are always kept.
+        Note: References are resolved statically. Names only looked up dynamically (e.g. through `globals()`) must be entrypoints themselves.
+        Warning: When a name is defined multiple times, only the last definition is kept, as the last one is the one found at call time.'''
+        self._entrypoints = list(self._entrypoints or []) + list(names)
+        return self
+
     def _is_regular_python(self, name):
-        if not self._stl_modules_cache:
-            self._stl_modules_cache = list(_generate_stl_libs())
-        return name in self._stl_modules_cache
+        stl_libs = _load_stl_libs()
+        return name in stl_libs or name.split('.', 1)[0] in stl_libs
+
 
+    def _select(self):
+        '''Resolves the top-level statements to put in the generated module.
+        Returns:
+            `(dict, set)`: The dict maps every input file to the list of `_Segment` to keep. The set contains all names referenced by kept segments.
+                           Without entrypoints, all segments are kept, and the set is `None`.'''
+        parsed = {x: _parse_file(x) for x in self._files}
+        if self._entrypoints == None:
+            return {x: p.segments for x, p in parsed.items()}, None
 
-    def _read_imports(self, allowed_imports=None, silent=False):
+        definitions = dict() # Maps names to the segment defining it last.
+        for p in parsed.values():
+            for segment in p.segments:
+                for name in segment.defines:
+                    definitions[name] = segment
+        missing = [x for x in self._entrypoints if not x in definitions]
+        if any(missing):
+            raise ValueError('Entrypoints not defined in any input file: {}'.format(', '.join(missing)))
+
+        kept = set(id(x) for p in parsed.values() for x in p.segments if not x.defines) # Statements without names are kept for their side effects.
+        todo = list(self._entrypoints) + [name for p in parsed.values() for x in p.segments if not x.defines for name in x.references]
+        referenced = set(todo)
+        while any(todo):
+            name = todo.pop()
+            segment = definitions.get(name)
+            if segment == None or id(segment) in kept:
+                continue
+            kept.add(id(segment))
+            for x in segment.references:
+                if not x in referenced:
+                    referenced.add(x)
+                    todo.append(x)
+        return {x: [y for y in p.segments if id(y) in kept] for x, p in parsed.items()}, referenced
+
+
+    def _read_imports(self, allowed_imports=None, referenced=None, silent=False):
         '''Reads imports from all files. Non-stl python libraries are skipped, except those specifically allowed in `allowed_imports`.
         Args:
             allowed_imports (optional iterable(str)): If set to an iterable, does not remove given import statements.
+            referenced (optional set(str)): If set, skips imports binding a name that is not in this set.
             silent (optional bool): If set, prints warnings about found non-stl python libraries.
 
         Returns:
-            `(set, set)`: The first set contains all found stl import names using format 'import x', with elements `x`.
-                          The second set contains all found stl import names using format 'from x import y (as z)', with elements `(x, y)` and `(x, y, z)`.'''
-        regex_import = re.compile(r'^ *import +([a-zA-Z\._0-9]+)', re.MULTILINE)
-        regex_from_import = re.compile(r'^ *from +([a-zA-Z\._0-9]+) import +((?:[a-zA-Z\._0-9]+, *)*[a-zA-Z\._0-9]+) *(?:as)? *([a-zA-Z\._0-9]+)?', re.MULTILINE)
+            `(set, set)`: The first set contains all found stl import names using format 'import x (as z)', with elements `(x, z)`.
+                          The second set contains all found stl import names using format 'from x import y (as z)', with elements `(x, y, z)`.
+                          `z` is `None` when no alias is given.'''
         found_stl_imports = set()
         found_stl_import_froms = set()
 
         allowed_set = set(allowed_imports) if allowed_imports else None
 
         for x in self._files:
-            with open(x, 'r') as f:
-                lines = f.read()
-
-                for match in itertools.chain(regex_import.finditer(lines), regex_from_import.finditer(lines)):
-                    matchtuple = match.groups()
-                    match_importmodule = matchtuple[0]
-
-                    if (not self._is_regular_python(match_importmodule)) and not (allowed_set and match_importmodule in allowed_set):
-                        if not silent:
-                            printw('(file: {}) Found non-regular import "{}".'.format(x, match_importmodule))
-                    else:
-                        if len(matchtuple) > 1:
-                            found_stl_import_froms.add(matchtuple)
-                        else:
-                            found_stl_imports.add(matchtuple[0])
-        if not any(found_stl_import_froms):
-            raise ValueError('Empty from sequence.')
+            for module, name, asname in _parse_file(x).imports:
+                if referenced != None and name != '*' and not _import_binding(module, name, asname) in referenced:
+                    continue
+                match_importmodule = module or name
+                if (not self._is_regular_python(match_importmodule)) and not (allowed_set and match_importmodule in allowed_set):
+                    if not silent:
+                        printw('(file: {}) Found non-regular import "{}".'.format(x, match_importmodule))
+                elif module:
+                    found_stl_import_froms.add((module, name, asname))
+                else:
+                    found_stl_imports.add((name, asname))
         return found_stl_imports, found_stl_import_froms
 
 
-    def _read_non_imports(self, filepath):
-        '''Reads given `filepath`, strips lines containing Python import statements (careful with comments, don't use multiline statements with ';'), returns as generator.'''
-        regex_no_import = re.compile(r'^((?!(?:from .+)? *import +.*).)+$', re.MULTILINE)
-        # ^((?!(?:from .+)? *import +(?:.*) *(?:as .*)?).)+$
-        # 
-        with open(filepath, 'r') as f:
-            lines = f.read()
-            return '\n'.join(x.group(0) for x in regex_no_import.finditer(lines))
+    def _render(self, allowed_imports=None, silent=False):
+        '''Builds the source of the final module. See `generate()`.
+        Returns:
+            `str` containing the generated module source.'''
+        selected, referenced = self._select()
+        files = [x for x in self._files if referenced == None or any(selected[x])]
+        stl_imports, stl_imports_from = self._read_imports(allowed_imports=allowed_imports, referenced=referenced, silent=silent)
+        header = '''
+
+################################################################################
+# Generated by the meta modulegenerator
+# Processed {} files/modules:
+{}
+################################################################################
+
+'''.format(len(files), '\n'.join('#    {}'.format(x) for x in files))
+        importstring = '\n'+'\n'.join('import {} as {}'.format(*names) if names[1] != None else 'import {}'.format(names[0]) for names in sorted(stl_imports, key=str))
+        importstring += '\n'
+        importstring += '\n'.join('from {} import {} as {}'.format(*names) if names[2] != None else 'from {} import {}'.format(*names[:2]) for names in sorted(stl_imports_from, key=str))
+        parts = [header, importstring]
+        for x in files:
+            parts.append('''
+################################################################################
+# Created from file {}
+'''.format(x))
+            parts.append(_parse_file(x).body if referenced == None else '\n\n'.join(y.source for y in selected[x]))
+            parts.append('''
+################################################################################
+
+''')
+        return ''.join(parts)
 
 
     def generate(self, outputpath, allowed_imports=None, silent=False):
@@ -129,35 +311,40 @@ class ModuleGenerator(object):
             outputpath (str): Location to store module, including output filename. Creates every directory  that does not exist.
             allowed_imports (optional iterable(str)): If set to an iterable, does not remove given import statements.
             silent (optional bool): If set, skips printing warnings when non-standard imports are encountered.'''
-        dest_dir = fs.dirname(outputpath)
-        if not fs.isdir(dest_dir):
-            fs.mkdir(dest_dir, exist_ok=True)
+        fs.write_atomic(outputpath, self._render(allowed_imports=allowed_imports, silent=silent))
 
 
-        stl_imports, stl_imports_from = self._read_imports(allowed_imports=allowed_imports, silent=silent)
-        with open(outputpath, 'w') as f:
-            header = '''
+    def digest(self, allowed_imports=None):
+        '''Computes a content hash over the generator version, the interpreter, the input files, the entrypoints and `allowed_imports`. Equal digests produce equal modules.
+        The interpreter counts because its stl names decide which imports we strip. We hash what keys the stl index (see `_stl_index_path`), instead of loading the index.
+        Returns:
+            `str` hexdigest.'''
+        hasher = hashlib.sha256('{}\n{}\n{}\n{}\n{}\n'.format(generator_version, sys.executable, sys.version, sorted(allowed_imports) if allowed_imports else None, self._entrypoints).encode('utf-8'))
+        for x in self._files:
+            hasher.update(x.encode('utf-8'))
+            with open(x, 'rb') as f:
+                hasher.update(hashlib.sha256(f.read()).digest())
+        return hasher.hexdigest()
 
-################################################################################
-# Generated by the meta modulegenerator
-# Processed {} files/modules:
-{}
-################################################################################
 
-'''.format(len(self._files), '\n'.join('#    {}'.format(x) for x in self._files))
-            f.write(header)
-            importstring = '\n'+'\n'.join('import {}'.format(name) for name in stl_imports)
-            importstring += '\n'
-            importstring += '\n'.join('from {} import {} as {}'.format(*names) if len(names) == 3 and names[2] != None else 'from {} import {}'.format(*names) for names in stl_imports_from)
-            f.write(importstring)
-            for x in self._files:
-                content = self._read_non_imports(x)
-                f.write('''
-################################################################################
-# Created from file {}
-'''.format(x))
-                f.write(content)
-                f.write('''
-################################################################################
+    def load(self, name, allowed_imports=None, silent=False):
+        '''Generates (if needed) and imports the final module. Generated modules are cached in the user cache directory, keyed by `digest()`.
+        When the module was loaded before in this process, generation and import are skipped altogether.
+        Args:
+            name (str): Name for the generated module.
+            allowed_imports (optional iterable(str)): If set to an iterable, does not remove given import statements.
+            silent (optional bool): If set, skips printing warnings when non-standard imports are encountered.
 
-''')
\ No newline at end of file
+        Returns:
+            Imported module. Its `__digest__` attribute is set to the module digest.'''
+        digest = self.digest(allowed_imports=allowed_imports)
+        with _loaded_modules_lock:
+            if digest in _loaded_modules:
+                return _loaded_modules[digest]
+            outputpath = fs.join(loc.cachedir(), 'modules', '{}-{}.py'.format(name, digest[:16]))
+            if not fs.isfile(outputpath):
+                self.generate(outputpath, allowed_imports=allowed_imports, silent=silent)
+            module = importer.import_full_path(outputpath)
+            module.__digest__ = digest
+            _loaded_modules[digest] = module
+            return module
@@ -0,0 +1,42 @@
+import hashlib
+import os
+
+
+_receiving = dict() # Maps names of archives being received to their (partial file, sha256 digest) pair.
+
+
+def archive_cached(name, sha256):
+    '''Returns `True` if the archive cache of this node has an archive with given name and sha256 digest.'''
+    path = join(archive_dir(), name)
+    return isfile(path) and _sha256sum(path) == sha256
+
+
+def receive_archive_start(name):
+    '''Starts receiving an archive for the archive cache of this node. Chunks are written to a partial file, which only replaces the cached archive once complete and verified.'''
+    mkdir(archive_dir(), exist_ok=True)
+    if name in _receiving: # Left over from an interrupted transfer.
+        _receiving.pop(name)[0].close()
+    _receiving[name] = (open(join(archive_dir(), name+'.part'), 'wb'), hashlib.sha256())
+    return True
+
+
+def receive_archive_chunk(name, data):
+    '''Appends a chunk to an archive being received.
+    Returns:
+        Number of bytes written.'''
+    f, digest = _receiving[name]
+    f.write(data)
+    digest.update(data)
+    return len(data)
+
+
+def receive_archive_finish(name, sha256):
+    '''Completes receiving an archive. The archive is moved into the archive cache atomically, if it has given sha256 digest.'''
+    f, digest = _receiving.pop(name)
+    f.close()
+    partloc = join(archive_dir(), name+'.part')
+    if digest.hexdigest() != sha256:
+        rm(partloc, ignore_errors=True)
+        raise ValueError('Checksum mismatch: Expected sha256 {}, received {}'.format(sha256, digest.hexdigest()))
+    os.replace(partloc, join(archive_dir(), name))
+    return True
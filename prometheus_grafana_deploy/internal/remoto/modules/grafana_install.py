@@ -1,18 +1,20 @@
-import subprocess
-
 def install_grafana(image, force_reinstall, silent):
-    has_docker = subprocess.call('which docker', **get_subprocess_kwargs(silent)) == 0
-    has_grafana = subprocess.call('sudo docker image inspect {}'.format(image), **get_subprocess_kwargs(True)) == 0
+    has_docker = _call('which docker', silent) == 0
+    has_grafana = _call('sudo docker image inspect {}'.format(image), True) == 0
 
     if (not force_reinstall) and has_docker and has_grafana:
         prints('Acceptable Grafana installation detected.')
         return True
     if not has_docker:
-        if subprocess.call('sudo apt install docker.io -y', **get_subprocess_kwargs(silent)) != 0:
+        with span('apt install docker.io'):
+            installed = _call('sudo apt install docker.io -y', silent) == 0
+        if not installed:
             printe('Could not install docker.io.')
             return False
     if force_reinstall or not has_grafana:
-        if subprocess.call('sudo docker image pull {}'.format(image), **get_subprocess_kwargs(silent)) != 0:
+        with span('docker image pull'):
+            pulled = _call('sudo docker image pull {}'.format(image), silent) == 0
+        if not pulled:
             printe('Could not fetch "{}" image.'.format(image))
             return False
     return True
\ No newline at end of file
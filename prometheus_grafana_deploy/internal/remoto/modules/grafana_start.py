@@ -1,20 +1,20 @@
-import subprocess
-
 def start_grafana(instance_name, image, port, silent):
-    output = subprocess.check_output('sudo docker ps -f "name={0}" --format "{{{{.Names}}}}"'.format(instance_name), shell=True).decode('utf-8').strip()
+    output = _check_output('sudo docker ps -f "name={0}" --format "{{{{.Names}}}}"'.format(instance_name))
     grafana_running = output == instance_name
     if grafana_running:
         prints('Running Grafana instance found.')
         return True
-    output = subprocess.check_output('sudo docker ps -a -f "name={0}" --format "{{{{.Names}}}}"'.format(instance_name), shell=True).decode('utf-8').strip()
+    output = _check_output('sudo docker ps -a -f "name={0}" --format "{{{{.Names}}}}"'.format(instance_name))
     grafana_exists = output == instance_name
     
     if grafana_exists:
-        if subprocess.call('sudo docker start {}'.format(instance_name), **get_subprocess_kwargs(silent)) != 0:
+        if _call('sudo docker start {}'.format(instance_name), silent) != 0:
             printe('Could not start existing Grafana container.')
             return False
     else:
-        if subprocess.call('sudo docker run -d --name {0} -p {1}:{1} {2}'.format(instance_name, port, image), **get_subprocess_kwargs(silent)) != 0:
+        with span('docker run'):
+            started = _call('sudo docker run -d --name {0} -p {1}:{1} {2}'.format(instance_name, port, image), silent) == 0
+        if not started:
             printe('Could not boot Grafana.')
             return False
     return True
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+import select
+import signal
+import subprocess
+import sys
+
+
+# HTTP file server started by `start_mirror`. Serves a directory, except partial files, handling at most `max_clients` requests at once. Other clients wait in the listen backlog.
+# Prints "ready" once it listens on its port.
+# Exits by itself after `lifetime` seconds, so it never outlives an install for long, even when we cannot stop it.
+_mirror_server = """
+import http.server
+import os
+import socketserver
+import sys
+import threading
+
+directory, port, max_clients, lifetime = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4])
+slots = threading.BoundedSemaphore(max_clients)
+os.chdir(directory)
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if self.path.split('?')[0].endswith('.part'): # Archive still being written.
+            self.send_error(404)
+            return None
+        return super().send_head()
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def process_request(self, request, client_address):
+        slots.acquire()
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            slots.release()
+
+server = Server(('', port), Handler)
+print('ready', flush=True)
+sys.stdout.close()
+threading.Thread(target=server.serve_forever, daemon=True).start()
+threading.Event().wait(lifetime)
+"""
+
+
+def start_mirror(port, max_clients, lifetime, silent):
+    '''Starts an HTTP server in the background, serving the archive cache of this node to other nodes.
+    Args:
+        port (int): Port to listen on.
+        max_clients (int): Maximum number of requests to handle at once.
+        lifetime (float): Number of seconds after which the server stops by itself.
+        silent (optional bool): If set, does not print.
+
+    Returns:
+        Process id of the server, to pass to `stop_mirror`.'''
+    mkdir(archive_dir(), exist_ok=True)
+    with span('start mirror'):
+        process = subprocess.Popen([sys.executable, '-c', _mirror_server, archive_dir(), str(port), str(max_clients), str(lifetime)], start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if silent else None)
+        # We wait for the server itself to report that it listens. Connecting to the port would also succeed when another process (e.g. an old mirror) has it.
+        readable, _, _ = select.select([process.stdout], [], [], 10)
+        line = process.stdout.readline() if readable else b''
+        process.stdout.close()
+        if line.strip() != b'ready':
+            process.kill()
+            process.wait()
+            raise RuntimeError('Mirror server did not start listening on port {}. Is the port in use?'.format(port))
+        if not silent:
+            print('Serving {} on port {}'.format(archive_dir(), port))
+        return process.pid
+
+
+def stop_mirror(pid):
+    '''Stops a mirror server started by `start_mirror`. Does nothing if it exited already.'''
+    try:
+        with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+            if not archive_dir().encode('utf-8') in f.read(): # Process id was reused by another process.
+                return True
+        os.kill(pid, signal.SIGTERM)
+    except (FileNotFoundError, ProcessLookupError) as e:
+        return True
+    try:
+        os.waitpid(pid, 0)
+    except ChildProcessError as e: # Started over another connection.
+        pass
+    return True
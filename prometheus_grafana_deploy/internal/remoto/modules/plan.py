@@ -0,0 +1,41 @@
+import time
+
+
+def run_plan(steps, stop_on_failure, step_timeout=None, node_timeout=None):
+    '''Runs an ordered list of steps, all received in one message.
+    Args:
+        steps (list(tuple(str, tuple))): Steps to run. Each step is a tuple containing the name of a function in this module, and the arguments to call it with.
+        stop_on_failure (bool): If set, skips all steps following a failed step.
+        step_timeout (optional float): If set, maximum number of seconds one step may take. Subprocesses and downloads started by a step are cancelled when its time is up.
+        node_timeout (optional float): If set, maximum number of seconds all steps together may take. Steps that did not start in time are skipped, and count as failed.
+
+    Returns:
+        `list(dict)` with a result for every step, in order. Each result has keys "step" (function name), "ok" (`True` unless the function returned `False`, raised, or was skipped),
+        "skipped" (`True` if the step was not executed), "result" (function return value) and "error" (`str` describing the raised exception or missed deadline, or `None`).
+        Executed steps also have keys "start" and "end" (seconds since the plan started), and "spans" (list of phases measured by the step, as (name, start, end) tuples, in seconds since the plan started).'''
+    results = []
+    failed = False
+    plan_start = time.monotonic()
+    node_deadline = None if node_timeout == None else plan_start + node_timeout
+    for name, args in steps:
+        if failed and stop_on_failure:
+            results.append({'step': name, 'ok': False, 'skipped': True, 'result': None, 'error': None})
+            continue
+        if node_deadline != None and time.monotonic() >= node_deadline:
+            results.append({'step': name, 'ok': False, 'skipped': True, 'result': None, 'error': 'Node timeout of {} seconds expired before starting.'.format(node_timeout)})
+            failed = True
+            continue
+        timeouts = [x for x in (step_timeout, None if node_deadline == None else node_deadline - time.monotonic()) if x != None]
+        set_deadline(min(timeouts) if any(timeouts) else None)
+        del _spans[:]
+        step_start = time.monotonic()
+        try:
+            result = globals()[name](*args)
+            results.append({'step': name, 'ok': result is not False, 'skipped': False, 'result': result, 'error': None})
+        except Exception as e:
+            results.append({'step': name, 'ok': False, 'skipped': False, 'result': None, 'error': '{}: {}'.format(type(e).__name__, e)})
+        finally:
+            set_deadline(None)
+        results[-1].update({'start': step_start - plan_start, 'end': time.monotonic() - plan_start, 'spans': [(x, start - plan_start, end - plan_start) for x, start, end in _spans]})
+        failed = failed or not results[-1]['ok']
+    return results
@@ -1,71 +1,303 @@
+import hashlib
 import os
-import subprocess
+import random
+import tarfile
 import tempfile
+import threading
+import time
 import urllib.request
 
 
-def _download_url(location, url, name='unspecified', silent=False, retries=5):
-    '''Download a zip from an URL.
+def _sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_socket_timeout = 60 # Seconds a download may stall before we give up on the attempt.
+_min_throughput = 16*1024 # Bytes per second a download must reach, measured over windows of `_throughput_window` seconds. Slower attempts are aborted and resumed.
+_throughput_window = 20
+_backoff_base = 1 # Seconds to wait before the first retry, at most. Doubles every retry, up to `_backoff_max`.
+_backoff_max = 30
+_parallel_min_size = 16*1024*1024 # Archives smaller than this are never downloaded with parallel range requests.
+
+
+def _timeout():
+    return _socket_timeout if remaining_time() == None else min(_socket_timeout, remaining_time())
+
+
+class _Tee(object):
+    '''Readable stream over a download, which copies everything read into a file and (optionally) a sha256 digest.
+    Raises an `IOError` when the download is slower than `_min_throughput`.'''
+    def __init__(self, response, f, digest=None):
+        self._response = response
+        self._f = f
+        self._digest = digest
+        self.bytes = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def read(self, size=-1):
+        data = self._response.read1(size) if size > 0 else self._response.read(size) # `read1` returns what arrived, so we notice slow downloads quickly.
+        self._f.write(data)
+        if self._digest:
+            self._digest.update(data)
+        self.bytes += len(data)
+        now = time.monotonic()
+        if now - self._window_start >= _throughput_window:
+            if (self.bytes - self._window_bytes) / (now - self._window_start) < _min_throughput:
+                raise IOError('Download stalled below {} KiB/s.'.format(_min_throughput//1024))
+            self._window_start, self._window_bytes = now, self.bytes
+        return data
+
+    def drain(self):
+        '''Reads the rest of the download.'''
+        while self.read(64*1024):
+            pass
+
+
+def _extract_members(fileobj, location, members=None):
+    '''Extracts a tar archive from a stream, in one pass, without seeking. Release archives have one top directory, which is stripped.
+    Args:
+        fileobj (file-like): Stream to read the (optionally compressed) archive from.
+        location (str): Directory to extract to.
+        members (optional list(str)): Names of files and directories in the top directory to extract. If `None`, extracts everything.'''
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            parts = member.name.split('/', 1)
+            if len(parts) < 2 or not parts[1] or (members != None and parts[1].split('/')[0] not in members):
+                continue
+            if parts[1].startswith('/') or '..' in parts[1].split('/'):
+                raise ValueError('Archive member {} points outside of the archive.'.format(member.name))
+            member.name = parts[1]
+            tar.extract(member, location, **({'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}))
+
+
+def _extract_file(path, location, members=None):
+    '''Replaces the contents of given location with the contents of a tar archive on disk. See `_extract_members`.'''
+    rm(location, ignore_errors=True)
+    mkdir(location)
+    with open(path, 'rb') as f:
+        _extract_members(f, location, members)
+
+
+def _ranged_length(url):
+    '''Returns the size of the file at given URL, if the server accepts range requests for it. Returns 0 otherwise.'''
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=_timeout()) as response:
+            if response.headers.get('Accept-Ranges') == 'bytes':
+                return int(response.headers.get('Content-Length', 0))
+    except Exception as e:
+        pass
+    return 0
+
+
+def _download_ranges(url, partloc, ranges):
+    '''Downloads a file with parallel range requests, every one writing its own part of the partial file.
+    Args:
+        url (str): URL to download.
+        partloc (str): Path to the partial file, which has the size of the complete file already.
+        ranges (dict(tuple(int, int), int)): Maps the `(start, end)` of every range to the number of bytes received for it. Updated while downloading, so a later call after a failure only requests what is missing.
+
+    Returns:
+        sha256 digest of the downloaded file.'''
+    errors = []
+    def _download_range(start, end):
+        try:
+            offset = start + ranges[(start, end)]
+            request = urllib.request.Request(url, headers={'Range': 'bytes={}-{}'.format(offset, end-1)})
+            with urllib.request.urlopen(request, timeout=_timeout()) as response, open(partloc, 'r+b') as f:
+                if response.status != 206 or not response.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset)):
+                    raise IOError('Server ignored range request.')
+                f.seek(offset)
+                stream = _Tee(response, f)
+                try:
+                    stream.drain()
+                finally:
+                    ranges[(start, end)] += stream.bytes
+            if ranges[(start, end)] != end-start:
+                raise IOError('Received {} of {} bytes for range {}-{}.'.format(ranges[(start, end)], end-start, start, end-1))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=_download_range, args=x, daemon=True) for x, received in ranges.items() if received < x[1]-x[0]]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    if errors:
+        raise errors[0]
+    return _sha256sum(partloc)
+
+
+def _download(url, partloc, streams=1, extract_to=None, members=None, ranges=None):
+    '''Makes one attempt to download a file into a partial file. If the partial file has content from an earlier attempt, only the rest is requested (with HTTP Range requests).
     Args:
-        url (str): URL zip.
+        url (str): URL to download.
+        partloc (str): Path to the partial file.
+        streams (optional int): If higher than 1, large files are downloaded with this many parallel range requests, when the server supports them.
+        extract_to (optional str): If set, extracts the download while it streams in, see `_extract_members`. Only happens when downloading from the start, with one stream.
+        members (optional list(str)): Names of files and directories to extract.
+        ranges (optional dict): Progress of parallel range requests, kept by the caller across attempts. Must be empty on the first attempt. See `_download_ranges`.
+
+    Returns:
+        `(sha256, received, extracted)`: sha256 digest of the complete file, number of bytes received in this attempt, and whether the download was extracted.'''
+    offset = os.path.getsize(partloc) if isfile(partloc) else 0
+    if offset == 0 and streams > 1 and ranges != None and not ranges:
+        length = _ranged_length(url)
+        if length >= _parallel_min_size:
+            with open(partloc, 'wb') as f:
+                f.truncate(length)
+            ranges.update({(length*x//streams, length*(x+1)//streams): 0 for x in range(streams)})
+    if ranges:
+        before = sum(ranges.values())
+        digest = _download_ranges(url, partloc, ranges)
+        return digest, sum(ranges.values())-before, False
+    request = urllib.request.Request(url, headers={'Range': 'bytes={}-'.format(offset)} if offset else {})
+    with urllib.request.urlopen(request, timeout=_timeout()) as response:
+        if offset and not (getattr(response, 'status', None) == 206 and response.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset))):
+            offset = 0 # Server does not resume. We start over.
+        digest = hashlib.sha256()
+        if offset:
+            with open(partloc, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    digest.update(chunk)
+        with open(partloc, 'ab' if offset else 'wb') as f:
+            stream = _Tee(response, f, digest)
+            if extract_to and offset == 0:
+                rm(extract_to, ignore_errors=True)
+                mkdir(extract_to)
+                _extract_members(stream, extract_to, members)
+            stream.drain() # Rest of the archive, e.g. members we skipped, for the cache and the checksum.
+        length = response.headers.get('Content-Length')
+        if length and stream.bytes != int(length):
+            raise IOError('Connection closed after {} of {} bytes.'.format(stream.bytes, length))
+        return digest.hexdigest(), stream.bytes, bool(extract_to and offset == 0)
+
+
+def _fetch_archive(url, name='unspecified', silent=False, retries=5, sha256=None, extract_to=None, members=None, streams=1):
+    '''Downloads an archive into the archive cache of this node, unless it is cached already.
+    Failed attempts are resumed where they stopped, after a jittered exponential backoff. Stops retrying when the deadline of the running step passes.
+    Args:
+        url (str): URL of the archive.
         name (optional str): Name for download to display when reporting errors.
         silent (optional bool): If set,  does not print.
-        retries (optional int): Amount of retries before reporting errors.
+        retries (optional int): Amount of download attempts before reporting errors. We always make at least one attempt.
+        sha256 (optional str): If set, the archive must have this sha256 digest. Cached archives with another digest are downloaded again.
+        extract_to (optional str): If set, also extracts the archive (a tar archive) to this directory. Any existing contents are removed. Downloads are extracted while they stream in, without reading the archive back from disk.
+        members (optional list(str)): Names of files and directories to extract, see `_extract_members`.
+        streams (optional int): Number of parallel range requests to download large archives with. See `_download`.
 
     Returns:
-        `True` on success, `False` otherwise.'''
-    with tempfile.TemporaryDirectory() as tmpdir: # We use a tempfile to store the downloaded archive.
-        archiveloc = join(tmpdir, url.split('/')[-1])
+        Path to the cached archive on success, `None` otherwise.'''
+    archiveloc = join(archive_dir(), url.split('/')[-1]) # Release archive names carry their version, e.g. "prometheus-2.26.0.linux-amd64.tar.gz".
+    if isfile(archiveloc) and (sha256 == None or _sha256sum(archiveloc) == sha256):
         if not silent:
-            print('Fetching Prometheus node exporter from {}'.format(url))
+            print('Using cached {} archive {}'.format(name, archiveloc))
+        if extract_to:
+            with span('extract {}'.format(name)):
+                _extract_file(archiveloc, extract_to, members)
+        return archiveloc
+    mkdir(archive_dir(), exist_ok=True)
+    partloc = archiveloc+'.part'
+    rm(partloc, ignore_errors=True) # Left over from an interrupted install, which we cannot verify.
+    if not silent:
+        print('Fetching {} from {}'.format(name, url))
+    t0 = time.monotonic()
+    received = 0
+    ranges = dict()
+    retries = max(retries, 1)
+    with span('download {}'.format(name)):
         for x in range(retries):
             try:
-                try:
-                    rm(archiveloc)
-                except Exception as e:
-                    pass
-                urllib.request.urlretrieve(url, archiveloc)
+                digest, nbytes, extracted = _download(url, partloc, streams=streams, extract_to=extract_to, members=members, ranges=ranges)
+                received += nbytes
+                if sha256 != None and digest != sha256:
+                    rm(partloc, ignore_errors=True)
+                    ranges.clear()
+                    raise ValueError('Checksum mismatch: Expected sha256 {}, received {}'.format(sha256, digest))
+                os.replace(partloc, archiveloc)
                 break
             except Exception as e:
-                if x == 0:
-                    printw('Could not download {}, url={}. Retrying...'.format(name, url))
-                elif x == retries-1:
+                if x == retries-1 or remaining_time() == 0:
+                    rm(partloc, ignore_errors=True)
+                    if extract_to:
+                        rm(extract_to, ignore_errors=True)
                     printe('Could not download {}, url={}. {}'.format(name, url, e))
-                    return False
+                    return None
+                delay = random.uniform(0, min(_backoff_max, _backoff_base * 2**x))
+                if remaining_time() != None:
+                    delay = min(delay, remaining_time())
+                printw('Could not download {} (attempt {}/{}), url={}: {}. Retrying in {:.1f} seconds...'.format(name, x+1, retries, url, str(e).rstrip('.'), delay))
+                time.sleep(delay)
+    if not silent:
+        seconds = time.monotonic() - t0
+        print('Fetched {} ({:.1f} MiB in {:.1f} seconds, {:.1f} MiB/s)'.format(name, received/1024/1024, seconds, received/1024/1024/seconds if seconds > 0 else 0))
+    if extract_to and not extracted: # Resumed or parallel downloads are extracted once complete.
+        with span('extract {}'.format(name)):
+            _extract_file(archiveloc, extract_to, members)
+    return archiveloc
+
+
+def fetch_archive(url, name, silent, retries, sha256=None, streams=1):
+    '''Downloads an archive into the archive cache of this node, e.g. to serve it to other nodes with `start_mirror`. See `_fetch_archive`.'''
+    return _fetch_archive(url, name=name, silent=silent, retries=retries, sha256=sha256, streams=streams) != None
+
+
+def _download_url(location, url, name='unspecified', silent=False, retries=5, sha256=None, members=None, streams=1):
+    '''Download a release archive from an URL, and extract it to given location.
+    Tar archives are extracted while they download, and only the given members are written. Other archives (e.g. zip files) are extracted after downloading.
+    Downloaded archives are kept in the archive cache of this node (see `archive_dir()`), so reinstalling the same version does not download again. See `_fetch_archive` for arguments.
+
+    Returns:
+        `True` on success, `False` otherwise.'''
+    if any(url.endswith(x) for x in ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
         try:
-            extractloc = join(tmpdir, 'extracted')
-            mkdir(extractloc, exist_ok=True)
-            unpack(archiveloc, extractloc)
-
-            extracted_dir = next(ls(extractloc, only_dirs=True, full_paths=True)) # find out what the extracted directory is called. There will be only 1 extracted directory.
-            rm(location, ignore_errors=True)
-            mkdir(location)
-            for x in ls(extracted_dir, full_paths=True): # Move every file and directory to the final location.
-                mv(x, location)
+            return _fetch_archive(url, name=name, silent=silent, retries=retries, sha256=sha256, extract_to=location, members=members, streams=streams) != None
+        except Exception as e: # Extracting a cached archive failed.
+            printe('Could not extract {} archive correctly, url={}. {}'.format(name, url, e))
+            return False
+
+    archiveloc = _fetch_archive(url, name=name, silent=silent, retries=retries, sha256=sha256, streams=streams)
+    if not archiveloc:
+        return False
+    with tempfile.TemporaryDirectory() as tmpdir: # We use a tempdir to extract the archive in.
+        try:
+            with span('extract {}'.format(name)):
+                extractloc = join(tmpdir, 'extracted')
+                mkdir(extractloc, exist_ok=True)
+                unpack(archiveloc, extractloc)
+
+                extracted_dir = next(ls(extractloc, only_dirs=True, full_paths=True)) # find out what the extracted directory is called. There will be only 1 extracted directory.
+                rm(location, ignore_errors=True)
+                mkdir(location)
+                for x in ls(extracted_dir, full_paths=True): # Move every file and directory to the final location.
+                    mv(x, location)
             return True
         except Exception as e:
             printe('Could not extract {} zip file correctly, url={}. {}'.format(name, url, e))
             return False
 
 
-def install_prometheus_node_exporter(location, node_exporter_url, force_reinstall, silent, retries):
+def install_prometheus_node_exporter(location, node_exporter_url, force_reinstall, silent, retries, sha256=None, streams=1):
     location = os.path.expanduser(location)
-    if (not force_reinstall) and isfile(join(location, 'node_exporter')) and isfile('/usr/bin/node_exporter') and isfile('/etc/systemd/system/node_exporter.service'):
+    if (not force_reinstall) and isfile(join(location, 'node_exporter')) and isfile(sysroot('/usr/bin/node_exporter')) and isfile(sysroot('/etc/systemd/system/node_exporter.service')):
         prints('Acceptable node exporter installation detected.')
         return True
     if force_reinstall:
         rm(location, ignore_errors=True)
     mkdir(location, exist_ok=True)
-    if (not isfile(location, 'node_exporter')) and not _download_url(location, node_exporter_url, name='Prometheus node exporter', silent=silent, retries=retries):
+    if (not isfile(location, 'node_exporter')) and not _download_url(location, node_exporter_url, name='Prometheus node exporter', silent=silent, retries=retries, sha256=sha256, members=['node_exporter'], streams=streams):
         return False
-    if subprocess.call('sudo cp {} /usr/bin'.format(join(location, 'node_exporter')), **get_subprocess_kwargs(silent)) != 0:
-        printe('Could not copy {} to /usr/bin. Location exists: {}'.format(join(location, 'node_exporter'), isfile(location, 'node_exporter')))
+    if _call('sudo cp {} {}'.format(join(location, 'node_exporter'), sysroot('/usr/bin')), silent) != 0:
+        printe('Could not copy {} to {}. Location exists: {}'.format(join(location, 'node_exporter'), sysroot('/usr/bin'), isfile(location, 'node_exporter')))
         import socket
         print(str(socket.gethostname()))
-        printe('cmd={}'.format('sudo cp {} /usr/bin'.format(join(location, 'node_exporter'))))
+        printe('cmd={}'.format('sudo cp {} {}'.format(join(location, 'node_exporter'), sysroot('/usr/bin'))))
         return False
     cmd = """sudo python3 -c "
-with open('/etc/systemd/system/node_exporter.service', 'w') as f:
+with open('{}', 'w') as f:
     f.write('''
 [Unit]
 Description=Node Exporter
@@ -73,37 +305,39 @@ After=network.target
 
 [Service]
 Type=simple
-ExecStart=/usr/bin/node_exporter
+ExecStart={}
 
 [Install]
 WantedBy=multi-user.target
 ''')
 exit(0)
 "
-"""
-    if subprocess.call(cmd, **get_subprocess_kwargs(silent)) != 0:
+""".format(sysroot('/etc/systemd/system/node_exporter.service'), sysroot('/usr/bin/node_exporter'))
+    if _call(cmd, silent) != 0:
         printe('Could not write systemd config.')
         return False
-    if subprocess.call('sudo systemctl daemon-reload', **get_subprocess_kwargs(silent)) != 0:
+    with span('systemctl daemon-reload'):
+        reloaded = _call('sudo systemctl daemon-reload', silent) == 0
+    if not reloaded:
         printe('Could not reload daemons.')
         return False
     return True
 
 
-def install_prometheus_admin(location, node_admin_url, force_reinstall, silent, retries):
+def install_prometheus_admin(location, node_admin_url, force_reinstall, silent, retries, sha256=None, streams=1):
     location = os.path.expanduser(location)
-    if (not force_reinstall) and isfile(join(location, 'prometheus')) and isfile('/usr/bin/prometheus') and isfile('/etc/systemd/system/prometheus.service'):
+    if (not force_reinstall) and isfile(join(location, 'prometheus')) and isfile(sysroot('/usr/bin/prometheus')) and isfile(sysroot('/etc/systemd/system/prometheus.service')):
         prints('Acceptable admin installation detected.')
         return True
     mkdir(location, exist_ok=True)
 
-    if (not isfile(location, 'prometheus')) and not _download_url(location, node_admin_url, name='Prometheus admin url', silent=silent, retries=retries):
+    if (not isfile(location, 'prometheus')) and not _download_url(location, node_admin_url, name='Prometheus admin', silent=silent, retries=retries, sha256=sha256, members=['prometheus', 'consoles', 'console_libraries'], streams=streams):
         return False
-    if subprocess.call('sudo cp {} /usr/bin'.format(join(location, 'prometheus')), **get_subprocess_kwargs(silent)) != 0:
-        printe('Could not copy {} to /usr/bin'.format(join(location, 'prometheus')))
+    if _call('sudo cp {} {}'.format(join(location, 'prometheus'), sysroot('/usr/bin')), silent) != 0:
+        printe('Could not copy {} to {}'.format(join(location, 'prometheus'), sysroot('/usr/bin')))
         return False
     cmd = """sudo python3 -c "
-with open('/etc/systemd/system/prometheus.service', 'w') as f:
+with open('{}', 'w') as f:
     f.write('''
 [Unit]
 Description=Prometheus
@@ -111,19 +345,21 @@ After=network.target
  
 [Service]
 Type=simple
-ExecStart=/usr/bin/prometheus --config.file={}
+ExecStart={} --config.file={}
  
 [Install]
 WantedBy=multi-user.target
 ''')
 exit(0)
 "
-""".format(join(location, 'config.yml'))
-    if subprocess.call(cmd, **get_subprocess_kwargs(silent)) != 0:
+""".format(sysroot('/etc/systemd/system/prometheus.service'), sysroot('/usr/bin/prometheus'), join(location, 'config.yml'))
+    if _call(cmd, silent) != 0:
         printe('Could not write admin systemd config.')
         return False
 
-    if subprocess.call('sudo systemctl daemon-reload', **get_subprocess_kwargs(silent)) != 0:
+    with span('systemctl daemon-reload'):
+        reloaded = _call('sudo systemctl daemon-reload', silent) == 0
+    if not reloaded:
         printe('Could not reload daemons.')
         return False
     return True
\ No newline at end of file
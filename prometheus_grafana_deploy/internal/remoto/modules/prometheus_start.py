@@ -1,14 +1,14 @@
-import subprocess
-
 def start_prometheus_node_exporter(location, silent):
-    if not isfile('/etc/systemd/system/node_exporter.service'):
+    if not isfile(sysroot('/etc/systemd/system/node_exporter.service')):
         return False # We have no node daemon installed.
-    if subprocess.call('sudo systemctl restart node_exporter', **get_subprocess_kwargs(silent)) != 0:
+    with span('systemctl restart node_exporter'):
+        restarted = _call('sudo systemctl restart node_exporter', silent) == 0
+    if not restarted:
         return False
-    return subprocess.call('sudo systemctl enable node_exporter', **get_subprocess_kwargs(silent)) == 0
+    return _call('sudo systemctl enable node_exporter', silent) == 0
 
 def start_prometheus_admin(location, config, silent):
-    if not isfile('/etc/systemd/system/prometheus.service'):
+    if not isfile(sysroot('/etc/systemd/system/prometheus.service')):
         return False # We have no node daemon installed.
     location = os.path.expanduser(location)
     if not isdir(location):
@@ -17,6 +17,8 @@ def start_prometheus_admin(location, config, silent):
     configfile = join(location, 'config.yml')
     with open(configfile, 'w') as f:
         f.write(config)
-    if subprocess.call('sudo systemctl restart prometheus', **get_subprocess_kwargs(silent)) != 0:
+    with span('systemctl restart prometheus'):
+        restarted = _call('sudo systemctl restart prometheus', silent) == 0
+    if not restarted:
         return False
-    return subprocess.call('sudo systemctl enable prometheus', **get_subprocess_kwargs(silent)) == 0
+    return _call('sudo systemctl enable prometheus', silent) == 0
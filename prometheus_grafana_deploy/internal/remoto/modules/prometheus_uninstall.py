@@ -1,5 +1,4 @@
 import os
-import subprocess
 
 def uninstall_prometheus_node_exporter(location, silent, retries):
     location = os.path.expanduser(location)
@@ -8,13 +7,13 @@ def uninstall_prometheus_node_exporter(location, silent, retries):
 
     if isfile(join(location, 'node_exporter')):
         rm(location, ignore_errors=True)
-    subprocess.call('sudo rm -rf /usr/bin/node_exporter /etc/systemd/system/node_exporter.service', **get_subprocess_kwargs(silent))
+    _call('sudo rm -rf {} {}'.format(sysroot('/usr/bin/node_exporter'), sysroot('/etc/systemd/system/node_exporter.service')), silent)
     return True
 
 
 def uninstall_prometheus_admin(location, silent, retries):
     location = os.path.expanduser(location)
-    if isfile(join(location, 'prometheus')) and isfile('/usr/bin/prometheus') and isfile('/etc/systemd/system/prometheus.service'):
+    if isfile(join(location, 'prometheus')) and isfile(sysroot('/usr/bin/prometheus')) and isfile(sysroot('/etc/systemd/system/prometheus.service')):
         rm(location, ignore_errors=True)
-    subprocess.call('sudo rm -rf /usr/bin/prometheus /etc/systemd/system/prometheus.service', **get_subprocess_kwargs(silent))
+    _call('sudo rm -rf {} {}'.format(sysroot('/usr/bin/prometheus'), sysroot('/etc/systemd/system/prometheus.service')), silent)
     return True
\ No newline at end of file
@@ -1,6 +1,93 @@
-
 '''Small file to help with Prometheus+Grafana deployment.'''
+import os
+import signal
+import subprocess
+import threading
+import time
+
+
+_deadline = None # Monotonic time at which the running step must be done. `None` means there is no deadline.
+_spans = [] # Spans recorded by the running step, as (name, start, end) tuples. See `span()`.
+_kill_grace = 5 # Seconds commands get to exit after SIGTERM, when the deadline passes, before we send SIGKILL.
+_sysroot = os.environ.get('PROMETHEUS_GRAFANA_DEPLOY_SYSROOT', '') # Directory to use as system root. Empty on real nodes. Loopback nodes each have their own system root.
+
+
+def sysroot(path):
+    '''Returns location of given absolute system path (e.g. "/usr/bin") below the system root.'''
+    return _sysroot + path
+
+
+def archive_dir():
+    '''Returns the directory in which this node keeps downloaded release archives. It lives outside the installation directory, so it survives uninstalling.'''
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'prometheus_grafana_deploy', 'archives')
+
+
+def set_deadline(seconds):
+    '''Sets the deadline for the running step to given amount of seconds from now. If `None`, removes the deadline.'''
+    global _deadline
+    _deadline = None if seconds == None else time.monotonic() + seconds
+
+
+def remaining_time():
+    '''Returns number of seconds left before the deadline, or `None` if there is no deadline.'''
+    return None if _deadline == None else max(_deadline - time.monotonic(), 0)
+
+
+class _Span(object):
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _spans.append((self._name, self._start, time.monotonic()))
+        return False
+
+
+def span(name):
+    '''Returns a context manager measuring a phase of the running step, e.g. `with span('download'):`. `run_plan` returns measured phases with the step results.'''
+    return _Span(name)
+
+
 def get_subprocess_kwargs(silent):
+    '''Returns kwargs for `subprocess` calls.'''
     if silent:
         return {'shell': True, 'stderr': subprocess.DEVNULL, 'stdout': subprocess.DEVNULL}
     return {'shell': True}
+
+
+def _wait(process):
+    '''Waits for a process started in its own session, and returns its exit status.
+    When the deadline passes, the process is killed together with everything it started (e.g. the command `sudo` runs), and `subprocess.TimeoutExpired` is raised.
+    Killing only the shell would leave e.g. a running `apt install` behind, holding the dpkg lock.'''
+    try:
+        return process.wait(timeout=remaining_time())
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGTERM) # `sudo` relays SIGTERM to its command, which we may not signal ourselves.
+        try:
+            process.wait(timeout=_kill_grace)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        raise
+
+
+def _call(cmd, silent):
+    '''Runs a shell command, and returns its exit status. See `_wait` for what happens when the deadline passes.'''
+    with subprocess.Popen(cmd, start_new_session=True, **get_subprocess_kwargs(silent)) as process:
+        return _wait(process)
+
+
+def _check_output(cmd):
+    '''Runs a shell command, and returns its output, stripped. Raises `subprocess.CalledProcessError` when the command fails. See `_wait` for what happens when the deadline passes.'''
+    with subprocess.Popen(cmd, shell=True, start_new_session=True, stdout=subprocess.PIPE) as process:
+        output = []
+        reader = threading.Thread(target=lambda: output.append(process.stdout.read()), daemon=True) # Reading in the background lets us wait with a deadline.
+        reader.start()
+        status = _wait(process)
+        reader.join()
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd)
+    return output[0].decode('utf-8').strip()
@@ -0,0 +1,156 @@
+import queue
+
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Batched remote execution: A plan holds an ordered list of remote function calls for one node, which are sent in one message and run remotely in one round trip.'''
+
+_timeout_grace = 30 # Remote hosts enforce timeouts themselves. We only give up locally when a remote host did not report back this many seconds after its deadline.
+
+
+class Plan(object):
+    '''Ordered list of steps to run on one node. Each step calls a function of the lifecycle bundle.'''
+    def __init__(self, stop_on_failure=True):
+        self._steps = []
+        self._descriptions = []
+        self._stop_on_failure = stop_on_failure
+
+    def add(self, name, *args, description=None):
+        '''Appends a step.
+        Args:
+            name (str): Name of remote function to call.
+            args: Arguments for the remote function. Must be serializable by execnet.
+            description (optional str): Action description used when reporting failures, e.g. "start Grafana". Defaults to `name`.
+
+        Returns:
+            This plan.'''
+        self._steps.append((name, args))
+        self._descriptions.append(description or name)
+        return self
+
+    def extend(self, plan):
+        '''Appends all steps of given plan to this plan.
+        Returns:
+            This plan.'''
+        self._steps += plan._steps
+        self._descriptions += plan._descriptions
+        return self
+
+    @property
+    def steps(self):
+        return list(self._steps)
+
+    def __len__(self):
+        return len(self._steps)
+
+
+    def local_timeout(self, step_timeout=None, node_timeout=None):
+        '''Returns number of seconds after which we give up on a remote host executing this plan, or `None` to wait forever.'''
+        step_timeout, node_timeout = step_timeout or None, node_timeout or None # 0 disables timeouts.
+        if node_timeout:
+            return node_timeout + _timeout_grace
+        if step_timeout:
+            return step_timeout * len(self._steps) + _timeout_grace
+        return None
+
+
+    def failed(self, error):
+        '''Returns plan results in which every step failed with given error message.'''
+        return [{'step': name, 'ok': False, 'skipped': False, 'result': None, 'error': error} for name, _ in self._steps]
+
+
+    def submit(self, wrapper, module, callback, step_timeout=None, node_timeout=None):
+        '''Sends all steps to the remote host in one message, to run there in order. Does not wait for the steps to finish.
+        Args:
+            wrapper (RemotoSSHWrapper): Connection to execute plan on.
+            module (module): Lifecycle bundle module.
+            callback (callable): Called as `callback(results)` once the remote host reports back, from the execnet receiver thread.
+                                 `results` is a `list(dict)` containing a result for every step. See `run_plan` in `internal/remoto/modules/plan.py` for the result format.
+                                 If the connection fails, all steps fail.
+            step_timeout (optional float): If set, maximum number of seconds one step may take.
+            node_timeout (optional float): If set, maximum number of seconds all steps together may take.
+
+        Returns:
+            Number of seconds after which we should give up on the remote host, see `local_timeout()`.'''
+        missing = [name for name, _ in self._steps if not hasattr(module, name)]
+        if any(missing):
+            raise ValueError('Plan steps not available in module {}: {}'.format(module.__name__, ', '.join(missing)))
+        step_timeout, node_timeout = step_timeout or None, node_timeout or None # 0 disables timeouts.
+        try:
+            remote_module = wrapper.import_module(module)
+        except (OSError, EOFError) as e:
+            callback(self.failed('Could not send plan to remote host: {}'.format(e)))
+        else:
+            remote_module.submit('run_plan', (self._steps, self._stop_on_failure, step_timeout, node_timeout), lambda ok, value: callback(value if ok else self.failed(value)))
+        return self.local_timeout(step_timeout, node_timeout)
+
+
+    def report(self, results, node=None):
+        '''Reports failed steps in given plan results.
+        Args:
+            results (list(dict)): Results of this plan.
+            node (optional metareserve.Node): Node to mention when reporting failures.'''
+        for description, result in zip(self._descriptions, results):
+            if not (result['ok'] or result['skipped']) or (result['skipped'] and result['error']):
+                printe('Could not {}{}{}'.format(description, ' on node {}'.format(node) if node else '', ': {}'.format(result['error']) if result['error'] else '.'))
+
+
+    def timed_out(self, node, timeout):
+        '''Reports that a node did not finish this plan in time.
+        Returns:
+            Plan results in which every step failed.'''
+        printe('Node {} did not finish within {} seconds. Cancelling.'.format(node, timeout))
+        return self.failed('Timed out.')
+
+
+    def trace(self, tracer, node, results, submitted, received):
+        '''Records spans of a finished plan with given tracer: The plan as seen locally, every executed step, and the phases measured by steps.
+        Remote times are relative to the remote plan start. We assume a remote host replies right after finishing its last step, and align its plan with `received`.
+        Args:
+            tracer (Tracer): Tracer to record spans with.
+            node (metareserve.Node): Node that executed this plan.
+            results (list(dict)): Results of this plan.
+            submitted (float): Time at which we sent the plan, as `time.monotonic()` value.
+            received (float): Time at which we received the results, as `time.monotonic()` value.'''
+        tracer.add('plan', submitted, received, node=node)
+        ends = [x['end'] for x in results if x.get('end') != None]
+        if not any(ends):
+            return
+        offset = max(received - max(ends), submitted)
+        tracer.add('send plan', submitted, offset, node=node)
+        for description, result in zip(self._descriptions, results):
+            if result.get('start') == None:
+                continue
+            tracer.add(description, offset+result['start'], offset+result['end'], node=node, category='remote', args={'ok': result['ok'], 'error': result['error']})
+            for name, start, end in result['spans']:
+                tracer.add(name, offset+start, offset+end, node=node, category='remote')
+
+
+    def execute(self, wrapper, module, node=None, step_timeout=None, node_timeout=None):
+        '''Sends all steps to the remote host in one message, runs them there in order, and waits for them to finish. Reports failed steps.
+        To execute plans on many nodes at once, use `EventLoop` from `internal/remoto/eventloop.py` instead.
+        Args:
+            wrapper (RemotoSSHWrapper): Connection to execute plan on.
+            module (module): Lifecycle bundle module.
+            node (optional metareserve.Node): Node to mention when reporting failures.
+            step_timeout (optional float): If set, maximum number of seconds one step may take.
+            node_timeout (optional float): If set, maximum number of seconds all steps together may take.
+                                           If the remote host does not report back in time, we cancel the node by disconnecting `wrapper`, and all steps fail.
+
+        Returns:
+            `list(dict)` containing a result for every step. See `run_plan` in `internal/remoto/modules/plan.py` for the result format.'''
+        replies = queue.Queue()
+        timeout = self.submit(wrapper, module, replies.put, step_timeout=step_timeout, node_timeout=node_timeout)
+        try:
+            results = replies.get(timeout=timeout)
+        except queue.Empty:
+            wrapper.disconnect()
+            return self.timed_out(node, timeout)
+        self.report(results, node)
+        return results
+
+
+def succeeded(results, step=None):
+    '''Returns `True` if all steps in plan results succeeded. If `step` is set, only checks steps with that function name.
+    `None` results, for nodes we could not connect to, never succeed.'''
+    return results != None and all(x['ok'] for x in results if step == None or x['step'] == step)
@@ -0,0 +1,57 @@
+import os
+import subprocess
+
+import prometheus_grafana_deploy.internal.defaults.pool as defaults
+import prometheus_grafana_deploy.internal.util.fs as fs
+import prometheus_grafana_deploy.internal.util.location as loc
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Persistent connection pool, based on ssh connection multiplexing (ControlMaster).
+The first connection to a host starts a background master connection, which stays alive for a while after the connection closes.
+Later connections to the same host, also from later invocations, reuse the master and skip the key exchange and authentication.'''
+
+
+def ssh_params(persist=defaults.persist()):
+    '''Returns ssh config options to connect through the pool.
+    Args:
+        persist (optional str): Time a master connection stays alive after its last use, in ssh time format (e.g. "30m"). See `ControlPersist` in ssh_config(5).
+
+    Returns:
+        `dict` of ssh config options.'''
+    fs.mkdir(loc.ssh_controldir(), exist_ok=True)
+    os.chmod(loc.ssh_controldir(), 0o700) # Anyone able to reach a control socket can use its connection.
+    return {'ControlMaster': 'auto', 'ControlPath': fs.join(loc.ssh_controldir(), '%r@%h:%p'), 'ControlPersist': persist}
+
+
+def _control(socketpath, command):
+    '''Sends a control command ("check", "exit") to the master listening on given socket.
+    Returns:
+        `True` if the master accepted the command, `False` otherwise.'''
+    return subprocess.call(['ssh', '-F', '/dev/null', '-S', socketpath, '-O', command, 'pooled'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def _sockets():
+    if not fs.isdir(loc.ssh_controldir()):
+        return []
+    return sorted(fs.ls(loc.ssh_controldir(), full_paths=True))
+
+
+def list_connections():
+    '''Lists pooled connections.
+    Returns:
+        `list(tuple(str, bool))`, containing the name ("user@host:port") of every pooled connection, and whether it is still alive.'''
+    return [(fs.basename(x), _control(x, 'check')) for x in _sockets()]
+
+
+def flush_connections():
+    '''Closes all pooled connections, and removes sockets of connections that died.
+    Returns:
+        Number of closed connections.'''
+    closed = 0
+    for x in _sockets():
+        if _control(x, 'exit'):
+            closed += 1
+        else:
+            fs.rm(x, ignore_errors=True)
+    return closed
@@ -0,0 +1,192 @@
+import os
+import time
+
+import prometheus_grafana_deploy.internal.defaults.push as defaults
+from prometheus_grafana_deploy.internal.remoto.fanout import run_plans
+from prometheus_grafana_deploy.internal.remoto.plan import succeeded
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Push mode: We stream release archives to nodes over the execnet channel we already have open, so nodes do not need internet access.
+Archives go to the archive cache of every node (see `archive_dir()` in `internal/remoto/modules/util.py`), from which install steps extract them.'''
+
+_timeout_grace = 30 # See `internal/remoto/plan.py`.
+
+
+class Transfer(object):
+    '''Streams files to one node, in chunks, over the channel of the lifecycle bundle. Files the node has cached already are skipped.
+    Transfers have the same interface as `Plan`, so `run_plans` and `EventLoop` execute transfers on many nodes at once, without a thread per node.
+    After `submit()`, all work happens in channel callbacks. These come from the execnet receiver thread of the node, one at a time.'''
+    def __init__(self, files, chunk_size=defaults.chunk_size(), in_flight=defaults.in_flight()):
+        '''Args:
+            files (list(tuple(str, str))): Local path and sha256 digest of every file to send. Files keep their name on the node.
+            chunk_size (optional int): Number of bytes to send per chunk.
+            in_flight (optional int): Maximum number of chunks sent, but not yet written by the node.'''
+        self._files = files
+        self._chunk_size = chunk_size
+        self._in_flight = in_flight
+
+    def __len__(self):
+        return len(self._files)
+
+
+    def local_timeout(self, step_timeout=None, node_timeout=None):
+        '''Returns number of seconds after which we give up on a node, or `None` to wait forever. Every file counts as one step.'''
+        step_timeout, node_timeout = step_timeout or None, node_timeout or None # 0 disables timeouts.
+        if node_timeout:
+            return node_timeout + _timeout_grace
+        if step_timeout:
+            return step_timeout * len(self._files) + _timeout_grace
+        return None
+
+
+    def failed(self, error):
+        '''Returns transfer results in which every file failed with given error message.'''
+        return [{'step': 'push {}'.format(os.path.basename(path)), 'ok': False, 'skipped': False, 'result': None, 'error': error} for path, _ in self._files]
+
+
+    def submit(self, wrapper, module, callback, step_timeout=None, node_timeout=None):
+        '''Starts sending all files to the remote host. Does not wait for the transfer to finish.
+        Args:
+            wrapper (RemotoSSHWrapper): Connection to send files over.
+            module (module): Lifecycle bundle module.
+            callback (callable): Called as `callback(results)` once all files are sent, from the execnet receiver thread.
+                                 `results` is a `list(dict)` containing a result for every file, in the format of plan results. Results of sent files have a `dict` with keys "bytes", "seconds" and "cached" as "result".
+            step_timeout (optional float): If set, maximum number of seconds sending one file may take.
+            node_timeout (optional float): If set, maximum number of seconds sending all files may take.
+
+        Returns:
+            Number of seconds after which we should give up on the remote host, see `local_timeout()`.'''
+        self._callback = callback
+        self._results = []
+        self._index = -1
+        try:
+            self._remote = wrapper.import_module(module)
+        except (OSError, EOFError) as e:
+            callback(self.failed('Could not send module to remote host: {}'.format(e)))
+        else:
+            self._next_file()
+        return self.local_timeout(step_timeout, node_timeout)
+
+
+    def _next_file(self):
+        self._index += 1
+        if self._index == len(self._files):
+            return self._callback(self._results)
+        path, sha256 = self._files[self._index]
+        self._name = os.path.basename(path)
+        self._start = time.monotonic()
+        self._sent = 0
+        self._unacknowledged = 0
+        self._error = None
+        self._eof = False
+        self._pumping = False
+        self._remote.submit('archive_cached', (self._name, sha256), self._on_cached)
+
+
+    def _done(self, ok, error=None, cached=False):
+        self._results.append({'step': 'push {}'.format(self._name), 'ok': ok, 'skipped': False, 'result': {'bytes': self._sent, 'seconds': time.monotonic()-self._start, 'cached': cached} if ok else None, 'error': error, 'start': self._start, 'end': time.monotonic()})
+        self._next_file()
+
+
+    def _on_cached(self, ok, value):
+        if not ok:
+            return self._done(False, value)
+        if value:
+            return self._done(True, cached=True)
+        try:
+            self._file = open(self._files[self._index][0], 'rb')
+        except OSError as e:
+            return self._done(False, 'Could not read {}: {}'.format(self._files[self._index][0], e))
+        self._unacknowledged += 1
+        self._pumping = True
+        self._remote.submit('receive_archive_start', (self._name,), self._on_chunk)
+        self._pump()
+
+
+    def _on_chunk(self, ok, value):
+        self._unacknowledged -= 1
+        if not ok and not self._error:
+            self._error = value
+        if not self._pumping: # Failing sends call back right away, while we are still pumping.
+            self._pump()
+
+
+    def _pump(self):
+        '''Sends chunks until `in_flight` chunks are unacknowledged. Once everything is acknowledged, finishes the file.'''
+        self._pumping = True
+        while not (self._error or self._eof) and self._unacknowledged < self._in_flight:
+            data = self._file.read(self._chunk_size)
+            if not data:
+                self._eof = True
+                break
+            self._sent += len(data)
+            self._unacknowledged += 1
+            self._remote.submit('receive_archive_chunk', (self._name, data), self._on_chunk)
+        self._pumping = False
+        if self._unacknowledged == 0 and (self._error or self._eof):
+            self._file.close()
+            if self._error:
+                self._done(False, self._error)
+            else:
+                self._remote.submit('receive_archive_finish', (self._name, self._files[self._index][1]), lambda ok, value: self._done(ok, None if ok else value))
+
+
+    def report(self, results, node=None):
+        '''Reports files that could not be sent in given transfer results.'''
+        for result in results:
+            if not result['ok']:
+                printe('Could not {}{}: {}'.format(result['step'], ' to node {}'.format(node) if node else '', result['error']))
+
+
+    def timed_out(self, node, timeout):
+        '''Reports that a node did not receive all files in time.
+        Returns:
+            Transfer results in which every file failed.'''
+        printe('Node {} did not receive all files within {} seconds. Cancelling.'.format(node, timeout))
+        return self.failed('Timed out.')
+
+
+    def trace(self, tracer, node, results, submitted, received):
+        '''Records a span for every file in given transfer results with given tracer. See `Plan.trace`.'''
+        tracer.add('push', submitted, received, node=node)
+        for result in results:
+            if result.get('start') != None:
+                tracer.add(result['step'], result['start'], result['end'], node=node, args=result['result'])
+
+
+def push_files(files, module, wrappers, max_parallel=None, window=False, step_timeout=None, node_timeout=None, retry_failed=0, chunk_size=defaults.chunk_size(), in_flight=defaults.in_flight(), tracer=None, silent=False):
+    '''Streams local files to the archive cache of nodes, over their lifecycle bundle channel. Reports throughput per node and in total.
+    Args:
+        files (dict(metareserve.Node, list(tuple(str, str)))): Local path and sha256 digest of every file to send, per node.
+        module (module): Lifecycle bundle module.
+        wrappers (dict(metareserve.Node, RemotoSSHWrapper)): Connection to send files over, per node.
+        max_parallel (optional int): Maximum number of nodes to send files to at once. If `None`, sends to all nodes at once.
+        window (optional bool): If set, every connection is opened right before sending, and disconnected right after. See `run_plans`.
+        step_timeout (optional float): If set, maximum number of seconds sending one file may take.
+        node_timeout (optional float): If set, maximum number of seconds sending all files to one node may take.
+        retry_failed (optional int): Number of times to send files again to nodes where sending failed.
+        chunk_size (optional int): Number of bytes to send per chunk.
+        in_flight (optional int): Maximum number of chunks per node sent, but not yet written by the node.
+        tracer (optional Tracer): If set, records how long sending every file takes on every node.
+        silent (optional bool): If set, does not print throughput.
+
+    Returns:
+        `dict(metareserve.Node, bool)`, mapping every node to whether it received all files.'''
+    t0 = time.monotonic()
+    results = run_plans({node: Transfer(x, chunk_size=chunk_size, in_flight=in_flight) for node, x in files.items()}, module, wrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)
+    elapsed = time.monotonic() - t0
+    if not silent:
+        rates = []
+        for node, x in results.items():
+            sent = sum(y['result']['bytes'] for y in x or [] if y['ok'])
+            seconds = sum(y['result']['seconds'] for y in x or [] if y['ok'] and y['result']['bytes'] > 0)
+            if seconds > 0:
+                rates.append(sent / seconds)
+        total = sum(y['result']['bytes'] for x in results.values() for y in x or [] if y['ok'])
+        cached = sum(1 for x in results.values() for y in x or [] if y['ok'] and y['result']['cached'])
+        print('Pushed {:.1f} MiB to {} node(s) in {:.1f} seconds ({:.1f} MiB/s in total). {} file(s) were cached on nodes already.'.format(total/1024/1024, len(rates), elapsed, total/1024/1024/elapsed if elapsed > 0 else 0, cached))
+        if any(rates):
+            rates.sort()
+            print('Throughput per node: {:.1f} MiB/s min, {:.1f} MiB/s median, {:.1f} MiB/s max.'.format(rates[0]/1024/1024, rates[len(rates)//2]/1024/1024, rates[-1]/1024/1024))
+    return {node: succeeded(x) for node, x in results.items()}
@@ -0,0 +1,86 @@
+import sys
+import threading
+
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Relayed connections: We open one connection to a relay node (normally the admin), and spawn gateways to all other nodes from there, using execnet's "via" support.
+This way, only one connection crosses the (slow) link between the operator machine and the cluster.'''
+
+_join_timeout = 5 # Seconds to wait for a relayed gateway to exit.
+_local_options = ('IdentityFile', 'ControlMaster', 'ControlPath', 'ControlPersist') # ssh options referring to files on the operator machine.
+
+
+class RelayedConnection(object):
+    '''Minimal stand-in for `remoto.Connection`, for gateways spawned through a relay.'''
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    @property
+    def gateway(self):
+        return self._gateway
+
+    def exit(self):
+        self._gateway.exit()
+        self._gateway.join(timeout=_join_timeout)
+        # execnet joins exited gateways again when terminating their group, talking to them through the relay gateway.
+        # By then, the relay gateway is closed already. As we just joined this gateway, we remove it from the group instead.
+        try:
+            self._gateway._group._gateways_to_join.remove(self._gateway)
+        except ValueError:
+            pass
+
+
+class Relay(object):
+    '''Connection to a relay node, shared by multiple wrappers. The connection is opened when first needed, and closed when the last wrapper closes the relay.
+    Args:
+        connect (callable): Takes no arguments, and opens a `remoto.Connection` to the relay node. Must return `None` on failure.
+        users (int): Number of wrappers sharing this relay.
+        ssh_config (optional closable): ssh config used by `connect`. Closed together with the relay connection.'''
+    def __init__(self, connect, users, ssh_config=None):
+        self._connect = connect
+        self._connection = None
+        self._users = users
+        self._ssh_config = ssh_config
+        self._lock = threading.Lock()
+
+    def _relay_connection(self):
+        with self._lock:
+            if self._connect:
+                self._connection = self._connect()
+                self._connect = None
+            return self._connection
+
+    def connect(self, hostname=None, ssh_params=None):
+        '''Opens a gateway through the relay node.
+        Args:
+            hostname (optional str): Host to connect to, as seen from the relay node. If `None`, starts a new Python process on the relay node itself.
+            ssh_params (optional dict): ssh options to connect with from the relay node. Options referring to local files (e.g. "IdentityFile") are skipped: The relay node uses its own ssh keys.
+
+        Returns:
+            `RelayedConnection` on success, `None` on failure.'''
+        relay_connection = self._relay_connection()
+        if not relay_connection:
+            return None
+        python = 'python{}'.format(sys.version_info[0])
+        if hostname:
+            options = ' '.join('-o {}={}'.format(k, v) for k, v in (ssh_params or {}).items() if not k in _local_options)
+            spec = 'ssh={} {}//via={}//python={}'.format(options, hostname, relay_connection.gateway.id, python)
+        else:
+            spec = 'popen//via={}//python={}'.format(relay_connection.gateway.id, python)
+        try:
+            gateway = relay_connection.group.makegateway(spec)
+        except Exception as e:
+            printe('Could not connect to remote host {} through relay.'.format(hostname or 'relay'))
+            return None
+        gateway.reconfigure(py2str_as_py3str=False, py3str_as_py2str=False)
+        return RelayedConnection(gateway)
+
+    def close(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                if self._connection:
+                    self._connection.exit()
+                if self._ssh_config:
+                    self._ssh_config.close()
@@ -0,0 +1,127 @@
+import collections
+import threading
+import zlib
+
+
+'''Ships generated modules to remote hosts over execnet, compressed, and calls functions in them.'''
+
+
+# Source executed on the remote host. Receives the compressed module, executes it in a fresh namespace, and serves calls until the channel closes.
+# Exceptions are sent back instead of raised, so one failing call does not close the channel for later calls.
+_bootstrap = '''
+import traceback
+import zlib
+
+namespace = {'__name__': '__remote_module__'}
+exec(compile(zlib.decompress(channel.receive()).decode('utf-8'), '<remote_module>', 'exec'), namespace)
+for name, args in channel:
+    try:
+        channel.send((True, namespace[name](*args)))
+    except Exception as e:
+        channel.send((False, traceback.format_exc()))
+'''
+
+_compressed = dict() # Maps module keys to compressed module sources.
+_compressed_lock = threading.Lock()
+
+
+def module_key(module):
+    '''Returns key to identify given module with. Modules generated by `ModuleGenerator.load()` are identified by their digest, other modules by their name.'''
+    return getattr(module, '__digest__', module.__name__)
+
+
+def compressed_source(module):
+    '''Returns zlib-compressed source of given module. Compression happens once per module per process.'''
+    key = module_key(module)
+    with _compressed_lock:
+        if not key in _compressed:
+            with open(module.__file__, 'rb') as f:
+                _compressed[key] = zlib.compress(f.read(), 9)
+        return _compressed[key]
+
+
+_closed = object() # execnet endmarker, received by a channel callback when the channel closes.
+
+
+class RemoteModule(object):
+    '''Handle to a module executing on a remote host. The module source is sent once, when constructing this object.
+    Calls share one execnet channel, and are executed remotely one after another.
+    Replies are received by a channel callback in the execnet receiver thread, so no thread needs to block while waiting for a remote function.'''
+    def __init__(self, gateway, module):
+        self._module = module
+        self._lock = threading.Lock()
+        self._pending = collections.deque() # Callbacks waiting for a reply, in call order.
+        self._open = True
+        self._channel = gateway.remote_exec(_bootstrap)
+        self._channel.setcallback(self._receive, endmarker=_closed)
+        self._channel.send(compressed_source(module))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self._module, name):
+            raise AttributeError('module {} does not have attribute {}'.format(self._module.__name__, name))
+
+        def wrapper(*args):
+            return self.call(name, *args)
+        return wrapper
+
+    def _receive(self, reply):
+        with self._lock:
+            if reply is _closed:
+                self._open = False
+                callbacks = list(self._pending)
+                self._pending.clear()
+            else:
+                callbacks = [self._pending.popleft()]
+        for callback in callbacks:
+            if reply is _closed:
+                callback(False, 'Connection closed before remote function returned.')
+            elif reply[0]:
+                callback(*reply)
+            else: # Only keep the final traceback line, as earlier lines refer to code that does not exist locally.
+                callback(False, next((x for x in reversed(reply[1].split('\n')) if x), reply[1]))
+
+    def submit(self, name, args, callback):
+        '''Calls a function of the remote module, without waiting for it to return.
+        Args:
+            name (str): Name of function to call.
+            args (tuple): Arguments for the function. Must be serializable by execnet.
+            callback (callable): Called as `callback(ok, value)` once the function returns, with `ok` set and the return value as `value`.
+                                 If the function raises, or the connection closes first, called with `ok` unset and an error message as `value`.
+                                 Called from the execnet receiver thread, so it should return quickly.'''
+        with self._lock:
+            if self._open:
+                try:
+                    self._channel.send((name, args))
+                    self._pending.append(callback)
+                    return
+                except (OSError, EOFError) as e:
+                    error = 'Could not send call to remote host: {}'.format(e)
+            else:
+                error = 'Connection closed before remote function returned.'
+        callback(False, error)
+
+    def call(self, name, *args, timeout=None):
+        '''Calls a function of the remote module, and waits for it to return.
+        Args:
+            name (str): Name of function to call.
+            args: Arguments for the function. Must be serializable by execnet.
+            timeout (optional float): If set, raises `TimeoutError` when the function does not return within this many seconds.
+                                      The remote function keeps running, and later calls only start remotely once it returns.
+
+        Returns:
+            Function return value.'''
+        done = threading.Event()
+        reply = []
+        def _callback(ok, value):
+            reply.append((ok, value))
+            done.set()
+        self.submit(name, args, _callback)
+        if not done.wait(timeout):
+            raise TimeoutError('Remote call {} did not return within {} seconds.'.format(name, timeout))
+        ok, value = reply[0]
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def close(self):
+        self._channel.close()
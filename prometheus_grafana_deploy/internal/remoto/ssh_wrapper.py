@@ -1,5 +1,6 @@
 import concurrent.futures
 import tempfile
+import threading
 import uuid
 
 from prometheus_grafana_deploy.thirdparty.sshconf import *
@@ -7,15 +8,29 @@ from prometheus_grafana_deploy.thirdparty.sshconf import *
 import logging
 import remoto
 
+import prometheus_grafana_deploy.internal.remoto.fanout as _fanout
+import prometheus_grafana_deploy.internal.remoto.pool as _pool
+import prometheus_grafana_deploy.internal.remoto.relay as _relay
+from prometheus_grafana_deploy.internal.remoto.remote_module import RemoteModule, module_key
 from prometheus_grafana_deploy.internal.util.printer import *
+import prometheus_grafana_deploy.internal.util.trace as _trace
 
 
 class RemotoSSHWrapper(object):
-    '''Simple wrapper containing a remoto connection and the file it is using as ssh config.'''
-    def __init__(self, connection, ssh_config=None):
+    '''Simple wrapper containing a remoto connection and the file it is using as ssh config.
+    Remote modules imported through this wrapper are cached for the lifetime of the wrapper.
+    Wrappers built with a `connect` callable can connect again after `disconnect()`, e.g. to retry a node after cancelling it. Lazy wrappers receive only the callable, and only connect when calling `connect()`.
+    Relayed wrappers share a `Relay`, which is closed when the last wrapper using it closes.'''
+    def __init__(self, connection, ssh_config=None, connect=None, relay=None):
         self._connection = connection
+        self._connect = connect
+        self._relay = relay
         self._ssh_config = ssh_config
         self._open = True
+        self._remote_modules = dict()
+        self._remote_modules_lock = threading.Lock()
+        self._module_hits = 0
+        self._module_misses = 0
 
     def __enter__(self):
         return self
@@ -36,7 +51,60 @@ class RemotoSSHWrapper(object):
     def open(self):
         '''If set, connection is open. Otherwise, Connection is closed'''
         return self._open and self._connection != None
-    
+
+    @property
+    def reconnectable(self):
+        '''If set, this wrapper can `connect()` again after `disconnect()`.'''
+        return self._open and self._connect != None
+
+    @property
+    def module_hits(self):
+        '''Number of `import_module()` calls served from the remote module cache. Every hit saves sending and executing the module source remotely.'''
+        return self._module_hits
+
+    @property
+    def module_misses(self):
+        '''Number of `import_module()` calls that had to send the module source to the remote host.'''
+        return self._module_misses
+
+
+    def connect(self):
+        '''Opens the connection, if it is not open and this wrapper is `reconnectable`. Does nothing for other wrappers.
+        Returns:
+            This wrapper.'''
+        if self._connection == None and self._connect and self._open:
+            self._connection = self._connect()
+        return self
+
+
+    def disconnect(self):
+        '''Closes the connection, keeping the wrapper itself usable to `connect()` again, if it is `reconnectable`. Other wrappers are closed, as with `exit()`.'''
+        if not self._connect:
+            return self.exit()
+        if self._connection:
+            self._connection.exit()
+            self._connection = None
+        self._remote_modules.clear()
+
+
+    def import_module(self, module):
+        '''Imports given module on the remote host, or returns the handle of an earlier import of the same module.
+        The module source is sent compressed, and only once per connection.
+        Modules generated by `ModuleGenerator.load()` are identified by their digest, other modules by their name.
+        Args:
+            module (module): Module to import remotely.
+
+        Returns:
+            `RemoteModule` handle to call functions of the remote module with.'''
+        key = module_key(module)
+        with self._remote_modules_lock:
+            if key in self._remote_modules:
+                self._module_hits += 1
+            else:
+                self._module_misses += 1
+                self._remote_modules[key] = RemoteModule(self._connection.gateway, module)
+            return self._remote_modules[key]
+
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.exit()
@@ -44,28 +112,65 @@ class RemotoSSHWrapper(object):
 
 
     def exit(self):
+        if not self._open: # Already closed.
+            return
         if self._connection:
             self._connection.exit()
         if self._ssh_config:
             self._ssh_config.close()
+        if self._relay:
+            self._relay.close()
+        self._remote_modules.clear()
         self._open = False
 
 
-def _build_ssh_config(hostname, ssh_params):
+class _SharedSSHConfig(object):
+    '''Temporary ssh config file shared by multiple wrappers. The file is removed when the last wrapper closes it.'''
+    def __init__(self, tmpfile, users):
+        self._tmpfile = tmpfile
+        self._users = users
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._tmpfile.name
+
+    def close(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._tmpfile.close()
+
+
+def _resolve_ssh_params(node, ssh_params, pool=None):
+    '''Returns ssh config options for given node, or `None` if no config is required.'''
+    if callable(ssh_params):
+        ssh_params = ssh_params(node)
+    if not ssh_params and not pool:
+        return None
+    if not isinstance(ssh_params or {}, dict):
+        raise ValueError('ssh_params must be a dict, mapping ssh options to values. E.g: {{"IdentityFile": "/some/key.rsa", "IdentitiesOnly": "yes", "Port": 22}}')
+    if pool:
+        return dict(ssh_params or {}, **_pool.ssh_params(persist=pool))
+    return ssh_params
+
+
+def _build_ssh_config(host_params):
     '''Writes a temporary ssh config with provided parameters.
     Warning: Returned value must be closed properly.
     Args:
-        hostname (str): Hostname to register.
-        ssh_params (dict): Parameters to set for hostname. A valid dict would be e.g: {"IdentityFile": "/some/key.rsa", "IdentitiesOnly": "yes", "Port": 22}
+        host_params (dict(str, dict)): Maps hostnames to parameters to set for that hostname. A valid parameter dict would be e.g: {"IdentityFile": "/some/key.rsa", "IdentitiesOnly": "yes", "Port": 22}.
+                                       If all hostnames share the same parameters, a single wildcard entry is written instead of one entry per hostname.
 
     Returns:
         TemporaryFile containing the ssh config.'''
-    if callable(ssh_params):
-        ssh_params = ssh_params(node)
-    if not isinstance(ssh_params, dict):
-        raise ValueError('ssh_params must be a dict, mapping ssh options to values. E.g: {{"IdentityFile": "/some/key.rsa", "IdentitiesOnly": "yes", "Port": 22}}')
     conf = empty_ssh_config_file()
-    conf.add(hostname, **ssh_params)
+    distinct = list({tuple(sorted((k, str(v)) for k, v in x.items())): x for x in host_params.values()}.values())
+    if len(distinct) == 1:
+        conf.add('*', **distinct[0])
+    else:
+        for hostname, params in host_params.items():
+            conf.add(hostname, **params)
     tmpfile = tempfile.NamedTemporaryFile()
     conf.write(tmpfile.name)
     return tmpfile
@@ -97,7 +202,7 @@ def _build_conn(hostname, loggername, silent, ssh_configpath=None):
         return None
 
 
-def get_wrapper(node, hostname, ssh_params=None, loggername=None, silent=False):
+def get_wrapper(node, hostname, ssh_params=None, loggername=None, pool=None, silent=False):
     '''Gets a connection wrapper.
     Warning: The `RemotoSSHWrapper` objects created here must be properly closed. A "with" clause is supported to close all wrappers on function exit.
     Args:
@@ -106,54 +211,135 @@ def get_wrapper(node, hostname, ssh_params=None, loggername=None, silent=False):
         ssh_params (optional dict, callable): If set, builds a temporary ssh config file with provided options to open connection with.
                                                        Can be a callable (i.e. function/lambda), which takes 1 node as argument, and outputs the dict with ssh config options (or `None`) for that node.
         loggername (optional str, callable): Name for logger. Can be either a `str` or a callable. Callables must take 1 node as argument, and output the logger name (`str`) to use for that node. If not set, uses random logger name.
+        pool (optional str): If set, connects through the persistent connection pool, keeping the connection alive for given time (e.g. "30m") after closing it.
         silent (optional bool): If set, connection is silent (except when reporting errors).
 
     Returns:
         `RemotoSSHWrapper` on success, `None` otherwise.'''
-    if loggername == None:
-        loggername = 'logger-'+str(uuid.uuid4())
-    elif callable(loggername):
-        loggername = loggername(node)
-
     if callable(hostname):
         hostname = hostname(node)
 
-    if callable(ssh_params):
-        ssh_params = ssh_params(node)
+    params = _resolve_ssh_params(node, ssh_params, pool=pool)
+    ssh_config = _build_ssh_config({hostname: params}) if params else None
+    return RemotoSSHWrapper(_build_conn(hostname, _loggername(node, loggername), silent, ssh_configpath=ssh_config.name if ssh_config else None), ssh_config=ssh_config)
 
-    ssh_config = _build_ssh_config(hostname, ssh_params) if ssh_params else None
-    conn = _build_conn(hostname, loggername, silent, ssh_configpath=ssh_config.name if ssh_config else None)
-    return RemotoSSHWrapper(conn, ssh_config=ssh_config)
 
+def _loggername(node, loggername=None):
+    if loggername == None:
+        return 'logger-'+str(uuid.uuid4())
+    return loggername(node) if callable(loggername) else loggername
+
+
+def _make_wrappers(connectors, ssh_configs=None, relay=None, parallel=True, max_parallel=None, lazy=False):
+    '''Builds a wrapper for every node.
+    Args:
+        connectors (dict(metareserve.Node, callable)): Maps nodes to a callable taking no arguments, which opens the connection to that node.
+        ssh_configs (optional dict(metareserve.Node, closable)): ssh config per node, closed when the wrapper of that node closes.
+        relay (optional Relay): Relay shared by all wrappers.
+
+    Returns:
+        `dict(metareserve.Node, RemotoSSHWrapper)`.'''
+    ssh_configs = ssh_configs or dict()
+    if lazy:
+        return {x: RemotoSSHWrapper(None, ssh_config=ssh_configs.get(x), connect=connect, relay=relay) for x, connect in connectors.items()}
+    if parallel:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_fanout.workers(len(connectors), max_parallel)) as executor:
+            futures_connect = {x: executor.submit(connect) for x, connect in connectors.items()}
+            return {x: RemotoSSHWrapper(v.result(), ssh_config=ssh_configs.get(x), connect=connectors[x], relay=relay) for x, v in futures_connect.items()}
+    return {x: RemotoSSHWrapper(connect(), ssh_config=ssh_configs.get(x), connect=connect, relay=relay) for x, connect in connectors.items()}
 
-def get_wrappers(nodes, hostnames, ssh_params=None, loggername=None, parallel=True, silent=False):
+
+def get_wrappers(nodes, hostnames, ssh_params=None, loggername=None, parallel=True, pool=None, max_parallel=None, handshake_rate=None, lazy=False, relay=None, relay_hostnames=None, tracer=None, silent=False):
     '''Gets multiple wrappers at once.
     Warning: The `RemotoSSHWrapper` objects created here must be properly closed.
     Args:
         nodes (iterable of metareserve.Node): Nodes to build connection for.
         hostnames (dict(metareserve.Node, str), callable): Names to register connections to. Can be either a dict mapping nodes to their hostname or a callable taking 1 node as argument, outputting its hostname.
-        ssh_params (optional dict or callable): If set, builds a temporary ssh config file with provided options to open connection with.
+        ssh_params (optional dict or callable): If set, builds one temporary ssh config file with provided options, shared by all connections.
                                                        Can be a callable (i.e. function/lambda), which takes 1 node as argument, and outputs the dict with ssh config options (or `None`) for that node.
         loggername (optional callable): Callable must take 1 node as argument, and output the logger name (`str`) to use for that node. If not set, uses random logger names.
         parallel (optional bool): If set, creates wrappers in parallel. Otherwise, creates sequentially.
+        pool (optional str): If set, connects through the persistent connection pool, keeping connections alive for given time (e.g. "30m") after closing them.
+        max_parallel (optional int): If set, creates at most this many wrappers at once.
+        handshake_rate (optional float): If set, starts at most this many ssh handshakes per second. Useful to stay below the sshd `MaxStartups` limit of shared hosts.
+        lazy (optional bool): If set, does not connect yet. Instead, returned wrappers connect when calling their `connect()`, honoring `handshake_rate`.
+        relay (optional metareserve.Node): If set, only connects to this node directly. All nodes are reached through this node instead, using `relay_hostnames`.
+                                           Note: The relay node connects to other nodes using its own ssh keys.
+        relay_hostnames (optional dict(metareserve.Node, str), callable): Names of nodes as seen from the relay node, e.g. `lambda node: node.ip_local`. Required when setting `relay`.
+        tracer (optional Tracer): If set, records a "connect" span for every node.
         silent (optional bool): If set, connections are silent (except when reporting errors).
 
     Returns:
         `dict(metareserve.Node, RemotoSSHWrapper)`, Maps metareserve.Node to open remoto connection wrapper. Wrapper can be `None`, indicating failure to connect to key node'''
+    nodes = list(nodes)
     hostnames = hostnames if isinstance(hostnames, dict) else {x: hostnames(x) for x in nodes}
-    if parallel:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-            futures_get_wrappers = {x: executor.submit(get_wrapper, x, hostnames[x], ssh_params=ssh_params, loggername=loggername, silent=silent) for x in nodes}
-            return {k: v.result() for k,v in futures_get_wrappers.items()}
-    else:
-        return {x: get_wrapper(x, hostnames[x], ssh_params=ssh_params, loggername=loggername, silent=silent) for x in nodes}
+    limiter = _fanout.RateLimiter(handshake_rate)
+    if relay:
+        return _get_relayed_wrappers(nodes, hostnames, relay, relay_hostnames, limiter, ssh_params=ssh_params, loggername=loggername, parallel=parallel, pool=pool, max_parallel=max_parallel, lazy=lazy, tracer=tracer, silent=silent)
+
+    # All nodes share one ssh config, with one entry per hostname, instead of having one config file (and file handle) per node.
+    # Nodes without ssh_params get no config at all, so they never match a wildcard entry.
+    host_params = dict()
+    configured = set()
+    for x in nodes:
+        params = _resolve_ssh_params(x, ssh_params, pool=pool)
+        if params == None:
+            continue
+        if hostnames[x] in host_params and host_params[hostnames[x]] != params:
+            raise ValueError('Nodes with hostname "{}" have different ssh_params.'.format(hostnames[x]))
+        host_params[hostnames[x]] = params
+        configured.add(x)
+    ssh_config = _SharedSSHConfig(_build_ssh_config(host_params), users=len(configured)) if any(configured) else None
+    ssh_configs = {x: ssh_config if x in configured else None for x in nodes}
+
+    def connector(node):
+        loggername_node = _loggername(node, loggername)
+        def connect():
+            limiter.wait()
+            with _trace.span(tracer, 'connect', node=node):
+                return _build_conn(hostnames[node], loggername_node, silent, ssh_configpath=ssh_configs[node].name if ssh_configs[node] else None)
+        return connect
+    return _make_wrappers({x: connector(x) for x in nodes}, ssh_configs=ssh_configs, parallel=parallel, max_parallel=max_parallel, lazy=lazy)
+
+
+def _get_relayed_wrappers(nodes, hostnames, relay, relay_hostnames, limiter, ssh_params=None, loggername=None, parallel=True, pool=None, max_parallel=None, lazy=False, tracer=None, silent=False):
+    '''Gets wrappers for all nodes, reaching every node through one connection to the relay node. See `get_wrappers`.'''
+    if not relay_hostnames:
+        raise ValueError('relay_hostnames must be set when using a relay.')
+    relay_hostnames = relay_hostnames if isinstance(relay_hostnames, dict) else {x: relay_hostnames(x) for x in nodes}
+
+    params = _resolve_ssh_params(relay, ssh_params, pool=pool)
+    ssh_config = _SharedSSHConfig(_build_ssh_config({hostnames[relay]: params}), users=1) if params else None
+    relay_loggername = _loggername(relay, loggername)
+    shared_relay = _relay.Relay(lambda: _build_conn(hostnames[relay], relay_loggername, silent, ssh_configpath=ssh_config.name if ssh_config else None), users=len(nodes), ssh_config=ssh_config)
+
+    def connector(node):
+        relay_params = _resolve_ssh_params(node, ssh_params)
+        def connect():
+            limiter.wait()
+            with _trace.span(tracer, 'connect', node=node):
+                return shared_relay.connect(None if node == relay else relay_hostnames[node], ssh_params=relay_params)
+        return connect
+    return _make_wrappers({x: connector(x) for x in nodes}, relay=shared_relay, parallel=parallel, max_parallel=max_parallel, lazy=lazy)
+
+
+def module_cache_stats(wrappers):
+    '''Sums remote module cache counters over wrappers.
+    Args:
+        wrappers (iterable(RemotoSSHWrapper)): Wrappers to sum counters of. `None` values are skipped.
+
+    Returns:
+        `(hits, misses)`.'''
+    wrappers = [x for x in wrappers if x]
+    return sum(x.module_hits for x in wrappers), sum(x.module_misses for x in wrappers)
 
 
-def close_wrappers(wrappers, parallel=True):
-    '''Closes an iterable of wrappers.
+def close_wrappers(wrappers, parallel=True, max_parallel=None):
+    '''Closes an iterable of wrappers. Closing a wrapper twice is allowed.
     Args:
         wrappers (RemotoSSHWrapper, list(RemotoSSHWrapper), dict(RemotoSSHWrapper)): Wrappers to close.
-        parallel (optional bool): If set, closes connections in parallel. Otherwise, closes connections sequentially.'''
+        parallel (optional bool): If set, closes connections in parallel. Otherwise, closes connections sequentially.
+        max_parallel (optional int): If set, closes at most this many connections at once.'''
     if isinstance(wrappers, RemotoSSHWrapper):
         closables = [wrappers]
     elif isinstance(wrappers, dict):
@@ -168,7 +354,7 @@ def close_wrappers(wrappers, parallel=True):
     else:
         raise ValueError('Cannot close given wrappers: No dict, list, or single wrapper passed: {}'.format(wrappers))
     if parallel:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(closables)) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_fanout.workers(len(closables), max_parallel)) as executor:
             futures_close = [executor.submit(x.exit) for x in closables]
             for x in futures_close:
                 x.result()
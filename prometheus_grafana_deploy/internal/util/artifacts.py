@@ -0,0 +1,87 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import urllib.request
+
+import prometheus_grafana_deploy.internal.util.fs as fs
+import prometheus_grafana_deploy.internal.util.location as loc
+from prometheus_grafana_deploy.internal.util.printer import *
+
+
+'''Operator-side artifact cache. Release archives are downloaded once per URL, verified, and kept in `loc.artifactdir()` for later commands.'''
+
+
+def sha256sum(path):
+    '''Returns the sha256 digest of given file, as hex string.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _published_sha256(url, timeout=None):
+    '''Returns the sha256 digest published for given URL in a "sha256sums.txt" file next to it, as Prometheus releases have. Returns `None` if there is no such digest.'''
+    name = url.split('/')[-1]
+    try:
+        with urllib.request.urlopen('{}/sha256sums.txt'.format(url.rsplit('/', 1)[0]), timeout=timeout) as response:
+            lines = response.read().decode('utf-8').split('\n')
+    except Exception as e:
+        return None
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip('*') == name:
+            return parts[0].lower()
+    return None
+
+
+def cached(url):
+    '''Returns path where the artifact cache keeps the artifact of given URL. The file may not exist yet.'''
+    return fs.join(loc.artifactdir(), hashlib.sha256(url.encode('utf-8')).hexdigest(), url.split('/')[-1])
+
+
+def fetch(url, sha256=None, retries=5, timeout=60, silent=False):
+    '''Fetches the artifact at given URL into the artifact cache, unless it is cached already. Cached artifacts are verified again before use.
+    Args:
+        url (str): URL of the artifact.
+        sha256 (optional str): Expected sha256 digest. If `None`, uses the digest published next to the artifact (see `_published_sha256`). If nothing is published, any download is accepted, and its digest is recorded.
+        retries (optional int): Amount of download attempts before reporting errors.
+        timeout (optional float): Socket timeout for downloads, in seconds.
+        silent (optional bool): If set, does not print so much info.
+
+    Returns:
+        `(path, sha256)` of the cached artifact on success, `(None, None)` otherwise.'''
+    path = cached(url)
+    digestfile = path+'.sha256'
+    if fs.isfile(path) and fs.isfile(digestfile):
+        with open(digestfile, 'r') as f:
+            recorded = f.read().strip()
+        if sha256 in (None, recorded) and sha256sum(path) == recorded:
+            return path, recorded
+        printw('Cached artifact {} does not match its checksum. Fetching it again.'.format(path))
+
+    expected = sha256 or _published_sha256(url, timeout=timeout)
+    if not expected:
+        printw('No published checksum found for {}. Recording the checksum of our download.'.format(url))
+    fs.mkdir(fs.dirname(path), exist_ok=True)
+    if not silent:
+        print('Fetching {}'.format(url))
+    for x in range(retries):
+        fd, partial = tempfile.mkstemp(dir=fs.dirname(path), suffix='.part')
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response, os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            digest = sha256sum(partial)
+            if expected and digest != expected:
+                raise ValueError('Checksum mismatch: Expected sha256 {}, got {}'.format(expected, digest))
+            os.replace(partial, path)
+            fs.write_atomic(digestfile, digest)
+            return path, digest
+        except Exception as e:
+            fs.rm(partial, ignore_errors=True)
+            if x == retries-1:
+                printe('Could not fetch {}. {}'.format(url, e))
+            elif not silent:
+                printw('Could not fetch {} (attempt {}/{}). {}'.format(url, x+1, retries, e))
+    return None, None
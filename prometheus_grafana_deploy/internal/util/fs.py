@@ -8,6 +8,7 @@ import os
 from pathlib import Path
 import shutil
 import sys
+import tempfile
 from zipfile import ZipFile, ZipInfo
 
 
@@ -106,6 +107,19 @@ def rm(directory, *args, ignore_errors=False):
             os.remove(path)
 
 
+# Write content to a file atomically: Readers either see the old file, or the complete new file.
+# The temporary file is created in the destination directory, as os.replace is only atomic within one filesystem.
+def write_atomic(path, content, binary=False):
+    mkdir(dirname(path), exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=dirname(path), prefix='.{}.'.format(basename(path)))
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            f.write(content)
+        os.replace(tmppath, path)
+    except Exception as e:
+        rm(tmppath, ignore_errors=True)
+        raise e
+
 def sep():
     return os.sep
 
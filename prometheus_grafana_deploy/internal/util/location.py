@@ -3,6 +3,18 @@ import os
 def rootdir():
     return os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
+def cachedir():
+    '''Per-user cache directory, following the XDG base directory specification.'''
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'prometheus_grafana_deploy')
+
+def ssh_controldir():
+    '''Directory holding ssh ControlMaster sockets of pooled connections.'''
+    return os.path.join(cachedir(), 'ssh')
+
+def artifactdir():
+    '''Directory holding release archives fetched by the operator. See `internal/util/artifacts.py`.'''
+    return os.path.join(cachedir(), 'artifacts')
+
 def generators_dir():
     return os.path.join(rootdir(), 'dashboard_generators')
 
@@ -0,0 +1,89 @@
+import contextlib
+import json
+import threading
+import time
+
+
+'''Execution traces: Spans per node and per phase, exported in Chrome trace-event format. Open exported traces in chrome://tracing or https://ui.perfetto.dev.'''
+
+
+class Tracer(object):
+    '''Collects spans. Every span belongs to a node, or to the controller when it has no node. Safe to use from multiple threads.
+    Span times are `time.monotonic()` values.'''
+    def __init__(self):
+        self._t0 = time.monotonic()
+        self._spans = [] # List of (name, category, node, start, end, args).
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, node=None, category='local', args=None):
+        '''Records a span.
+        Args:
+            name (str): Name of the phase, e.g. "connect".
+            start (float): Start time, as `time.monotonic()` value.
+            end (float): End time, as `time.monotonic()` value.
+            node (optional metareserve.Node): Node the span belongs to. If `None`, the span belongs to the controller.
+            category (optional str): "local" for spans measured on this machine, "remote" for spans measured on a node.
+            args (optional dict): Extra information to show with the span.'''
+        with self._lock:
+            self._spans.append((name, category, node, start, max(start, end), args))
+
+    @contextlib.contextmanager
+    def span(self, name, node=None, category='local', args=None):
+        '''Records a span for the duration of a "with" block.'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic(), node=node, category=category, args=args)
+
+
+    def write(self, path):
+        '''Writes all spans to given path, in Chrome trace-event format. Every node gets its own track.'''
+        with self._lock:
+            spans = list(self._spans)
+        tids = {None: 0}
+        for _, _, node, _, _, _ in spans:
+            if not node in tids:
+                tids[node] = len(tids)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'grafana-monitor'}}]
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': 'controller' if node == None else str(node)}} for node, tid in tids.items()]
+        events += [{'name': 'thread_sort_index', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'sort_index': tid}} for tid in tids.values()]
+        events.append({'name': 'command', 'cat': 'local', 'ph': 'X', 'pid': 1, 'tid': 0, 'ts': 0, 'dur': (time.monotonic()-self._t0)*1000000})
+        for name, category, node, start, end, args in spans:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tids[node], 'ts': (start-self._t0)*1000000, 'dur': (end-start)*1000000}
+            if args:
+                event['args'] = args
+            events.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+    def summary(self, top=5):
+        '''Prints the slowest nodes and the slowest phases.
+        Args:
+            top (optional int): Number of nodes and phases to print.'''
+        with self._lock:
+            spans = list(self._spans)
+        busy = dict()
+        for _, _, node, start, end, _ in spans:
+            if node != None:
+                first, last = busy.get(node, (start, end))
+                busy[node] = (min(first, start), max(last, end))
+        phases = dict()
+        for name, _, node, start, end, _ in spans:
+            count, total, longest, longest_node = phases.get(name, (0, 0, -1, None))
+            phases[name] = (count+1, total+end-start, max(longest, end-start), node if end-start > longest else longest_node)
+
+        if busy:
+            print('Slowest nodes:')
+            for node, (first, last) in sorted(busy.items(), key=lambda x: x[1][0]-x[1][1])[:top]:
+                print('    {:<40}{:>10.2f}s'.format(str(node), last-first))
+        if phases:
+            print('Slowest phases (longest, mean, count):')
+            for name, (count, total, longest, longest_node) in sorted(phases.items(), key=lambda x: -x[1][2])[:top]:
+                print('    {:<40}{:>10.2f}s{:>10.2f}s{:>8}{}'.format(name, longest, total/count, count, '   (node {})'.format(longest_node) if longest_node != None else ''))
+
+
+def span(tracer, name, node=None):
+    '''Returns a context manager recording a span with given tracer. Records nothing if `tracer` is `None`.'''
+    return tracer.span(name, node=node) if tracer else contextlib.nullcontext()
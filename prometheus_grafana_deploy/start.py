@@ -1,42 +1,37 @@
-import concurrent.futures
-import hashlib
-import subprocess
-import tempfile
-
 import yaml
 
-import prometheus_grafana_deploy.internal.defaults.start as defaults
+import prometheus_grafana_deploy.internal.defaults.deadline as deadline_defaults
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
 import prometheus_grafana_deploy.internal.defaults.install as install_defaults
-from prometheus_grafana_deploy.internal.remoto.modulegenerator import ModuleGenerator
-from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers
-import prometheus_grafana_deploy.internal.util.fs as fs
-import prometheus_grafana_deploy.internal.util.importer as importer
+import prometheus_grafana_deploy.internal.defaults.start as defaults
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+from prometheus_grafana_deploy.internal.remoto.fanout import run_plans, node_results
+from prometheus_grafana_deploy.internal.remoto.plan import Plan, succeeded
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers, module_cache_stats
 import prometheus_grafana_deploy.internal.util.location as loc
 from prometheus_grafana_deploy.internal.util.printer import *
+from prometheus_grafana_deploy.internal.util.trace import span
 
 
-def _start_prometheus_node_exporter(connection, module, install_dir, silent=False):
-    remote_module = connection.import_module(module)
-
-    if not remote_module.start_prometheus_node_exporter(loc.prometheus_exporterdir(install_dir), silent):
-        printe('Could not start prometheus node exporter.')
-        return False
-    return True
-
-
-def _start_prometheus_admin(connection, module, install_dir, reservation, port=defaults.prometheus_port(), silent=False):
-    remote_module = connection.import_module(module)
+def _prometheus_config(nodes, port=defaults.prometheus_port()):
+    '''Builds Prometheus admin configuration, with a scrape job for every node job.
+    Args:
+        nodes (iterable(metareserve.Node)): Nodes to scrape metrics from.
+        port (optional int): Port to scrape metrics from.
 
-    jobs = set(x.extra_info['job'] for x in reservation.nodes if 'job' in x.extra_info)
-    jobmapping = {x: ['{}:{}'.format(y.ip_public, port) for y in reservation.nodes if 'job' in y.extra_info and y.extra_info['job'] == x] for x in jobs}
+    Returns:
+        configuration `str` on success, `None` when no node has a job.'''
+    nodes = list(nodes)
+    jobs = set(x.extra_info['job'] for x in nodes if 'job' in x.extra_info)
+    jobmapping = {x: ['{}:{}'.format(y.ip_public, port) for y in nodes if 'job' in y.extra_info and y.extra_info['job'] == x] for x in jobs}
 
-    if any(True for x in reservation.nodes if not 'job' in x.extra_info):
-        ignored_nodes = [x for x in reservation.nodes if not 'job' in x.extra_info]
+    if any(True for x in nodes if not 'job' in x.extra_info):
+        ignored_nodes = [x for x in nodes if not 'job' in x.extra_info]
         printw('Ignoring metrics from {} nodes:\n{}'.format(len(ignored_nodes), '\n'.join('    {}'.format(x) for x in ignored_nodes)))
         print('To get metrics for these nodes, describe their job. E.g. specify 0|node0|192.168.1.1|123.456.789.111|22|user=Tester|job=client')
     if not any(jobmapping):
         printe('No jobs specified, cancelling admin boot.')
-        return False
+        return None
 
     configdata = {
         'global': {
@@ -47,35 +42,31 @@ def _start_prometheus_admin(connection, module, install_dir, reservation, port=d
             {'job_name': name, 'static_configs': [{'targets': jobmapping[name]}]} for name in jobmapping.keys()
         ],
     }
-    configstring = yaml.dump(configdata, default_flow_style=False)
-    if not remote_module.start_prometheus_admin(loc.prometheus_admindir(install_dir), configstring,  silent):
-        printe('Could not start Prometheus admin on some node(s).')
-        return False
-    return True
-
-def _start_grafana(node, connection, module, name=defaults.grafana_name(), port=defaults.grafana_port(), image=install_defaults.grafana_image(), silent=False):
-    remote_module = connection.import_module(module)
-    if not remote_module.start_grafana(name, image, port, silent):
-        printe('Could not start Grafana.')
-        return False
-    printc('Grafana main started on http://{}:{}'.format(node.ip_public, port), Color.CAN)
-    print('NOTE: If this is your first time, user will be "admin", password will be "admin".')
-    return True
+    return yaml.dump(configdata, default_flow_style=False)
+
+
+def _start_exporter_plan(install_dir, silent=False):
+    '''Builds the plan to start the node exporter of one node.'''
+    return Plan(stop_on_failure=False).add('start_prometheus_node_exporter', loc.prometheus_exporterdir(install_dir), silent, description='start prometheus node exporter')
 
 
-def _generate_module_start(silent=False):
-    '''Generates Prometheus-start module from available sources.'''
-    generation_loc = fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'generated', 'all_start.py')
-    files = [
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'util', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'util.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'prometheus_start.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'grafana_start.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'remoto_base.py'),
-    ]
-    ModuleGenerator().with_modules(fs, importer).with_files(*files).generate(generation_loc, silent)
-    return importer.import_full_path(generation_loc)
+def _start_admin_plan(install_dir, configstring, grafana_name=defaults.grafana_name(), grafana_port=defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), silent=False):
+    '''Builds the plan to start Prometheus admin and Grafana on the admin node.'''
+    plan = Plan(stop_on_failure=False).add('start_prometheus_admin', loc.prometheus_admindir(install_dir), configstring, silent, description='start Prometheus admin')
+    return plan.add('start_grafana', grafana_name, grafana_image, grafana_port, silent, description='start Grafana')
+
+
+def _start_plan(install_dir, is_admin, configstring, grafana_name=defaults.grafana_name(), grafana_port=defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), silent=False):
+    '''Builds the start plan for one node. Every node starts a node exporter. The admin node also starts Prometheus admin and Grafana.'''
+    plan = _start_exporter_plan(install_dir, silent=silent)
+    if is_admin:
+        plan.extend(_start_admin_plan(install_dir, configstring, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, silent=silent))
+    return plan
+
+
+def _print_grafana_started(node, port=defaults.grafana_port()):
+    printc('Grafana main started on http://{}:{}'.format(node.ip_public, port), Color.CAN)
+    print('NOTE: If this is your first time, user will be "admin", password will be "admin".')
 
 
 def _pick_admin(reservation, admin=None):
@@ -102,7 +93,7 @@ def _merge_kwargs(x, y):
     return z
 
 
-def start(reservation, install_dir=install_defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, prometheus_port=defaults.prometheus_port(), grafana_name=defaults.grafana_name(), grafana_port=defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), silent=False):
+def start(reservation, install_dir=install_defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, prometheus_port=defaults.prometheus_port(), grafana_name=defaults.grafana_name(), grafana_port=defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), pool=None, max_parallel=fanout_defaults.max_parallel(), handshake_rate=fanout_defaults.handshake_rate(), window=False, relay=False, step_timeout=deadline_defaults.step_timeout(), node_timeout=deadline_defaults.node_timeout(), retry_failed=0, partial=False, tracer=None, silent=False):
     '''Start Prometheus on remote cluster.
     Args:
         reservation (metareserve.Reservation): Reservation object with all nodes to start Prometheus on.
@@ -110,6 +101,16 @@ def start(reservation, install_dir=install_defaults.install_dir(), key_path=None
         key_path (optional str): Path to SSH key, which we use to connect to nodes. If `None`, we do not authenticate using an IdentityFile.
         admin_id (optional int): Node id of the admin. If `None`, the node with lowest public ip value (string comparison) will be picked.
         connectionwrappers (optional dict(metareserve.Node, RemotoSSHWrapper)): If set, uses given connections, instead of building new ones.
+        pool (optional str): If set, connects through the persistent connection pool, keeping connections alive for given time (e.g. "30m") for reuse by later invocations.
+        max_parallel (optional int): Maximum number of nodes to connect to and work on at once. If `None`, works on all nodes at once.
+        handshake_rate (optional float): If set, starts at most this many new ssh connections per second.
+        window (optional bool): If set, every connection is opened right before working on its node, and closed right after. This way, at most `max_parallel` connections are open at once. Ignored when passing `connectionwrappers`.
+        relay (optional bool): If set, only connects to the admin node directly, and reaches all other nodes from there, over their local ip. The admin node must be able to ssh to all other nodes using its own ssh keys.
+        step_timeout (optional float): Maximum number of seconds one step (e.g. installing Grafana) may take on a node. If `None` or 0, steps may take forever.
+        node_timeout (optional float): Maximum number of seconds all steps together may take on a node. Nodes that do not finish in time are cancelled and reported. If `None` or 0, nodes may take forever.
+        retry_failed (optional int): Number of times to retry nodes that failed, reusing their connections.
+        partial (optional bool): If set, continues on nodes we can reach when other nodes fail. The Prometheus admin only scrapes nodes that started successfully.
+        tracer (optional Tracer): If set, records how long every phase takes on every node. See `internal/util/trace.py`.
         prometheus_port (optional int): Port to use with Prometheus.
         grafana_name (optional str): Grafana docker run name to use.
         grafana_port (optional int): Port to use with Grafana.
@@ -117,36 +118,75 @@ def start(reservation, install_dir=install_defaults.install_dir(), key_path=None
         silent (optional bool): If set, does not print so much info.
 
     Returns:
-        `True, admin_node_id` on success, `False, None` otherwise.'''
+        `True, admin_node_id` on success, `False, None` otherwise.
+        With `partial` set, returns `True, admin_node_id, node_results` when the Prometheus admin and Grafana started, `False, None, node_results` otherwise.
+        `node_results` is a `dict(metareserve.Node, bool)`, mapping every node to whether it started successfully.'''
     admin_picked, _ = _pick_admin(reservation, admin=admin_id)
     printc('Picked admin node: {}'.format(admin_picked), Color.CAN)
 
     local_connections = connectionwrappers == None
+    window = window and local_connections # We only close connections we opened ourselves.
     if local_connections:
         ssh_kwargs = {'IdentitiesOnly': 'yes', 'User': admin_picked.extra_info['user'], 'StrictHostKeyChecking': 'no'}
         if key_path:
             ssh_kwargs['IdentityFile'] = key_path
         else:
             printw('Connections have no assigned ssh key. Prepare to fill in your password often.')
-        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, silent=silent)
+        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, pool=pool, max_parallel=max_parallel, handshake_rate=handshake_rate, lazy=window, relay=admin_picked if relay else None, relay_hostnames=lambda node: node.ip_local, tracer=tracer, silent=silent)
 
-    if not all(x.open for x in connectionwrappers.values()):
+    if not partial and not window and not all(x.open for x in connectionwrappers.values()):
         if local_connections:
-            close_wrappers(connectionwrappers)
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
         printe('Failed to create at least one connection.')
         return False, None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(reservation)+2) as executor:
-        start_module = _generate_module_start()
-        futures_start = [executor.submit(_start_prometheus_node_exporter, wrapper.connection, start_module, install_dir, silent=silent) for wrapper in connectionwrappers.values()]
-        futures_start.append(executor.submit(_start_prometheus_admin, connectionwrappers[admin_picked].connection, start_module, install_dir, reservation, port=prometheus_port, silent=silent))
-        futures_start.append(executor.submit(_start_grafana, admin_picked, connectionwrappers[admin_picked].connection, start_module, name=grafana_name, port=grafana_port, image=grafana_image, silent=silent))
-
-        if not all(x.result() for x in futures_start):
-            if local_connections:
-                close_wrappers(connectionwrappers)
-            return False, None
-        prints('Prometheus+Grafana started on all nodes.')
+    with span(tracer, 'generate module'):
+        start_module = generate_module_lifecycle(silent=silent)
+    if partial:
+        return _start_partial(reservation, admin_picked, install_dir, connectionwrappers, local_connections, start_module, prometheus_port=prometheus_port, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer, silent=silent)
+
+    configstring = _prometheus_config(reservation.nodes, port=prometheus_port)
+    if not configstring:
+        if local_connections:
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return False, None
+
+    plans = {node: _start_plan(install_dir, node == admin_picked, configstring, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, silent=silent) for node in connectionwrappers.keys()}
+    results = run_plans(plans, start_module, connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)
+    if succeeded(results[admin_picked], step='start_grafana'):
+        _print_grafana_started(admin_picked, port=grafana_port)
+
+    if not all(succeeded(x) for x in results.values()):
         if local_connections:
-            close_wrappers(connectionwrappers)
-        return True, admin_picked.node_id
\ No newline at end of file
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return False, None
+    prints('Prometheus+Grafana started on all nodes.')
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+    if local_connections:
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
+    return True, admin_picked.node_id
+
+
+def _start_partial(reservation, admin_picked, install_dir, connectionwrappers, local_connections, start_module, prometheus_port=defaults.prometheus_port(), grafana_name=defaults.grafana_name(), grafana_port=defaults.grafana_port(), grafana_image=install_defaults.grafana_image(), max_parallel=None, window=False, step_timeout=None, node_timeout=None, retry_failed=0, tracer=None, silent=False):
+    '''Starts Prometheus on all nodes we can reach, and ignores failing nodes. The Prometheus admin only scrapes nodes that started their node exporter.
+    Returns:
+        `(True, admin_node_id, node_results)` if the Prometheus admin and Grafana started, `(False, None, node_results)` otherwise.
+        `node_results` maps every node to whether it started successfully.'''
+    results = run_plans({node: _start_exporter_plan(install_dir, silent=silent) for node in connectionwrappers.keys()}, start_module, connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)
+    configstring = _prometheus_config((node for node, x in results.items() if succeeded(x)), port=prometheus_port)
+    admin_ok = False
+    if configstring:
+        admin_results = run_plans({admin_picked: _start_admin_plan(install_dir, configstring, grafana_name=grafana_name, grafana_port=grafana_port, grafana_image=grafana_image, silent=silent)}, start_module, connectionwrappers, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)[admin_picked]
+        admin_ok = succeeded(admin_results)
+        results[admin_picked] = None if results[admin_picked] == None or admin_results == None else results[admin_picked] + admin_results
+        if succeeded(admin_results, step='start_grafana'):
+            _print_grafana_started(admin_picked, port=grafana_port)
+
+    summary = node_results(results, 'start Prometheus')
+    prints('Prometheus+Grafana started on {}/{} nodes.'.format(sum(summary.values()), len(summary)))
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+    if local_connections:
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
+    return admin_ok, admin_picked.node_id if admin_ok else None, summary
@@ -1,55 +1,23 @@
-import concurrent.futures
-import hashlib
-import subprocess
-import tempfile
-
+import prometheus_grafana_deploy.internal.defaults.deadline as deadline_defaults
+import prometheus_grafana_deploy.internal.defaults.fanout as fanout_defaults
 import prometheus_grafana_deploy.internal.defaults.install as install_defaults
 import prometheus_grafana_deploy.internal.defaults.start as start_defaults
-from prometheus_grafana_deploy.internal.remoto.modulegenerator import ModuleGenerator
-from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers
-import prometheus_grafana_deploy.internal.util.fs as fs
-import prometheus_grafana_deploy.internal.util.importer as importer
+from prometheus_grafana_deploy.internal.remoto.bundle import generate_module_lifecycle
+from prometheus_grafana_deploy.internal.remoto.fanout import run_plans, node_results
+from prometheus_grafana_deploy.internal.remoto.plan import Plan, succeeded
+from prometheus_grafana_deploy.internal.remoto.ssh_wrapper import get_wrappers, close_wrappers, module_cache_stats
 import prometheus_grafana_deploy.internal.util.location as loc
 from prometheus_grafana_deploy.internal.util.printer import *
+from prometheus_grafana_deploy.internal.util.trace import span
 
 
-def _stop_prometheus_node_exporter(connection, module, install_dir, silent=False):
-    remote_module = connection.import_module(module)
-    if not remote_module.stop_prometheus_node_exporter(silent):
-        printe('Could not stop prometheus node exporter.')
-        return False
-    return True
-
-
-def _stop_prometheus_admin(connection, module, install_dir, silent=False):
-    remote_module = connection.import_module(module)
-    if not remote_module.stop_prometheus_admin(silent):
-        printe('Could not stop Prometheus admin on some node(s).')
-        return False
-    return True
-
-
-def _stop_grafana(connection, module, name=start_defaults.grafana_name(), silent=False):
-    remote_module = connection.import_module(module)
-    if not remote_module.stop_grafana(name, silent):
-        printe('Could not stop Grafana.')
-        return False
-    return True
-
-
-def _generate_module_stop(silent=False):
-    '''Generates Prometheus-stop module from available sources.'''
-    generation_loc = fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'generated', 'all_stop.py')
-    files = [
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'util', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'printer.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'util.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'grafana_stop.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'prometheus_stop.py'),
-        fs.join(fs.dirname(fs.abspath(__file__)), 'internal', 'remoto', 'modules', 'remoto_base.py'),
-    ]
-    ModuleGenerator().with_modules(fs, importer).with_files(*files).generate(generation_loc, silent)
-    return importer.import_full_path(generation_loc)
+def _stop_plan(is_admin, grafana_name=start_defaults.grafana_name(), silent=False):
+    '''Builds the stop plan for one node. Every node stops its node exporter. The admin node also stops Prometheus admin and Grafana.'''
+    plan = Plan(stop_on_failure=False).add('stop_prometheus_node_exporter', silent, description='stop prometheus node exporter')
+    if is_admin:
+        plan.add('stop_prometheus_admin', silent, description='stop Prometheus admin')
+        plan.add('stop_grafana', grafana_name, silent, description='stop Grafana')
+    return plan
 
 
 def _pick_admin(reservation, admin=None):
@@ -76,7 +44,7 @@ def _merge_kwargs(x, y):
     return z
 
 
-def stop(reservation, install_dir=install_defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, grafana_name=start_defaults.grafana_name(), silent=False):
+def stop(reservation, install_dir=install_defaults.install_dir(), key_path=None, admin_id=None, connectionwrappers=None, grafana_name=start_defaults.grafana_name(), pool=None, max_parallel=fanout_defaults.max_parallel(), handshake_rate=fanout_defaults.handshake_rate(), window=False, relay=False, step_timeout=deadline_defaults.step_timeout(), node_timeout=deadline_defaults.node_timeout(), retry_failed=0, partial=False, tracer=None, silent=False):
     '''Stop Prometheus on remote cluster.
     Args:
         reservation (`metareserve.Reservation`): Reservation object with all nodes to stop Prometheus on.
@@ -84,38 +52,61 @@ def stop(reservation, install_dir=install_defaults.install_dir(), key_path=None,
         key_path (optional str): Path to SSH key, which we use to connect to nodes. If `None`, we do not authenticate using an IdentityFile.
         admin_id (optional int): Node id of the admin. If `None`, the node with lowest public ip value (string comparison) will be picked.
         connectionwrappers (optional dict(metareserve.Node, RemotoSSHWrapper)): If set, uses given connections, instead of building new ones.
+        pool (optional str): If set, connects through the persistent connection pool, keeping connections alive for given time (e.g. "30m") for reuse by later invocations.
+        max_parallel (optional int): Maximum number of nodes to connect to and work on at once. If `None`, works on all nodes at once.
+        handshake_rate (optional float): If set, starts at most this many new ssh connections per second.
+        window (optional bool): If set, every connection is opened right before working on its node, and closed right after. This way, at most `max_parallel` connections are open at once. Ignored when passing `connectionwrappers`.
+        relay (optional bool): If set, only connects to the admin node directly, and reaches all other nodes from there, over their local ip. The admin node must be able to ssh to all other nodes using its own ssh keys.
+        step_timeout (optional float): Maximum number of seconds one step (e.g. installing Grafana) may take on a node. If `None` or 0, steps may take forever.
+        node_timeout (optional float): Maximum number of seconds all steps together may take on a node. Nodes that do not finish in time are cancelled and reported. If `None` or 0, nodes may take forever.
+        retry_failed (optional int): Number of times to retry nodes that failed, reusing their connections.
+        partial (optional bool): If set, continues on nodes we can reach when other nodes fail.
+        tracer (optional Tracer): If set, records how long every phase takes on every node. See `internal/util/trace.py`.
         grafana_name (optional str): Grafana docker run name to use.
         silent (optional bool): If set, does not print so much info.
 
     Returns:
-        `True` on success, `False` otherwise.'''
+        `True` on success, `False` otherwise.
+        With `partial` set, returns `True, admin_node_id, node_results` when the admin node succeeded, `False, None, node_results` otherwise.
+        `node_results` is a `dict(metareserve.Node, bool)`, mapping every node to whether it stopped successfully.'''
     admin_picked, _ = _pick_admin(reservation, admin=admin_id)
     printc('Picked admin node: {}'.format(admin_picked), Color.CAN)
 
     local_connections = connectionwrappers == None
+    window = window and local_connections # We only close connections we opened ourselves.
     if local_connections:
         ssh_kwargs = {'IdentitiesOnly': 'yes', 'User': admin_picked.extra_info['user'], 'StrictHostKeyChecking': 'no'}
         if key_path:
             ssh_kwargs['IdentityFile'] = key_path
         else:
             printw('Connections have no assigned ssh key. Prepare to fill in your password often.')
-        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, silent=silent)
-    if not all(x.open for x in connectionwrappers.values()):
+        connectionwrappers = get_wrappers(reservation.nodes, lambda node: node.ip_public, ssh_params=ssh_kwargs, pool=pool, max_parallel=max_parallel, handshake_rate=handshake_rate, lazy=window, relay=admin_picked if relay else None, relay_hostnames=lambda node: node.ip_local, tracer=tracer, silent=silent)
+    if not partial and not window and not all(x.open for x in connectionwrappers.values()):
         if local_connections:
-            close_wrappers(connectionwrappers)
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
         printe('Failed to create at least one connection.')
         return False, None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(reservation)+2) as executor:
-        stop_module = _generate_module_stop()
-        futures_stop = [executor.submit(_stop_prometheus_node_exporter, wrapper.connection, stop_module, install_dir, silent=silent) for wrapper in connectionwrappers.values()]
-        futures_stop.append(executor.submit(_stop_prometheus_admin, connectionwrappers[admin_picked].connection, stop_module, install_dir, silent=silent))
-        futures_stop.append(executor.submit(_stop_grafana, connectionwrappers[admin_picked].connection, stop_module, name=grafana_name, silent=silent))
-        if not all(x.result() for x in futures_stop):
-            if local_connections:
-                close_wrappers(connectionwrappers)
-            return False
-        prints('Prometheus+Grafana stopped on all nodes.')
+    with span(tracer, 'generate module'):
+        stop_module = generate_module_lifecycle(silent=silent)
+    plans = {node: _stop_plan(node == admin_picked, grafana_name=grafana_name, silent=silent) for node in connectionwrappers.keys()}
+    results = run_plans(plans, stop_module, connectionwrappers, max_parallel=max_parallel, window=window, step_timeout=step_timeout, node_timeout=node_timeout, retry_failed=retry_failed, tracer=tracer)
+    if partial:
+        summary = node_results(results, 'stop Prometheus')
+        admin_ok = succeeded(results[admin_picked])
+        prints('Prometheus+Grafana stopped on {}/{} nodes.'.format(sum(summary.values()), len(summary)))
+        if not silent:
+            print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
         if local_connections:
-            close_wrappers(connectionwrappers)
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return admin_ok, admin_picked.node_id if admin_ok else None, summary
+    if not all(succeeded(x) for x in results.values()):
+        if local_connections:
+            close_wrappers(connectionwrappers, max_parallel=max_parallel)
+        return False
+    prints('Prometheus+Grafana stopped on all nodes.')
+    if not silent:
+        print('Remote module imports: {} reused, {} sent.'.format(*module_cache_stats(connectionwrappers.values())))
+    if local_connections:
+        close_wrappers(connectionwrappers, max_parallel=max_parallel)
     return True
\ No newline at end of file